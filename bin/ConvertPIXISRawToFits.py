@@ -1,10 +1,15 @@
-import struct 
 import sys 
-import matplotlib.pyplot as plt 
+import time
 #from cantrips import readLinesFromFile 
 import numpy as np
 from datetime import datetime 
 from astropy.io import fits
+from instrumentation import configure_from_environment, span
+from pixis_raw import FrameGeometry, base_header, decode_readouts, choose_byte_order
+from fits_writer import FitsWriter, write_fits_atomic
+from temperature_telemetry import exposure_trace, exposure_window
+from wavelength_calibration import calibration_header_elems
+from exposure_timing import read_timing, timing_file_name, timing_header_elems, log_frame
 
 def readLinesFromFile(file_name): 
     lines = [] 
@@ -13,7 +18,7 @@ def readLinesFromFile(file_name):
     lines = [line.strip() for line in lines]
     return lines  
 
-def saveDataToFitsFile(image_array, file_name, save_dir, header = 'default', overwrite = True):
+def saveDataToFitsFile(image_array, file_name, save_dir, header = 'default', overwrite = True, extensions = []):
 
     if header == 'default':
         default_file = '/Users/sasha/Documents/Harvard/physics/stubbs/skySpectrograph/calData/' + 'default.fits'
@@ -21,53 +26,49 @@ def saveDataToFitsFile(image_array, file_name, save_dir, header = 'default', ove
         header = hdul[0].header 
     
     #master_med_hdu = fits.PrimaryHDU(image_array.transpose(), header = header)
-    master_med_hdu = fits.PrimaryHDU(image_array, header = header)
-    master_med_hdul = fits.HDUList([master_med_hdu])
-    master_med_hdul.writeto(save_dir + file_name, overwrite = overwrite)
+    with span("fits.write", cat="conversion", file=file_name):
+        write_fits_atomic(image_array, header, save_dir + file_name, overwrite = overwrite, extensions = extensions)
     return 1
 
 def convertRawToFits(source_file, target_file_wo_suffix, 
                      source_dir = '', target_dir = '', n_imgs = 1, 
                      img_dimen = [1024, 1024], n_unsigned_bytes = 2,
-                     target_suffix = '.fits', big_endian = 0, header_elems_to_add = []):
-    raw_object = open(source_dir + source_file, 'rb') 
-    raw_data = raw_object.read() 
-    single_img_length = img_dimen[0] * img_dimen[1] * n_unsigned_bytes
-    separated_data = [raw_data[i * single_img_length:(i+1) * single_img_length ] 
-                      for i in range(n_imgs) ]
+                     target_suffix = '.fits', big_endian = None, header_elems_to_add = [],
+                     geometry = None, extensions = []):
+    #The readout layout (ROI, binning, stride, bit depth) comes from the geometry file
+    # configure_sasha writes; without one, img_dimen and n_unsigned_bytes describe an unbinned frame. 
+    if geometry is None:
+        geometry = FrameGeometry.from_dimen(img_dimen, n_unsigned_bytes)
+    with span("raw.read", cat="conversion", file=source_file):
+        raw_data = np.memmap(source_dir + source_file, dtype=np.uint8, mode='r')
     #The endian-ness of the data flipped on me at least once during my time working with the camera.
-    #I therefore am providing the user the opportunity to flip the endianness, if they need to
-    # (once the data is moved to a fits file, then it should be stable). 
+    #By default (big_endian = None) the byte order is therefore picked for every frame from how
+    # smooth it looks, and recorded as BYTEORDR; pass 0 or 1 to force it. 
     #If you are seeing an image that looks only like noise, and the noise is escessive
-    # or one with 'tearing' patterns, then you might try flipping the endian-ness here and see
-    # if that helps. 
-    if big_endian:
-        img_fmt = '>' + str(img_dimen[0] * img_dimen[1]) + 'H' 
-    else: 
-        img_fmt = '<' + str(img_dimen[0] * img_dimen[1]) + 'H' 
-
-    flat_img_arrays = [struct.unpack(img_fmt, data_set) for data_set in separated_data]
-    
-    img_arrays = [np.flip(np.reshape(flat_img, img_dimen),0) for flat_img in flat_img_arrays]
+    # or one with 'tearing' patterns, see pixis_raw.py --doRedecode. 
+    with span("raw.decode", cat="conversion", n_imgs=n_imgs):
+        img_arrays = decode_readouts(raw_data, geometry, n_readouts = n_imgs)
+        img_arrays = [choose_byte_order(img_array, big_endian) for img_array in img_arrays]
 
-    new_header = fits.Header() 
-    new_header['SIMPLE'] = ('T', 'Created by convertRawToFits.py')
-    new_header['BITPIX'] = (n_unsigned_bytes * 8, 'number of bits per data pixel')
-    new_header['NAXIS'] = (2, 'number of data axes') 
-    new_header['NAXIS1'] = (1024, 'length of data axis 1') 
-    new_header['NAXIS2'] = (1024, 'length of data axis 2')
-    new_header['BZERO'] = (32768, 'data range offset')
-    new_header['BSCALE'] = (1, 'default scaling factor')
+    new_header = base_header(geometry.roi_shape(), geometry.n_unsigned_bytes)
+    for header_elem in geometry.header_elems(): 
+        new_header[header_elem[0]] = (header_elem[1], header_elem[2])  
     print ('header_elems_to_add = ' + str(header_elems_to_add))  
     for header_elem in header_elems_to_add: 
         header_key_str = header_elem[0]  
         new_header[header_key_str] = (header_elem[1], header_elem[2])  
 
     if n_imgs > 1:  
-        [saveDataToFitsFile(img_arrays[i], target_file + '_' + str(i) + '.fits', target_dir, header = new_header)  
-         for i in range(len(img_arrays)) ]
+        #Several readouts are written in parallel, each renamed into place once complete 
+        with FitsWriter(durability = 'run') as writer: 
+            for i in range(len(img_arrays)): 
+                img_array, byte_order_elem = img_arrays[i] 
+                new_header[byte_order_elem[0]] = (byte_order_elem[1], byte_order_elem[2]) 
+                writer.submit(img_array, new_header, target_dir + target_file_wo_suffix + '_' + str(i) + target_suffix, extensions)  
     else: 
-        saveDataToFitsFile(img_arrays[0], target_file_wo_suffix + target_suffix, target_dir, header = new_header)
+        img_array, byte_order_elem = img_arrays[0] 
+        new_header[byte_order_elem[0]] = (byte_order_elem[1], byte_order_elem[2]) 
+        saveDataToFitsFile(img_array, target_file_wo_suffix + target_suffix, target_dir, header = new_header, extensions = extensions)
 
     return 1 
 
@@ -114,16 +115,16 @@ def BuildInitialHeader(exposure_parameter_file, target_name, exp_time, shutter_k
                                                           'Position of collimating lens (mm)'],
                                                          ['LOCSTART', 
                                                           l_start_time,  
-                                                          'Start of exposure, in local (computer) time' ], 
+                                                          'Start of exposure, local (computer) time' ], 
                                                          ['LOCEND',
                                                            l_end_time, 
-                                                          'End of exposure, in local (computer) time']
+                                                          'End of exposure, local (computer) time']
                                                         ]
     stored_param_key_strs = ['TEMP','STARTEXP','ENDEXP']
-    stored_param_comments = ['temperature of PIXIS CCD', 'start of acquisition (GMT)', 'end of acquisition (GMT)']
-    stored_param_conversion_functs = [lambda val: int(val.strip()), 
-                                      lambda val: datetime.utcfromtimestamp(float(val.strip())).strftime('%Y-%m-%dT%H:%M:%SZ'), 
-                                      lambda val: datetime.utcfromtimestamp(float(val.strip())).strftime('%Y-%m-%dT%H:%M:%SZ') ]
+    stored_param_comments = ['[C] temperature of PIXIS CCD', 'shutter open (GMT)', 'shutter close (GMT)']
+    stored_param_conversion_functs = [lambda val: float(val.strip()), 
+                                      lambda val: datetime.utcfromtimestamp(float(val.strip())).strftime('%Y-%m-%dT%H:%M:%S.%fZ'), 
+                                      lambda val: datetime.utcfromtimestamp(float(val.strip())).strftime('%Y-%m-%dT%H:%M:%S.%fZ') ]
     lines = readLinesFromFile(source_dir + exposure_parameter_file) 
     for i in range(len(lines)): 
         line = lines[i] 
@@ -135,12 +136,29 @@ def BuildInitialHeader(exposure_parameter_file, target_name, exp_time, shutter_k
 
 if __name__ == "__main__":
     #print ('sys.argv[1:] = ' + str(sys.argv[1:])) 
-    source_file, target_file, exposure_parameter_file, source_dir, target_dir, target_name, exp_time, shutter_key, gain_key, exp_speed_key, focus_pos, local_start_time, local_end_time = sys.argv[1:]
+    configure_from_environment(process_name="ConvertPIXISRawToFits")
+    #Optional flags may follow the positional arguments: --grating=<n> records GRATING, and --doWavelengthCalibration 
+    # adds the cached wavelength solution for GRATING, FOCUSPOS and TEMP as WCS keywords 
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    source_file, target_file, exposure_parameter_file, source_dir, target_dir, target_name, exp_time, shutter_key, gain_key, exp_speed_key, focus_pos, local_start_time, local_end_time = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
     additional_header_elems = BuildInitialHeader(exposure_parameter_file, target_name, exp_time, shutter_key, gain_key, exp_speed_key, focus_pos, local_start_time, local_end_time)
+    for flag in flags: 
+        if flag.startswith('--grating='): 
+            additional_header_elems = additional_header_elems + [['GRATING', int(flag.split('=')[1]), 'grating in use']]
     
     target_suffix = '.fits'  
+    geometry = FrameGeometry.from_file_or_default(source_dir + exposure_parameter_file.replace('.txt', '_geometry.txt'))
+    if '--doWavelengthCalibration' in flags: 
+        additional_header_elems = additional_header_elems + calibration_header_elems(additional_header_elems, geometry)
+    #The temperature samples configure_sasha took during the exposure go in a TEMPTRACE extension 
+    exposure_start, exposure_end = exposure_window(source_dir + exposure_parameter_file)
+    trace_header_elems, trace_extensions = exposure_trace(source_dir + exposure_parameter_file.replace('.txt', '_temperature.txt'), exposure_start, exposure_end)
+    #The shutter, readout and save times configure_sasha recorded, to the microsecond 
+    timing = read_timing(timing_file_name(source_dir + exposure_parameter_file.replace('.txt', '')))
     #temperature_string = readLinesFromFile(source_dir + temperature_file)[0] 
-    convertRawToFits(source_file, target_file, source_dir = source_dir, target_dir = target_dir, target_suffix = target_suffix, header_elems_to_add = additional_header_elems); 
+    with span("convert", cat="conversion", file=source_file):
+        convertRawToFits(source_file, target_file, source_dir = source_dir, target_dir = target_dir, target_suffix = target_suffix, header_elems_to_add = additional_header_elems + trace_header_elems + timing_header_elems(timing), geometry = geometry, extensions = trace_extensions); 
+    log_frame(target_dir + target_file + target_suffix, timing, time.time())
     print ('Done converting file: ' + str(source_dir + source_file) + ' to file: ' + str(target_dir + target_file + target_suffix) )
      
 
@@ -27,6 +27,8 @@ from enum import IntEnum
 
 import numpy as np
 
+from instrumentation import span
+
 """
 Load the .dll/.so for ATIK
 - This probably could be more robust. But, this will work most likely.
@@ -180,7 +182,8 @@ class AtikFilterWheel:
 			if attempts > 10:
 				raise Exception(f"Could not detect Atik Camera at index {camera_index}")
 		
-		self._handle = ArtemisEFWConnect(filter_wheel_index)
+		with span("dll.ArtemisEFWConnect", cat="dll", index=filter_wheel_index):
+			self._handle = ArtemisEFWConnect(filter_wheel_index)
 		
 		if not self._handle:
 			raise Exception(f"Could not conenct to the Atik Filter Wheel at {filter_wheel_index}")
@@ -255,13 +258,15 @@ class AtikFilterWheel:
 			raise IndexError(f"Invalid focus wheel position selected. Valid range: [0, {number_of_filters})")
 		desired_position = c_int(position)
 		
-		status = ArtemisEFWSetPosition(self._handle, desired_position)
-		validate_status_code(status)
-		
-		# busy wait until the move has completed
-		if delay and delay > 0.0:
-			while self.is_moving():
-				time.sleep(delay)
+		with span("atik.set_position", cat="device", position=position):
+			with span("dll.ArtemisEFWSetPosition", cat="dll"):
+				status = ArtemisEFWSetPosition(self._handle, desired_position)
+			validate_status_code(status)
+			
+			# busy wait until the move has completed
+			if delay and delay > 0.0:
+				while self.is_moving():
+					time.sleep(delay)
 	
 	@_check_connected
 	def get_details(self):
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""
+.. module:: auto_exposure
+    :platform: unix
+    :synopsis: Exposure times chosen from the signal of the frames already taken.
+
+With --doAutoExposure, mlof_take_image measures every frame it converts: a
+high percentile of the frame (the signal) above a low percentile (the bias
+and background), from every 4th pixel along both axes. Divided by the
+exposure time and multiplied by GAIN this is a count rate in e-/s, which
+does not depend on the gain setting. The rates measured at each MONOWAVE are
+interpolated in wavelength to predict the exposure time that brings the next
+frame to the target level, so a monochromator sweep follows the throughput
+of the system instead of taking saturated or faint frames. A frame that
+comes out saturated or too faint anyway is retaken straight away with a
+corrected exposure time.
+
+Every measurement is appended to a log (auto_exposure.jsonl next to the
+images by default):
+
+    {"file", "wavelength", "gain", "exposure_ms", "level", "background", "signal",
+     "rate", "saturated", "accepted", "next_exposure_ms", "time"}
+
+which is also where the next call of mlof_take_image picks the rates up.
+
+Typical usage:
+
+    python auto_exposure.py --doSummary /data/2023_05_01/auto_exposure.jsonl
+"""
+
+import os
+import json
+import time
+import optparse
+
+import numpy as np
+
+from instrumentation import configure_from_environment, metrics
+
+#ADU at which the PIXIS frame is treated as saturated
+SATURATION_LEVEL = 65000
+#e-/ADU for each gain key, as recorded in GAIN
+GAINS = {0: 4, 1: 2, 2: 1}
+
+
+def fast_percentiles(img, percentiles, step=4):
+    """
+    Percentiles of a subsample of the frame, by partial sorting.
+
+    :param step: use every step-th pixel along both axes
+    :return: list of values, one per percentile
+    """
+    sample = np.asarray(img)[::step, ::step].ravel()
+    indices = [int(round(p / 100.0 * (sample.size - 1))) for p in percentiles]
+    partitioned = np.partition(sample, indices)
+    return [float(partitioned[i]) for i in indices]
+
+
+def read_log(log_file):
+    """
+
+    :return: the entries of an exposure log, oldest first
+    """
+    entries = []
+    if log_file is None or not os.path.isfile(log_file):
+        return entries
+    with open(log_file) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return entries
+
+
+class ExposureController:
+    """
+    Conversion stage that measures each frame and predicts the next exposure time.
+
+    Called as stage(img, header, target_file); the measurement is kept in last.
+    """
+    def __init__(self, log_file=None, target_level=30000.0, percentile=99.5, background_percentile=5.0,
+                 min_fraction=0.25, min_exposure=1, max_exposure=600000, max_step=10.0,
+                 saturation=SATURATION_LEVEL):
+        """
+
+        :param log_file: exposure log to read earlier rates from and append to
+        :param target_level: [ADU] signal above background wanted at percentile
+        :param percentile: percentile of the frame taken as its signal
+        :param background_percentile: percentile of the frame taken as bias and background
+        :param min_fraction: frames with less than this fraction of target_level are retaken
+        :param min_exposure: [ms] shortest exposure time chosen
+        :param max_exposure: [ms] longest exposure time chosen
+        :param max_step: largest factor the exposure time changes by from one frame to the next
+        """
+        self.log_file = log_file
+        self.target_level = target_level
+        self.percentile = percentile
+        self.background_percentile = background_percentile
+        self.min_fraction = min_fraction
+        self.min_exposure = min_exposure
+        self.max_exposure = max_exposure
+        self.max_step = max_step
+        self.saturation = saturation
+        self.history = [entry for entry in read_log(log_file) if entry.get('accepted')]
+        self.last = None
+
+    def clamp(self, exposure_ms, previous_ms=None):
+        if previous_ms is not None and previous_ms > 0:
+            exposure_ms = min(max(exposure_ms, previous_ms / self.max_step), previous_ms * self.max_step)
+        return int(round(min(max(exposure_ms, self.min_exposure), self.max_exposure)))
+
+    def rate_at(self, wavelength=None):
+        """
+
+        :return: [e-/s] count rate at a wavelength, interpolated between the rates measured so far
+                 (the latest rate without a wavelength), or None before the first measurement
+        """
+        if not self.history:
+            return None
+        if wavelength is not None:
+            # the latest measurement at each wavelength
+            rates = {}
+            for entry in self.history:
+                if entry.get('wavelength') is not None:
+                    rates[entry['wavelength']] = entry['rate']
+            if rates:
+                wavelengths = sorted(rates)
+                log_rates = np.log([rates[w] for w in wavelengths])
+                if len(wavelengths) > 1 and not wavelengths[0] <= wavelength <= wavelengths[-1]:
+                    # beyond the sweep so far, follow the trend of the two nearest wavelengths
+                    ends = [0, 1] if wavelength < wavelengths[0] else [-2, -1]
+                    (w1, w2), (r1, r2) = [wavelengths[i] for i in ends], [log_rates[i] for i in ends]
+                    log_rate = r2 + (r2 - r1) / (w2 - w1) * (wavelength - w2)
+                    # by no more than max_step beyond the nearest measurement
+                    nearest = r1 if wavelength < wavelengths[0] else r2
+                    log_rate = np.clip(log_rate, nearest - np.log(self.max_step), nearest + np.log(self.max_step))
+                    return float(np.exp(log_rate))
+                return float(np.exp(np.interp(wavelength, wavelengths, log_rates)))
+        return self.history[-1]['rate']
+
+    def predict(self, wavelength=None, gain_key=0, default_ms=0):
+        """
+
+        :return: [ms] exposure time expected to reach target_level, or default_ms with nothing measured yet
+        """
+        rate = self.rate_at(wavelength)
+        if rate is None or rate <= 0:
+            return default_ms
+        return self.clamp(1000.0 * self.target_level * GAINS[gain_key] / rate)
+
+    def measure(self, img, exposure_ms, gain, wavelength=None, file_name=None):
+        """
+        Measures a frame, decides whether it is usable and predicts the next exposure time.
+
+        :param gain: [e-/ADU]
+        :return: the log entry of the frame
+        """
+        background, level = fast_percentiles(img, [self.background_percentile, self.percentile])
+        signal = level - background
+        saturated = level >= self.saturation
+        rate = None
+        if saturated:
+            # the signal is at least what reached saturation, so this is the longest the next exposure should be
+            next_ms = 0.5 * exposure_ms * self.target_level / max(self.saturation - background, 1.0)
+        elif signal > 0 and exposure_ms > 0:
+            rate = signal * gain / (exposure_ms / 1000.0)
+            next_ms = exposure_ms * self.target_level / signal
+        else:
+            next_ms = exposure_ms * self.max_step
+        accepted = not saturated and signal >= self.min_fraction * self.target_level
+        entry = {'file': file_name,
+                 'wavelength': wavelength,
+                 'gain': gain,
+                 'exposure_ms': exposure_ms,
+                 'level': level,
+                 'background': background,
+                 'signal': signal,
+                 'rate': rate,
+                 'saturated': bool(saturated),
+                 'accepted': bool(accepted),
+                 'next_exposure_ms': self.clamp(next_ms, exposure_ms),
+                 'time': time.time()}
+        if accepted and rate is not None:
+            self.history.append(entry)
+        metrics.incr("auto_exposure.accepted" if accepted else "auto_exposure.rejected")
+        if self.log_file is not None:
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        return entry
+
+    def __call__(self, img, header, target_file):
+        wavelength = header.get('MONOWAVE')
+        self.last = self.measure(img, int(round(1000.0 * header['EXPTIME'])), float(header['GAIN']),
+                                 None if wavelength is None else float(wavelength), target_file)
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] exposure_log")
+
+    parser.add_option("--doSummary", action="store_true", default=False)
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+    configure_from_environment(process_name="auto_exposure")
+
+    if opts.doSummary:
+        for log_file in args:
+            entries = read_log(log_file)
+            print('%s: %d frame(s), %d retaken (%d saturated)' %
+                  (log_file, len(entries), sum(not e['accepted'] for e in entries),
+                   sum(e['saturated'] for e in entries)))
+            for entry in entries:
+                print('  %-40s %8s nm %8d ms  signal %8.0f ADU%s' %
+                      (os.path.basename(entry['file'] or ''),
+                       '-' if entry['wavelength'] is None else '%.1f' % entry['wavelength'],
+                       entry['exposure_ms'], entry['signal'],
+                       '' if entry['accepted'] else (' saturated' if entry['saturated'] else ' too faint')))
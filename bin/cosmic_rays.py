@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+"""
+.. module:: cosmic_rays
+    :platform: unix
+    :synopsis: Cosmic-ray rejection across repeated exposures, with a Laplacian fallback for single frames.
+
+doPixisImaging.bash takes n_exps identical exposures of a target. The frames
+are stacked into a memory-mapped (frames, rows, columns) cube on disk and
+compared against their per-pixel median in bands of chunk_rows rows, so only
+one band of the stack is ever in memory. A pixel is flagged when it sits more
+than nsigma above the (flux-scaled) stack median, where sigma is the larger
+of the robust scatter across the stack and the read + shot noise of the
+median. Flagged pixels, grown by one pixel, are replaced by the scaled median.
+
+With fewer than three frames there is no usable median, so each frame is
+cleaned on its own by a single-pass Laplacian edge detection (after van
+Dokkum 2001, L.A.Cosmic).
+
+Every input frame.fits gets a frame_clean.fits next to it (or in --output_dir)
+whose primary HDU is the cleaned image and whose CRMASK extension marks the
+replaced pixels.
+
+Typical usage:
+
+    python cosmic_rays.py --doReject /data/2023_05_01/Arc_2023_05_01_1*.fits
+"""
+
+import os
+import glob
+import tempfile
+import optparse
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from astropy.io import fits
+
+from instrumentation import configure_from_environment, span, metrics
+from fits_writer import write_fits_atomic
+
+#The median of fewer frames than this does not reject anything
+MIN_STACK = 3
+
+
+def clean_file_name(file_name, output_dir=None):
+    """
+
+    :return: file_name with _clean before the .fits suffix, optionally moved to output_dir
+    """
+    clean_name = file_name.replace('.fits', '') + '_clean.fits'
+    if output_dir is not None:
+        clean_name = os.path.join(output_dir, os.path.basename(clean_name))
+    return clean_name
+
+
+def noise_parameters(header):
+    """
+
+    :return: (gain in e-/ADU, read noise in ADU) from the GAIN and RDNOISE keywords
+    """
+    gain = float(header.get('GAIN', 1.0))
+    readnoise = float(header.get('RDNOISE', 0.0)) / gain
+    return gain, readnoise
+
+
+def build_cube(file_names, cube_file):
+    """
+    Copies frames one at a time into a memory-mapped (frames, rows, columns) uint16 cube.
+
+    :return: (cube, list of headers)
+    """
+    headers = []
+    cube = None
+    for i, file_name in enumerate(file_names):
+        with fits.open(file_name) as hdul:
+            data = hdul[0].data
+            if cube is None:
+                cube = np.memmap(cube_file, dtype=np.uint16, mode='w+', shape=(len(file_names),) + data.shape)
+            elif data.shape != cube.shape[1:]:
+                raise ValueError('%s has shape %s, not %s' % (file_name, data.shape, cube.shape[1:]))
+            cube[i] = data
+            headers.append(hdul[0].header.copy())
+    return cube, headers
+
+
+def frame_scales(cube, step=8):
+    """
+    Relative flux of each frame (lamp drift), from the median of a subsampled grid.
+
+    :return: (n,) float32 array with median 1
+    """
+    levels = np.median(np.asarray(cube[:, ::step, ::step], dtype=np.float32).reshape(len(cube), -1), axis=1)
+    reference = np.median(levels)
+    if reference <= 0:
+        return np.ones(len(cube), dtype=np.float32)
+    return (levels / reference).astype(np.float32)
+
+
+def grow(mask):
+    """
+    Dilates a (..., rows, columns) boolean mask by one pixel along rows and columns.
+    """
+    grown = mask.copy()
+    grown[..., 1:, :] |= mask[..., :-1, :]
+    grown[..., :-1, :] |= mask[..., 1:, :]
+    grown[..., :, 1:] |= mask[..., :, :-1]
+    grown[..., :, :-1] |= mask[..., :, 1:]
+    return grown
+
+
+def reject_stack(cube, clean, masks, nsigma=5.0, gain=1.0, readnoise=0.0, chunk_rows=64, grow_mask=True):
+    """
+    Sigma-clips every frame of a stack against the per-pixel median, one band of rows at a time.
+
+    Each band is read with one row of halo either side so that growing the
+    mask is seamless across band edges.
+
+    :param cube: (n, rows, columns) frames, typically a np.memmap
+    :param clean: output array of the same shape, receives the cleaned frames
+    :param masks: output uint8 array of the same shape, 1 where a pixel was replaced
+    :param gain: e-/ADU, for the shot noise of the median
+    :param readnoise: read noise in ADU
+    :return: number of pixels flagged in each frame
+    """
+    n, n_rows, n_cols = cube.shape
+    scales = frame_scales(cube)[:, None, None]
+    n_flagged = np.zeros(n, dtype=np.int64)
+    for r0 in range(0, n_rows, chunk_rows):
+        r1 = min(r0 + chunk_rows, n_rows)
+        h0, h1 = max(r0 - 1, 0), min(r1 + 1, n_rows)
+        with span("cr.chunk", cat="analysis", rows=r1 - r0):
+            band = np.asarray(cube[:, h0:h1], dtype=np.float32) / scales
+            median = np.median(band, axis=0)
+            residual = band - median
+            robust_sigma = 1.4826 * np.median(np.abs(residual), axis=0)
+            model_sigma = np.sqrt(readnoise ** 2 + np.maximum(median, 0) / gain)
+            flagged = residual > nsigma * np.maximum(robust_sigma, model_sigma)
+            if grow_mask:
+                flagged = grow(flagged)
+            flagged = flagged[:, r0 - h0:r0 - h0 + (r1 - r0)]
+            band = band[:, r0 - h0:r0 - h0 + (r1 - r0)]
+            replacement = np.broadcast_to(median[r0 - h0:r0 - h0 + (r1 - r0)], band.shape)
+            cleaned = np.where(flagged, replacement, band) * scales
+            clean[:, r0:r1] = np.clip(np.rint(cleaned), 0, np.iinfo(np.uint16).max)
+            masks[:, r0:r1] = flagged
+            n_flagged += flagged.reshape(n, -1).sum(axis=1)
+    return n_flagged
+
+
+def median_filter(img, size, chunk_rows=128):
+    """
+    size x size median filter (edges reflected), computed in bands of rows to bound memory.
+    """
+    pad = size // 2
+    padded = np.pad(img, pad, mode='reflect')
+    out = np.empty(img.shape, dtype=np.float32)
+    for r0 in range(0, img.shape[0], chunk_rows):
+        r1 = min(r0 + chunk_rows, img.shape[0])
+        windows = sliding_window_view(padded[r0:r1 + 2 * pad], (size, size))
+        out[r0:r1] = np.median(windows.reshape(r1 - r0, img.shape[1], -1), axis=2)
+    return out
+
+
+def local_median(img, rows, cols, size):
+    """
+    size x size median of img (edges reflected) at the given pixels only.
+    """
+    pad = size // 2
+    padded = np.pad(img, pad, mode='reflect')
+    offsets = np.arange(size)
+    windows = padded[rows[:, None, None] + offsets[None, :, None], cols[:, None, None] + offsets[None, None, :]]
+    return np.median(windows.reshape(len(rows), -1), axis=1)
+
+
+def reject_laplacian(img, nsigma=5.0, objlim=5.0, gain=1.0, readnoise=0.0, grow_mask=True):
+    """
+    Single-pass Laplacian cosmic-ray detection on one frame.
+
+    The frame is 2x2 subsampled, convolved with a Laplacian and block
+    averaged back, which keeps the sharp edges of cosmic rays and suppresses
+    the smooth ones of the PSF. Candidates must be nsigma above the noise and
+    objlim times sharper than the local fine structure. Only the 3x3 median
+    is computed over the whole frame; the wider medians are evaluated at the
+    candidates alone.
+
+    :return: (cleaned float32 image, boolean mask)
+    """
+    img = np.asarray(img, dtype=np.float32)
+    bias = np.percentile(img[::4, ::4], 1)
+    median3 = median_filter(img, 3)
+    noise = np.sqrt(readnoise ** 2 + np.maximum(median3 - bias, 0) / gain)
+    noise = np.maximum(noise, 1e-3)
+    # the bias level is only a guess, so calibrate the model against the robust
+    # scatter of adjacent-pixel differences, which the sharp cosmic rays barely move
+    differences = (img[::2, 1::2] - img[::2, :-1:2]) / (np.sqrt(2) * noise[::2, 1::2])
+    noise *= max(1.4826 * np.median(np.abs(differences)), 1e-3)
+
+    # Laplacian of the 2x2 subsampled image, block averaged back to the original pixels
+    sub = np.repeat(np.repeat(img, 2, axis=0), 2, axis=1)
+    padded = np.pad(sub, 1, mode='edge')
+    laplacian = 4 * sub - padded[:-2, 1:-1] - padded[2:, 1:-1] - padded[1:-1, :-2] - padded[1:-1, 2:]
+    np.maximum(laplacian, 0, out=laplacian)
+    laplacian = laplacian.reshape(img.shape[0], 2, img.shape[1], 2).mean(axis=(1, 3))
+    significance = laplacian / (2 * noise)
+
+    mask = np.zeros(img.shape, dtype=bool)
+    rows, cols = np.nonzero(significance > nsigma)
+    if len(rows):
+        # remove the large-scale structure of the significance map, then compare with the fine structure
+        candidate_significance = significance[rows, cols] - local_median(significance, rows, cols, 5)
+        fine_structure = (median3[rows, cols] - local_median(median3, rows, cols, 7)) / noise[rows, cols]
+        fine_structure = np.maximum(fine_structure, 0.01)
+        keep = (candidate_significance > nsigma) & (significance[rows, cols] / fine_structure > objlim)
+        mask[rows[keep], cols[keep]] = True
+    if grow_mask:
+        mask = grow(mask)
+    clean = img.copy()
+    rows, cols = np.nonzero(mask)
+    if len(rows):
+        clean[rows, cols] = local_median(img, rows, cols, 5)
+    return clean, mask
+
+
+def write_clean(file_name, clean, mask, header, method):
+    """
+    Writes a cleaned frame with its CRMASK extension.
+    """
+    header = header.copy()
+    header['CRMETH'] = (method, 'cosmic-ray rejection method')
+    header['CRNPIX'] = (int(mask.sum()), 'pixels replaced by cosmic-ray rejection')
+    write_fits_atomic(np.asarray(clean, dtype=np.uint16), header, file_name,
+                      extensions=[fits.ImageHDU(np.asarray(mask, dtype=np.uint8), name='CRMASK')])
+
+
+def reject_files(file_names, output_dir=None, nsigma=5.0, chunk_rows=64, scratch_dir=None):
+    """
+    Cleans a set of repeated exposures: stack rejection if there are at least
+    MIN_STACK of them, otherwise the Laplacian on each.
+
+    :param scratch_dir: where the memory-mapped cubes live while they are used (default: the system temp dir)
+    :return: list of the cleaned file names
+    """
+    clean_names = [clean_file_name(f, output_dir) for f in file_names]
+    if len(file_names) < MIN_STACK:
+        for file_name, clean_name in zip(file_names, clean_names):
+            with span("cr.laplacian", cat="analysis", file=file_name):
+                with fits.open(file_name) as hdul:
+                    header = hdul[0].header.copy()
+                    img = hdul[0].data
+                gain, readnoise = noise_parameters(header)
+                clean, mask = reject_laplacian(img, nsigma=nsigma, gain=gain, readnoise=readnoise)
+                write_clean(clean_name, np.clip(np.rint(clean), 0, np.iinfo(np.uint16).max), mask, header, 'laplacian')
+            metrics.observe("cr.pixels", int(mask.sum()))
+        return clean_names
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir, prefix='mlof_cr_') as tmp_dir:
+        with span("cr.stack", cat="analysis", n_frames=len(file_names)):
+            cube, headers = build_cube(file_names, os.path.join(tmp_dir, 'cube.u16'))
+        clean = np.memmap(os.path.join(tmp_dir, 'clean.u16'), dtype=np.uint16, mode='w+', shape=cube.shape)
+        masks = np.memmap(os.path.join(tmp_dir, 'mask.u8'), dtype=np.uint8, mode='w+', shape=cube.shape)
+        gain, readnoise = noise_parameters(headers[0])
+        with span("cr.reject", cat="analysis", n_frames=len(file_names)):
+            n_flagged = reject_stack(cube, clean, masks, nsigma=nsigma, gain=gain, readnoise=readnoise,
+                                     chunk_rows=chunk_rows)
+        with span("cr.write", cat="analysis", n_frames=len(file_names)):
+            for i, clean_name in enumerate(clean_names):
+                write_clean(clean_name, clean[i], masks[i], headers[i], 'stack')
+                metrics.observe("cr.pixels", int(n_flagged[i]))
+        del cube, clean, masks
+    return clean_names
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] fits_files")
+
+    parser.add_option("-o","--output_dir", default=None, help="write the cleaned frames here instead of next to the inputs")
+    parser.add_option("--nsigma", type=float, default=5.0)
+    parser.add_option("--chunk_rows", type=int, default=64, help="rows of the stack compared at a time")
+    parser.add_option("--scratch_dir", default=None, help="directory for the memory-mapped stack (default: system temp dir)")
+    parser.add_option("--doReject", action="store_true", default=False)
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+    configure_from_environment(process_name="cosmic_rays")
+
+    if opts.doReject:
+        fits_files = sorted(f for pattern in args for f in glob.glob(pattern) if not f.endswith('_clean.fits'))
+        if opts.output_dir is not None and not os.path.isdir(opts.output_dir):
+            os.makedirs(opts.output_dir)
+        clean_names = reject_files(fits_files, output_dir=opts.output_dir, nsigma=opts.nsigma,
+                                   chunk_rows=opts.chunk_rows, scratch_dir=opts.scratch_dir)
+        print('Wrote %d cleaned frame(s)' % len(clean_names))
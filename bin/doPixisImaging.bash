@@ -13,7 +13,14 @@
 # -u -> universal prefix with which these images will be saved; generally should be observation date 
 # -l -> should computer wait to acquire until temperature is locked (1 for yes, 0 for no).  Usually 0. 
 # -d -> full path to directory where observations should be saved 
-while getopts ":e:o:t:n:s:g:r:p:f:u:l:d:" opt; do
+# -R -> read out only a region of interest, as x,width,x_binning,y,height,y_binning in unbinned pixels (optional; default full sensor) 
+# -C -> reject cosmic rays across the n exposures once they are all taken, writing *_clean.fits next to them (1 for yes, 0 for no; optional, default 0) 
+# -Q -> write zscaled PNG thumbnails of the n exposures and an index.html contact sheet into <save dir>/previews (1 for yes, 0 for no; optional, default 0) 
+# -L -> serve a live view of each exposure, as it is saved, at http://localhost:<port>/ while the sequence runs (optional) 
+# -G -> grating in use, recorded as GRATING (optional) 
+# -W -> add the cached wavelength solution for the grating, focus position and CCD temperature as WCS keywords (1 for yes, 0 for no; optional, default 0; needs -G) 
+# -T -> Chrome trace file that the acquisition and conversion steps append timing spans to (optional) 
+while getopts ":e:o:t:n:s:g:r:p:f:u:l:d:R:C:Q:L:G:W:T:" opt; do
     case $opt in
         e)
              #echo "Setting exposure time to: $OPTARG" >&2
@@ -69,6 +76,37 @@ while getopts ":e:o:t:n:s:g:r:p:f:u:l:d:" opt; do
              date_str=$OPTARG
              echo "Setting reference date to $date_str" 
              ;;
+        R)
+             echo "Setting region of interest to: $OPTARG" >&2
+             roi_arg="roi=$OPTARG"
+             ;;
+        C)
+             echo "Setting cosmic-ray rejection key to: $OPTARG" >&2
+             reject_cr=$OPTARG
+             ;;
+        Q)
+             echo "Setting quick-look preview key to: $OPTARG" >&2
+             do_preview=$OPTARG
+             ;;
+        L)
+             echo "Serving the live view on port: $OPTARG" >&2
+             live_view_port=$OPTARG
+             ;;
+        G)
+             echo "Setting grating to: $OPTARG" >&2
+             convert_args="$convert_args --grating=$OPTARG"
+             ;;
+        W)
+             echo "Setting wavelength calibration key to: $OPTARG" >&2
+             if [ "$OPTARG" -eq 1 ]; then
+                 convert_args="$convert_args --doWavelengthCalibration"
+             fi
+             ;;
+        T)
+             echo "Tracing acquisition and conversion to: $OPTARG"
+             export MLOF_TRACE=$OPTARG
+             export MLOF_METRICS="${OPTARG%.*}_metrics.jsonl"
+             ;;
         \?)
              echo "Invalid option: -$OPTARG" >&2
              exit 1
@@ -112,6 +150,12 @@ fi
 if [ -z $do_lock ]; then
     do_lock=0
 fi
+if [ -z $reject_cr ]; then
+    reject_cr=0
+fi
+if [ -z $do_preview ]; then
+    do_preview=0
+fi
 if [ -z $focus_pos ]; then
     focus_pos=18.7 #0 is minimium (home); ~25 is maximum of stage given current configuration.  This should be checked whenever spectrograph is redeployed; 28 is maximum of stage itself; 
 fi  
@@ -167,9 +211,14 @@ fi
 typeset -i tally=$(cat $full_save_dir$image_number_tracker_file)
 
 remove_raw=1
+if [ -n "$live_view_port" ]; then
+    python $python_dir/live_view.py --doServe -d $full_save_dir --port $live_view_port &
+    live_view_pid=$!
+fi
 #for ((i=1;i<=n_exps;i++))
 currenttime=$(date +%Y:%m:%d:%H:%M)
 sequence_number=1
+sequence_files=()
 while [[ "$currenttime" < "$stoptime" ]] && [ "$sequence_number" -le "$n_exps" ]
 do
     #currenttime=$(date +%Y:%m:%d:%H:%M)
@@ -196,22 +245,24 @@ do
     #raw_file="Bias_2021_12_11_1.raw"
     #image_file_name="$full_file_prefix"
 
-    local_start_time=$(date +%Y:%m:%d:%H:%M)
+    local_start_time=$(date +%Y:%m:%d:%H:%M:%S.%3N)
     echo "Acquiring the data using PIXIS commands..."
     if [ "$do_lock" -eq 1 ]; then
-        $script_dir/configure_sasha $exp_time 1 $shutter $gain_key $fast $full_image_file_prefix $full_parameter_file_prefix lock
+        $script_dir/configure_sasha $exp_time 1 $shutter $gain_key $fast $full_image_file_prefix $full_parameter_file_prefix lock $roi_arg
     else
-        $script_dir/configure_sasha $exp_time 1 $shutter $gain_key $fast $full_image_file_prefix $full_parameter_file_prefix
+        $script_dir/configure_sasha $exp_time 1 $shutter $gain_key $fast $full_image_file_prefix $full_parameter_file_prefix $roi_arg
     fi
     echo "Raw data acquired.  Now converting to .fits image(s)... "
 
     echo "Raw data file: $raw_file"
 
-    local_end_time=$(date +%Y:%m:%d:%H:%M)
-    python $python_dir/ConvertPIXISRawToFits.py $raw_file $full_image_file_prefix $full_parameter_file_name  "" $full_save_dir "$target_name" $exp_time $shutter $gain_key $fast $focus_pos $local_start_time $local_end_time 
+    local_end_time=$(date +%Y:%m:%d:%H:%M:%S.%3N)
+    python $python_dir/ConvertPIXISRawToFits.py $raw_file $full_image_file_prefix $full_parameter_file_name  "" $full_save_dir "$target_name" $exp_time $shutter $gain_key $fast $focus_pos $local_start_time $local_end_time $convert_args
     echo "$raw_file $full_image_file_prefix $full_parameter_file_name  "" $full_save_dir "$target_name" $exp_time $shutter $gain_key $fast $focus_pos $local_start_time $local_end_time"
     echo "Just saved new fits image to $full_save_dir$full_image_file_prefix.fits "
+    sequence_files+=("$full_save_dir$full_image_file_prefix.fits")
     rm $full_parameter_file_name 
+    rm -f "$full_parameter_file_prefix"_geometry.txt "$full_parameter_file_prefix"_temperature.txt "$full_parameter_file_prefix"_timing.txt
     #optionally, remove the raw data file names
     if [ "$remove_raw" -eq 1 ]; then
         rm $raw_file 
@@ -221,6 +272,20 @@ do
     currenttime=$(date +%Y:%m:%d:%H:%M) 
 done
 echo We have either passed the stop time or exceeded the specified number of images to take. Stopping sequence. 
+if [ -n "$live_view_pid" ]; then
+    kill $live_view_pid
+fi
+if [ "$reject_cr" -eq 1 ] && [ "${#sequence_files[@]}" -gt 0 ]; then
+    echo "Rejecting cosmic rays across ${#sequence_files[@]} exposure(s)..."
+    python $python_dir/cosmic_rays.py --doReject "${sequence_files[@]}"
+fi
+if [ "$do_preview" -eq 1 ] && [ "${#sequence_files[@]}" -gt 0 ]; then
+    echo "Writing quick-look previews to $full_save_dir"previews/
+    python $python_dir/quicklook.py --doPreview -o "$full_save_dir"previews -t "$target_name" "${sequence_files[@]}"
+fi
+if [ -n "$MLOF_TRACE" ]; then
+    python $python_dir/instrumentation.py --doSummary $MLOF_TRACE
+fi
 
 echo "Done."
 
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+"""
+.. module:: exposure_timing
+    :platform: unix
+    :synopsis: Per-frame exposure timestamps from configure_sasha, and the dead time between frames.
+
+configure_sasha writes <parameter prefix>_timing.txt while it acquires, one
+line per event:
+
+    readout  event  monotonic_seconds  unix_seconds
+
+with the events
+
+    issue    Picam_StartAcquisition called (readout 0)
+    open     shutter opened
+    close    shutter closed
+    readout  readout handed over by picam
+    saved    raw frame written to disk
+
+picam only reports when a readout arrives, so close is the arrival minus
+the camera's ReadoutTimeCalculation and open is close minus the exposure
+time. Both clocks are read at the same instant, to the microsecond; the
+monotonic one is CLOCK_MONOTONIC, which time.monotonic() reads on Linux.
+
+The converters put the events in the FITS header (CMDTIME, SHUTOPEN,
+SHUTCLOS, READDONE and RAWSAVED, in UTC, with DEADTIME and RDTIME) and, once
+the FITS file is written, append a line to timing.jsonl in its directory:
+
+    {"file", "readout", "events", "mono", "written", "dead_time", "readout_time",
+     "save_time", "write_time"}
+
+with every time in unix seconds and every interval in seconds.
+--doSummary prints the intervals of each frame, with the gap since the
+previous frame of the log closed its shutter, and, given the MLOF_TRACE
+file of the night, which monochromator or filter wheel moves (the "device"
+spans) came before or overlapped each exposure.
+
+Typical usage:
+
+    python exposure_timing.py --doSummary /data/2023_05_01/timing.jsonl --trace /data/2023_05_01/trace.json
+"""
+
+import os
+import json
+import fcntl
+import optparse
+from datetime import datetime
+
+import numpy as np
+
+from instrumentation import configure_from_environment, load_trace
+
+TIMING_LOG_NAME = 'timing.jsonl'
+EVENTS = ['issue', 'open', 'close', 'readout', 'saved']
+#Header keyword and comment of each event
+EVENT_KEYS = {'issue': ['CMDTIME', 'acquisition command issued (UTC)'],
+              'open': ['SHUTOPEN', 'shutter opened, estimated (UTC)'],
+              'close': ['SHUTCLOS', 'shutter closed, estimated (UTC)'],
+              'readout': ['READDONE', 'readout complete (UTC)'],
+              'saved': ['RAWSAVED', 'raw frame saved (UTC)']}
+
+
+def timing_file_name(parameter_file_prefix):
+    return parameter_file_prefix + '_timing.txt'
+
+
+def utc_isot(unix_time):
+    """
+
+    :return: a unix time as an ISO 8601 UTC string, to the microsecond
+    """
+    return datetime.utcfromtimestamp(unix_time).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class TimingSeries:
+    """
+    Events of a timing file, re-read incrementally while configure_sasha appends to it.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._offset = 0
+        self._partial = ''
+        # readout -> event -> (monotonic, unix) seconds
+        self._readouts = {}
+
+    def update(self):
+        """
+        Reads any events appended since the last call.
+
+        :return: the number of new events
+        """
+        if not os.path.isfile(self.file_name):
+            return 0
+        with open(self.file_name) as f:
+            f.seek(self._offset)
+            text = f.read()
+            self._offset = f.tell()
+        lines = (self._partial + text).split('\n')
+        # the last line may still be being written
+        self._partial = lines.pop()
+        n_new = 0
+        for line in lines:
+            fields = line.split()
+            if len(fields) == 4:
+                self._readouts.setdefault(int(fields[0]), {})[fields[1]] = (float(fields[2]), float(fields[3]))
+                n_new += 1
+        return n_new
+
+    def __len__(self):
+        return len([readout for readout in self._readouts if readout > 0])
+
+    def frame(self, readout):
+        """
+        Timing of one readout (counted from 1), with the intervals that follow from it.
+
+        :return: dict of 'readout', 'events' and 'mono' (event -> unix and monotonic seconds),
+                 'dead_time' (since the previous readout's shutter closed, or since the command
+                 for the first) and 'readout_time'; None if the readout has no events yet
+        """
+        if readout not in self._readouts:
+            return None
+        events = dict(self._readouts.get(0, {}))
+        events.update(self._readouts[readout])
+        timing = {'readout': readout,
+                  'events': dict((event, times[1]) for event, times in events.items()),
+                  'mono': dict((event, times[0]) for event, times in events.items()),
+                  'dead_time': None,
+                  'readout_time': None}
+        previous = self._readouts.get(readout - 1, {}).get('close', events.get('issue'))
+        if 'open' in events and previous is not None:
+            timing['dead_time'] = events['open'][0] - previous[0]
+        if 'close' in events and 'readout' in events:
+            timing['readout_time'] = events['readout'][0] - events['close'][0]
+        return timing
+
+
+def read_timing(file_name, readout=1):
+    """
+
+    :return: the timing of one readout of a timing file, or None if there is no file
+    """
+    if file_name is None or not os.path.isfile(file_name):
+        return None
+    series = TimingSeries(file_name)
+    series.update()
+    return series.frame(readout)
+
+
+def timing_header_elems(timing):
+    """
+
+    :return: [key, value, comment] elements of a frame's timing; empty without one
+    """
+    if timing is None:
+        return []
+    header_elems = []
+    for event in EVENTS:
+        if event in timing['events']:
+            key, comment = EVENT_KEYS[event]
+            header_elems.append([key, utc_isot(timing['events'][event]), comment])
+    if 'open' in timing['mono']:
+        header_elems.append(['MONOOPEN', round(timing['mono']['open'], 6), '[s] SHUTOPEN on the monotonic clock'])
+    if timing['dead_time'] is not None:
+        header_elems.append(['DEADTIME', round(timing['dead_time'], 6), '[s] since previous shutter close or command'])
+    if timing['readout_time'] is not None:
+        header_elems.append(['RDTIME', round(timing['readout_time'], 6), '[s] from shutter close to readout complete'])
+    return header_elems
+
+
+def log_entry(file_name, timing, written):
+    """
+
+    :param written: unix time the FITS file was in place
+    :return: the timing log record of one frame
+    """
+    events = timing['events']
+    entry = {'file': os.path.basename(file_name),
+             'readout': timing['readout'],
+             'events': events,
+             'mono': timing['mono'],
+             'written': written,
+             'dead_time': timing['dead_time'],
+             'readout_time': timing['readout_time'],
+             'save_time': None,
+             'write_time': None}
+    if 'readout' in events and 'saved' in events:
+        entry['save_time'] = events['saved'] - events['readout']
+    if 'readout' in events:
+        entry['write_time'] = written - events['readout']
+    return entry
+
+
+def append_log(directory, entry):
+    """
+    Appends an entry to a directory's timing log. Writers in other processes are kept out with a file lock.
+    """
+    with open(os.path.join(directory, TIMING_LOG_NAME), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def log_frame(file_name, timing, written):
+    """
+    Records a written frame in the timing log next to it; does nothing without a timing.
+    """
+    if timing is None:
+        return
+    append_log(os.path.dirname(os.path.abspath(file_name)), log_entry(file_name, timing, written))
+
+
+def read_log(log_file):
+    """
+
+    :return: the entries of a timing log, oldest first
+    """
+    entries = []
+    if not os.path.isfile(log_file):
+        return entries
+    with open(log_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # a line cut short by a crash while it was appended
+                continue
+    return entries
+
+
+def device_moves(trace_file):
+    """
+
+    :return: list of (name, start, end) unix seconds of the "device" spans of a trace, by start
+    """
+    moves = []
+    for event in load_trace(trace_file):
+        if event.get('ph') == 'X' and event.get('cat') == 'device':
+            start = event['ts'] / 1e6
+            moves.append((event['name'], start, start + event['dur'] / 1e6))
+    return sorted(moves, key=lambda move: move[1])
+
+
+def moves_near(entry, moves):
+    """
+
+    :return: (moves overlapping the exposure, last move that ended before it opened or None)
+    """
+    events = entry['events']
+    if 'open' not in events or 'close' not in events:
+        return [], None
+    starts = np.array([move[1] for move in moves])
+    overlapping = [move for move in moves[:np.searchsorted(starts, events['close'])]
+                   if move[2] > events['open']]
+    before = [move for move in moves if move[2] <= events['open']]
+    return overlapping, max(before, key=lambda move: move[2]) if before else None
+
+
+def format_seconds(value):
+    return '%9s' % '-' if value is None else '%9.4f' % value
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] timing_logs")
+
+    parser.add_option("--trace", default=None, help="MLOF_TRACE file to find monochromator and filter wheel moves in")
+    parser.add_option("--doSummary", action="store_true", default=False)
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+    configure_from_environment(process_name="exposure_timing")
+
+    if opts.doSummary:
+        moves = device_moves(opts.trace) if opts.trace is not None else None
+        for log_file in args:
+            entries = read_log(log_file)
+            print('%s: %d frame(s)' % (log_file, len(entries)))
+            print('  %-36s %9s %9s %9s %9s %9s %9s' % ('file', 'exposure', 'dead', 'gap', 'readout', 'save', 'write'))
+            exposures, gaps = [], []
+            previous_close = None
+            for entry in entries:
+                events = entry['events']
+                exposure = gap = None
+                if 'open' in events and 'close' in events:
+                    exposure = events['close'] - events['open']
+                    exposures.append(exposure)
+                    # the shutter was closed from the previous frame of the log until this one opened
+                    if previous_close is not None:
+                        gap = events['open'] - previous_close
+                        gaps.append(gap)
+                    previous_close = events['close']
+                line = '  %-36s %s %s %s %s %s %s' % (entry['file'], format_seconds(exposure),
+                                                      format_seconds(entry['dead_time']), format_seconds(gap),
+                                                      format_seconds(entry['readout_time']),
+                                                      format_seconds(entry['save_time']), format_seconds(entry['write_time']))
+                if moves is not None:
+                    overlapping, before = moves_near(entry, moves)
+                    if overlapping:
+                        line += '  MOVED during exposure: %s' % ', '.join(move[0] for move in overlapping)
+                    elif before is not None:
+                        line += '  %.3f s after %s' % (events['open'] - before[2], before[0])
+                print(line)
+            if gaps:
+                print('  between frames: mean %.4f s, max %.4f s; shutter open %.1f%% of the time' %
+                      (np.mean(gaps), np.max(gaps), 100.0 * np.sum(exposures[1:]) / (np.sum(exposures[1:]) + np.sum(gaps))))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+.. module:: fits_integrity
+    :platform: unix
+    :synopsis: Checksums and content hashes of FITS frames, recorded as they are written, and their verification.
+
+write_fits_atomic (fits_writer.py) writes every frame with
+
+    CHECKSUM/DATASUM  the FITS standard checksums of each HDU
+    DATAHASH          SHA-256 of the primary data array, as big-endian values
+
+and, once the frame is renamed into place, appends a line to manifest.jsonl
+in its directory giving the SHA-256 and size of the whole file. All of these
+are computed from what is in memory while the file is written, so writing a
+frame never reads it back. The manifest's sha256 values are those
+sha256sum prints.
+
+--doVerify reads every frame of a directory once, across several
+processes, and reports frames whose checksums or hashes no longer match,
+frames missing from disk or from the manifest, and frames whose data is
+identical to another's (DATAHASH ignores the header, so a frame converted
+twice shows up as a duplicate).
+
+Typical usage:
+
+    python fits_integrity.py --doVerify -n 8 /data/2023_05_01/
+    python fits_integrity.py --doManifest /data/2019_03_21/
+"""
+
+import os
+import io
+import sys
+import glob
+import json
+import fcntl
+import hashlib
+import optparse
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+
+from instrumentation import configure_from_environment, span
+
+MANIFEST_NAME = 'manifest.jsonl'
+HASH_KEY = 'DATAHASH'
+
+
+def data_hash(data):
+    """
+
+    :return: hex SHA-256 of an array's values stored big endian, as FITS stores them
+    """
+    data = np.ascontiguousarray(data)
+    return hashlib.sha256(data.astype(data.dtype.newbyteorder('>'), copy=False)).hexdigest()
+
+
+class HashingFile:
+    """
+    Write-only file wrapper that hashes and counts the bytes passing through it.
+
+    It has no fileno(), so astropy hands every block, data included, to write().
+    """
+    mode = 'wb'
+
+    def __init__(self, f):
+        self._f = f
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self.hash.update(data)
+        self.size += data.nbytes
+        return self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
+
+    def tell(self):
+        return self.size
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def manifest_file_name(directory):
+    return os.path.join(directory, MANIFEST_NAME)
+
+
+def manifest_entry(file_name, sha256, size, header):
+    """
+
+    :return: the manifest record of one file
+    """
+    return {'file': os.path.basename(file_name),
+            'size': size,
+            'sha256': sha256,
+            'datahash': header.get(HASH_KEY),
+            'datasum': header.get('DATASUM'),
+            'written': Time.now().isot}
+
+
+def append_manifest(directory, entry):
+    """
+    Appends an entry to a directory's manifest. Writers in other processes are kept out with a file lock.
+    """
+    with open(manifest_file_name(directory), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_manifest(directory):
+    """
+
+    :return: dict of file base name to its manifest entry; the latest entry wins when a file was rewritten
+    """
+    entries = {}
+    file_name = manifest_file_name(directory)
+    if not os.path.isfile(file_name):
+        return entries
+    with open(file_name) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a line cut short by a crash while it was appended
+                continue
+            entries[entry['file']] = entry
+    return entries
+
+
+def verify_file(args):
+    """
+    Checks one file against its checksums, DATAHASH and manifest entry, reading it once.
+
+    :param args: (file name, manifest entry or None)
+    :return: dict of 'file', 'datahash' and 'problems', a list of what did not match
+    """
+    file_name, entry = args
+    problems = []
+    try:
+        with open(file_name, 'rb') as f:
+            contents = f.read()
+    except OSError as error:
+        return {'file': file_name, 'datahash': None, 'problems': ['unreadable: %s' % error]}
+    if entry is not None:
+        if entry.get('size') is not None and entry['size'] != len(contents):
+            problems.append('size %d, manifest says %d' % (len(contents), entry['size']))
+        elif entry.get('sha256') is not None and hashlib.sha256(contents).hexdigest() != entry['sha256']:
+            problems.append('sha256 does not match manifest')
+    datahash = None
+    try:
+        with fits.open(io.BytesIO(contents)) as hdul:
+            for i, hdu in enumerate(hdul):
+                if 'CHECKSUM' in hdu.header and hdu.verify_checksum() == 0:
+                    problems.append('CHECKSUM of HDU %d does not match' % i)
+                if 'DATASUM' in hdu.header and hdu.verify_datasum() == 0:
+                    problems.append('DATASUM of HDU %d does not match' % i)
+            if hdul[0].data is not None:
+                datahash = data_hash(hdul[0].data)
+                if HASH_KEY in hdul[0].header and hdul[0].header[HASH_KEY] != datahash:
+                    problems.append('%s does not match' % HASH_KEY)
+    except Exception as error:
+        problems.append('not readable as FITS: %s' % error)
+    return {'file': file_name, 'datahash': datahash, 'problems': problems}
+
+
+def frame_files(directory):
+    """
+
+    :return: FITS files of a directory, without temporary files left by an interrupted write
+    """
+    return sorted(f for f in glob.glob(os.path.join(directory, '*.fits'))
+                  if not os.path.basename(f).startswith('.'))
+
+
+def verify_directory(directory, n_processes=4):
+    """
+    Verifies every FITS file of a directory in parallel.
+
+    :return: dict of 'results' (one per file), 'corrupted' files with their problems,
+             'missing' manifest entries with no file, 'unrecorded' files with no manifest entry
+             and 'duplicates', lists of files sharing a DATAHASH
+    """
+    manifest = read_manifest(directory)
+    file_names = frame_files(directory)
+    tasks = [(f, manifest.get(os.path.basename(f))) for f in file_names]
+    with span("integrity.verify", cat="io", directory=directory, n_files=len(tasks)):
+        if n_processes > 1 and len(tasks) > 1:
+            with Pool(processes=n_processes) as pool:
+                results = pool.map(verify_file, tasks, chunksize=max(1, len(tasks) // (4 * n_processes)))
+        else:
+            results = [verify_file(task) for task in tasks]
+    on_disk = set(os.path.basename(f) for f in file_names)
+    by_hash = {}
+    for result in results:
+        if result['datahash'] is not None:
+            by_hash.setdefault(result['datahash'], []).append(result['file'])
+    return {'results': results,
+            'corrupted': [(r['file'], r['problems']) for r in results if r['problems']],
+            'missing': sorted(name for name in manifest if name not in on_disk),
+            'unrecorded': sorted(f for f in file_names if os.path.basename(f) not in manifest),
+            'duplicates': [sorted(files) for files in by_hash.values() if len(files) > 1]}
+
+
+def build_manifest(directory):
+    """
+    Adds manifest entries for files written before there was one (or by other tools).
+
+    :return: number of entries added
+    """
+    manifest = read_manifest(directory)
+    n_added = 0
+    for file_name in frame_files(directory):
+        if os.path.basename(file_name) in manifest:
+            continue
+        with open(file_name, 'rb') as f:
+            contents = f.read()
+        with fits.open(io.BytesIO(contents)) as hdul:
+            header = hdul[0].header.copy()
+            if HASH_KEY not in header and hdul[0].data is not None:
+                header[HASH_KEY] = data_hash(hdul[0].data)
+        append_manifest(directory, manifest_entry(file_name, hashlib.sha256(contents).hexdigest(),
+                                                  len(contents), header))
+        n_added += 1
+    return n_added
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] directories")
+
+    parser.add_option("-n","--n_processes", type=int, default=4)
+    parser.add_option("--doVerify", action="store_true", default=False)
+    parser.add_option("--doManifest", action="store_true", default=False,
+                      help="add manifest entries for files that have none")
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+    configure_from_environment(process_name="fits_integrity")
+
+    if opts.doManifest:
+        for directory in args:
+            print('%s: added %d manifest entries' % (directory, build_manifest(directory)))
+
+    if opts.doVerify:
+        n_bad = 0
+        for directory in args:
+            report = verify_directory(directory, n_processes=opts.n_processes)
+            for file_name, problems in report['corrupted']:
+                print('CORRUPTED %s: %s' % (file_name, '; '.join(problems)))
+            for name in report['missing']:
+                print('MISSING %s' % os.path.join(directory, name))
+            for files in report['duplicates']:
+                print('DUPLICATE data in %s' % ', '.join(files))
+            print('%s: %d file(s), %d corrupted, %d missing, %d duplicated, %d not in the manifest' %
+                  (directory, len(report['results']), len(report['corrupted']), len(report['missing']),
+                   sum(len(files) for files in report['duplicates']), len(report['unrecorded'])))
+            n_bad += len(report['corrupted']) + len(report['missing'])
+        sys.exit(1 if n_bad else 0)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""
+.. module:: fits_writer
+    :platform: unix
+    :synopsis: Background FITS writing with atomic renames and batched fsyncs.
+
+FitsWriter takes frames off the acquisition/conversion thread and writes
+them from a thread (or process) pool. Each file is written to a temporary
+name in its target directory and renamed into place, so a reader never sees
+a half-written FITS file. When the data is forced to disk is set by the
+durability policy:
+
+    'frame'  fsync every file (and its directory) before it is renamed into place
+    'batch'  fsync the last fsync_every files, and their directories, together
+    'run'    fsync everything once, when the writer is closed
+    'none'   leave it to the kernel
+
+Queue depth and write latency are kept in the instrumentation metrics
+registry ("writer.queue_depth", "writer.latency", "writer.io", "writer.fsync"),
+so storage can be sized for faster cadences.
+
+Every file is written with CHECKSUM/DATASUM and a DATAHASH of its data, and
+recorded in its directory's manifest.jsonl (see fits_integrity.py), all
+computed as it is written.
+
+Typical usage:
+
+    with FitsWriter(n_workers=4, durability='batch') as writer:
+        for img, header in frames:
+            writer.submit(img, header, 'frame_%d.fits' % i)
+    print(writer.stats())
+"""
+
+import os
+import time
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from instrumentation import metrics, counter, span
+from fits_integrity import HashingFile, data_hash, manifest_entry, append_manifest, HASH_KEY
+
+DURABILITY_POLICIES = ['frame', 'batch', 'run', 'none']
+
+
+def fsync_path(path):
+    """
+    Forces a file (or directory) already written and closed onto disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_fits_atomic(data, header, file_name, fsync=False, overwrite=True, extensions=None,
+                      checksum=True, manifest=True):
+    """
+    Writes one primary HDU to a temporary file next to file_name and renames it into place.
+
+    :param fsync: force the file and its directory to disk before returning
+    :param extensions: further HDUs to write after the primary one
+    :param checksum: add CHECKSUM/DATASUM to every HDU and DATAHASH to the primary one
+    :param manifest: record the file in manifest.jsonl of its directory once it is in place
+    :return: (file_name, seconds spent writing)
+    """
+    start = time.perf_counter()
+    directory = os.path.dirname(os.path.abspath(file_name))
+    if not overwrite and os.path.exists(file_name):
+        raise OSError('File %s already exists' % file_name)
+    tmp_name = os.path.join(directory, '.%s.%d.tmp' % (os.path.basename(file_name), os.getpid()))
+    hdul = fits.HDUList([fits.PrimaryHDU(data, header=header)] + list(extensions or []))
+    if checksum and data is not None:
+        # 64 hex digits leave no room on the card for a comment
+        hdul[0].header[HASH_KEY] = data_hash(data)
+    try:
+        with open(tmp_name, 'wb') as f:
+            hashing_file = HashingFile(f)
+            hdul.writeto(hashing_file, checksum=checksum)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+    if fsync:
+        fsync_path(directory)
+    if manifest:
+        append_manifest(directory, manifest_entry(file_name, hashing_file.hexdigest(), hashing_file.size,
+                                                  hdul[0].header))
+    return file_name, time.perf_counter() - start
+
+
+class FitsWriter:
+    """
+    Pool of FITS writers that never blocks the caller.
+    """
+    def __init__(self, n_workers=4, durability='batch', fsync_every=16, target_dirs=None,
+                 use_processes=False):
+        """
+
+        :param n_workers: number of concurrent writers
+        :param durability: one of DURABILITY_POLICIES
+        :param fsync_every: number of files per fsync batch with durability='batch'
+        :param target_dirs: directories that relative file names are spread over, round robin
+        :param use_processes: write from worker processes instead of threads
+        """
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError('durability must be one of %s' % str(DURABILITY_POLICIES))
+        self.durability = durability
+        self.fsync_every = max(1, int(fsync_every))
+        self.target_dirs = target_dirs
+        if target_dirs:
+            for target_dir in target_dirs:
+                if not os.path.isdir(target_dir):
+                    os.makedirs(target_dir)
+            self._next_dir = itertools.cycle(target_dirs)
+        if use_processes:
+            self._pool = ProcessPoolExecutor(max_workers=n_workers)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='fits_writer')
+        # fsyncs run off the write pool so that a slow flush never stalls the next frame
+        self._fsync_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fits_fsync')
+        self._lock = threading.Lock()
+        self._unsynced = []
+        self._futures = set()
+        self.n_submitted = 0
+        self.n_written = 0
+        self.n_failed = 0
+        self.max_queue_depth = 0
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    @property
+    def queue_depth(self):
+        return self.n_submitted - self.n_written - self.n_failed
+
+    def resolve(self, file_name):
+        """
+
+        :return: file_name, placed in the next target directory if it is relative and target_dirs is set
+        """
+        if self.target_dirs and not os.path.isabs(file_name) and not os.path.dirname(file_name):
+            return os.path.join(next(self._next_dir), file_name)
+        return file_name
+
+    def submit(self, data, header, file_name, extensions=None):
+        """
+        Queues one frame (and any extension HDUs) for writing and returns immediately.
+
+        The data and extensions are copied, so the caller may reuse them straight away.
+
+        :return: a future resolving to (file_name, seconds spent writing)
+        """
+        file_name = self.resolve(file_name)
+        data = np.array(data, copy=True)
+        header = header.copy()
+        if extensions:
+            extensions = [hdu.copy() for hdu in extensions]
+        submitted = time.perf_counter()
+        with self._lock:
+            self.n_submitted += 1
+            depth = self.queue_depth
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+        metrics.gauge("writer.queue_depth", depth)
+        counter("writer.queue_depth", depth, cat="io")
+        future = self._pool.submit(write_fits_atomic, data, header, file_name,
+                                   self.durability == 'frame', True, extensions)
+        # register before the callback, which runs straight away if the write already finished
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(lambda f: self._done(f, submitted))
+        return future
+
+    def _done(self, future, submitted):
+        with self._lock:
+            self._futures.discard(future)
+        error = future.exception()
+        if error is not None:
+            with self._lock:
+                self.n_failed += 1
+                self.errors.append(error)
+            metrics.incr("writer.failed")
+            print('FITS write failed: %s' % error)
+            return
+        file_name, io_time = future.result()
+        metrics.observe("writer.io", io_time)
+        metrics.observe("writer.latency", time.perf_counter() - submitted)
+        batch = None
+        with self._lock:
+            self.n_written += 1
+            depth = self.queue_depth
+            if self.durability in ['batch', 'run']:
+                self._unsynced.append(file_name)
+                if self.durability == 'batch' and len(self._unsynced) >= self.fsync_every:
+                    batch, self._unsynced = self._unsynced, []
+        metrics.incr("writer.frames")
+        metrics.gauge("writer.queue_depth", depth)
+        if batch:
+            self._fsync_pool.submit(self._fsync_batch, batch)
+
+    def _fsync_batch(self, file_names):
+        with span("writer.fsync_batch", cat="io", n_files=len(file_names)):
+            start = time.perf_counter()
+            for file_name in file_names:
+                fsync_path(file_name)
+            for directory in set(os.path.dirname(os.path.abspath(f)) for f in file_names):
+                fsync_path(directory)
+            metrics.observe("writer.fsync", time.perf_counter() - start)
+
+    def flush(self):
+        """Waits for every queued frame to be written."""
+        while True:
+            with self._lock:
+                pending = list(self._futures)
+            if not pending:
+                return
+            for future in pending:
+                try:
+                    future.result()
+                except Exception:
+                    pass
+
+    def close(self):
+        """Writes out the queue, applies any outstanding fsyncs and stops the workers."""
+        self.flush()
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            batch, self._unsynced = self._unsynced, []
+        if batch:
+            self._fsync_pool.submit(self._fsync_batch, batch)
+        self._fsync_pool.shutdown(wait=True)
+
+    def stats(self):
+        """
+
+        :return: counts, queue depth and latency statistics of this writer
+        """
+        snapshot = metrics.snapshot()["histograms"]
+        return {"submitted": self.n_submitted,
+                "written": self.n_written,
+                "failed": self.n_failed,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "latency": snapshot.get("writer.latency"),
+                "io": snapshot.get("writer.io"),
+                "fsync": snapshot.get("writer.fsync")}
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+"""
+.. module:: flat_response
+    :platform: unix
+    :synopsis: (wavelength, row, column) response cube of a monochromator sweep, built on disk a frame at a time.
+
+A sweep (Monochromater.scan, one PIXIS frame per wavelength) is streamed
+into a float32 cube preallocated on disk as a .npy memory map, one plane per
+step of the planned wavelength grid. Each frame is reduced as it is read,
+
+    response = (frame - bias - dark_rate * EXPTIME) / EXPTIME    [ADU/s]
+
+where bias is the mean of the bias frames and dark_rate the mean dark frame
+less bias, per second, so only a frame or two is ever in memory. Frames
+land on the grid step nearest their MONOWAVE; repeated frames at one step
+are averaged. The cube directory holds
+
+    response.npy    the cube
+    response.json   the grid, which steps are filled and from which files
+
+and the state is saved after every frame, so a sweep that was interrupted
+(or is still running) is completed by building again with the same
+directory: files already in the cube are skipped.
+
+The response at any wavelength is interpolated per pixel, linearly between
+the two nearest filled planes, without reading the rest of the cube.
+
+Typical usage:
+
+    python flat_response.py --doBuild -o /data/sweep_cube --wavelengths 400,1100,0.7 \\
+        --bias '/data/bias_*.fits' --dark '/data/dark_*.fits' '/data/sweep_*.fits'
+    python flat_response.py --doResponse 633.5 -o /data/sweep_cube --output_file flat_633.fits
+"""
+
+import os
+import glob
+import json
+import optparse
+
+import numpy as np
+from astropy.io import fits
+
+from instrumentation import configure_from_environment, span, metrics
+from pixel_stats import PixelStatsAccumulator
+from fits_writer import write_fits_atomic
+
+CUBE_NAME = 'response.npy'
+STATE_NAME = 'response.json'
+
+
+def master_frame(file_names):
+    """
+    Mean of a set of frames, accumulated one frame at a time. A single pixel_stats.py
+    output file (with a MEAN extension) is used as it is.
+
+    :return: (mean float32 frame, mean EXPTIME in s or None)
+    """
+    if len(file_names) == 1:
+        with fits.open(file_names[0]) as hdul:
+            if 'MEAN' in hdul:
+                return np.array(hdul['MEAN'].data, dtype=np.float32), hdul[0].header.get('EXPTIME')
+    accumulator = None
+    exposure_times = []
+    for file_name in file_names:
+        with fits.open(file_name) as hdul:
+            frame = hdul[0].data
+            if accumulator is None:
+                accumulator = PixelStatsAccumulator(frame.shape)
+            accumulator.add(frame)
+            if 'EXPTIME' in hdul[0].header:
+                exposure_times.append(float(hdul[0].header['EXPTIME']))
+    if accumulator is None:
+        raise ValueError('No frames to average')
+    return accumulator.mean, (float(np.mean(exposure_times)) if exposure_times else None)
+
+
+def wavelength_grid(spec):
+    """
+
+    :param spec: 'start,stop,step' in nm
+    :return: the grid, stop included
+    """
+    start, stop, step = [float(value) for value in spec.split(',')]
+    return np.round(np.arange(start, stop + 0.5 * step, step), 6)
+
+
+class ResponseCube:
+    """
+    Response cube and its state in a directory.
+    """
+    def __init__(self, cube_dir, mode='r'):
+        """
+
+        :param mode: 'r' to read, 'r+' to fill in
+        """
+        self.cube_dir = cube_dir
+        with open(os.path.join(cube_dir, STATE_NAME)) as f:
+            self.state = json.load(f)
+        self.wavelengths = np.array(self.state['wavelengths'])
+        self.cube = np.load(os.path.join(cube_dir, CUBE_NAME), mmap_mode=mode)
+
+    @classmethod
+    def create(cls, cube_dir, wavelengths, shape, bias_files=None, dark_files=None):
+        """
+        Preallocates an empty cube on disk for frames of shape (rows, columns).
+        """
+        if not os.path.isdir(cube_dir):
+            os.makedirs(cube_dir)
+        cube = np.lib.format.open_memmap(os.path.join(cube_dir, CUBE_NAME), mode='w+', dtype=np.float32,
+                                         shape=(len(wavelengths),) + tuple(shape))
+        del cube
+        n = len(wavelengths)
+        state = {'wavelengths': [float(w) for w in wavelengths],
+                 'shape': [int(s) for s in shape],
+                 'units': 'ADU/s',
+                 'counts': [0] * n,
+                 'exptime': [None] * n,
+                 'sources': [[] for i in range(n)],
+                 'bias': bias_files or [],
+                 'dark': dark_files or []}
+        _write_state(cube_dir, state)
+        return cls(cube_dir, mode='r+')
+
+    @property
+    def filled(self):
+        return np.array(self.state['counts']) > 0
+
+    def ingested(self):
+        """
+
+        :return: base names of the files already in the cube
+        """
+        return set(os.path.basename(f) for sources in self.state['sources'] for f in sources)
+
+    def step_of(self, wavelength, tolerance=None):
+        """
+
+        :return: index of the grid step nearest a wavelength, or None if it is further than tolerance
+                 (half the grid spacing by default)
+        """
+        index = int(np.argmin(np.abs(self.wavelengths - wavelength)))
+        if tolerance is None:
+            tolerance = 0.5 * np.min(np.diff(self.wavelengths)) if len(self.wavelengths) > 1 else np.inf
+        if abs(self.wavelengths[index] - wavelength) > tolerance + 1e-9:
+            return None
+        return index
+
+    def add(self, index, response, exptime, source):
+        """
+        Averages a reduced frame into a step and saves the state.
+        """
+        n = self.state['counts'][index]
+        plane = self.cube[index]
+        if n == 0:
+            plane[...] = response
+        else:
+            plane *= n / (n + 1.0)
+            plane += response / (n + 1.0)
+        # the plane is on disk before the state says it is filled
+        self.cube.flush()
+        self.state['counts'][index] = n + 1
+        self.state['exptime'][index] = exptime
+        self.state['sources'][index].append(os.path.basename(source))
+        _write_state(self.cube_dir, self.state)
+
+    def response_at(self, wavelength):
+        """
+        Per-pixel response at a wavelength, linear between the two nearest filled planes.
+
+        :return: (rows, columns) float32
+        """
+        filled = np.flatnonzero(self.filled)
+        if len(filled) == 0:
+            raise ValueError('The cube has no filled planes')
+        filled_wavelengths = self.wavelengths[filled]
+        if wavelength <= filled_wavelengths[0]:
+            return np.array(self.cube[filled[0]])
+        if wavelength >= filled_wavelengths[-1]:
+            return np.array(self.cube[filled[-1]])
+        upper = int(np.searchsorted(filled_wavelengths, wavelength))
+        lower = upper - 1
+        weight = np.float32((wavelength - filled_wavelengths[lower]) /
+                            (filled_wavelengths[upper] - filled_wavelengths[lower]))
+        response = np.array(self.cube[filled[lower]])
+        response *= 1 - weight
+        response += weight * self.cube[filled[upper]]
+        return response
+
+    def pixel_response(self, row, col):
+        """
+
+        :return: (wavelengths, response) of one pixel over the filled steps
+        """
+        filled = np.flatnonzero(self.filled)
+        return self.wavelengths[filled], np.array(self.cube[filled, row, col])
+
+
+def _write_state(cube_dir, state):
+    file_name = os.path.join(cube_dir, STATE_NAME)
+    tmp_name = file_name + '.tmp%d' % os.getpid()
+    with open(tmp_name, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_name, file_name)
+
+
+def reduce_frame(frame, exptime, bias, dark_rate):
+    """
+
+    :return: (frame - bias - dark_rate * exptime) / exptime as float32
+    """
+    response = np.subtract(frame, bias, dtype=np.float32)
+    if dark_rate is not None:
+        response -= dark_rate * np.float32(exptime)
+    response /= np.float32(exptime)
+    return response
+
+
+def build_cube(cube_dir, file_names, wavelengths=None, bias_files=None, dark_files=None, dark_exptime=None,
+               tolerance=None):
+    """
+    Streams a sweep into a response cube, creating it if needed and skipping files it already holds.
+
+    :param wavelengths: planned grid; taken from the frames' MONOWAVE if None and the cube is new
+    :param dark_exptime: [s] exposure time of the dark when its files do not record one
+    :return: the ResponseCube
+    """
+    if os.path.isfile(os.path.join(cube_dir, STATE_NAME)):
+        cube = ResponseCube(cube_dir, mode='r+')
+        bias_files, dark_files = cube.state['bias'], cube.state['dark']
+    else:
+        if wavelengths is None:
+            wavelengths = np.unique([float(fits.getheader(f)['MONOWAVE']) for f in file_names])
+        first_header = fits.getheader(file_names[0])
+        cube = ResponseCube.create(cube_dir, wavelengths, (first_header['NAXIS2'], first_header['NAXIS1']),
+                                   bias_files=bias_files, dark_files=dark_files)
+    bias = np.float32(0.0)
+    if bias_files:
+        bias, _ = master_frame(bias_files)
+    dark_rate = None
+    if dark_files:
+        dark, exposure = master_frame(dark_files)
+        exposure = dark_exptime if dark_exptime is not None else exposure
+        if not exposure:
+            raise ValueError('The dark frames record no EXPTIME; give the dark exposure time')
+        dark_rate = (dark - bias) / np.float32(exposure)
+    ingested = cube.ingested()
+    for file_name in file_names:
+        if os.path.basename(file_name) in ingested:
+            continue
+        with span("flat_response.add", cat="analysis", file=file_name):
+            with fits.open(file_name) as hdul:
+                header = hdul[0].header
+                if 'MONOWAVE' not in header or not header.get('EXPTIME'):
+                    print('Skipping %s: no MONOWAVE or EXPTIME' % file_name)
+                    continue
+                index = cube.step_of(float(header['MONOWAVE']), tolerance)
+                if index is None:
+                    print('Skipping %s: %.3f nm is not on the grid' % (file_name, header['MONOWAVE']))
+                    continue
+                exptime = float(header['EXPTIME'])
+                response = reduce_frame(hdul[0].data, exptime, bias, dark_rate)
+            cube.add(index, response, exptime, file_name)
+        metrics.incr("flat_response.frames")
+    return cube
+
+
+def expand(patterns):
+    if patterns is None:
+        return None
+    return sorted(f for pattern in patterns.split(',') for f in glob.glob(pattern))
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] sweep_fits_files")
+
+    parser.add_option("-o","--cube_dir", default="response_cube")
+    parser.add_option("--wavelengths", default=None, help="start,stop,step of the planned grid in nm; defaults to the MONOWAVE values of the frames")
+    parser.add_option("--tolerance", type=float, default=None, help="[nm] furthest a frame may be from its grid step; defaults to half the spacing")
+    parser.add_option("--bias", default=None, help="comma separated bias frames or patterns (or one pixel_stats.py file)")
+    parser.add_option("--dark", default=None, help="comma separated dark frames or patterns (or one pixel_stats.py file)")
+    parser.add_option("--dark_exptime", type=float, default=None, help="[s] exposure time of the dark, when its files do not record it")
+    parser.add_option("--output_file", default=None, help="where --doResponse writes the response frame")
+    parser.add_option("--doBuild", action="store_true", default=False)
+    parser.add_option("--doStatus", action="store_true", default=False)
+    parser.add_option("--doResponse", type=float, default=None, help="write the response at this wavelength (nm)")
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+    configure_from_environment(process_name="flat_response")
+
+    if opts.doBuild:
+        fits_files = sorted(f for pattern in args for f in glob.glob(pattern))
+        cube = build_cube(opts.cube_dir, fits_files,
+                          wavelengths=wavelength_grid(opts.wavelengths) if opts.wavelengths else None,
+                          bias_files=expand(opts.bias), dark_files=expand(opts.dark),
+                          dark_exptime=opts.dark_exptime, tolerance=opts.tolerance)
+        print('%s: %d of %d steps filled' % (opts.cube_dir, cube.filled.sum(), len(cube.wavelengths)))
+
+    if opts.doStatus:
+        cube = ResponseCube(opts.cube_dir)
+        filled = cube.filled
+        print('%s: %d of %d steps filled, %.1f to %.1f nm' %
+              (opts.cube_dir, filled.sum(), len(filled), cube.wavelengths[0], cube.wavelengths[-1]))
+        missing = cube.wavelengths[~filled]
+        if len(missing):
+            print('Missing: %s' % ', '.join('%g' % w for w in missing[:20]) + (' ...' if len(missing) > 20 else ''))
+
+    if opts.doResponse is not None:
+        cube = ResponseCube(opts.cube_dir)
+        response = cube.response_at(opts.doResponse)
+        output_file = opts.output_file
+        if output_file is None:
+            output_file = os.path.join(opts.cube_dir, 'response_%g.fits' % opts.doResponse)
+        header = fits.Header()
+        header['MONOWAVE'] = (opts.doResponse, '[nm] wavelength the response is interpolated to')
+        header['BUNIT'] = ('ADU/s', 'bias and dark subtracted count rate')
+        write_fits_atomic(response, header, output_file)
+        print('Wrote the response at %g nm to %s' % (opts.doResponse, output_file))
@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+
+"""
+.. module:: instrumentation
+    :platform: unix
+    :synopsis: Span tracing and in-process metrics for the acquisition chain.
+
+Spans are written in the Chrome trace event format ("JSON Array Format"),
+which chrome://tracing, Perfetto and the OpenTelemetry Chrome-trace importers
+all read. Every process in a run (configure_sasha, the converters, the device
+scripts) appends to the same file, so the whole night lines up on one
+timeline.
+
+Tracing is switched on by pointing the MLOF_TRACE environment variable at a
+trace file (or by calling configure()). When it is off, span() hands back a
+shared no-op object, so instrumented code pays one attribute check per span.
+
+Typical usage:
+
+    from instrumentation import span, metrics
+
+    with span("convert", cat="conversion", file=source_file):
+        ...
+    print(metrics.summary())
+"""
+
+import atexit
+import functools
+import json
+import math
+import os
+import threading
+import time
+import optparse
+
+TRACE_ENV = "MLOF_TRACE"
+METRICS_ENV = "MLOF_METRICS"
+
+
+class Histogram:
+    """
+    Latency histogram with logarithmic buckets (in seconds).
+
+    Bucket i holds values below 10 us * 2**i; the last bucket is unbounded.
+    """
+    n_buckets = 32
+    base = 1e-5
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = [0] * self.n_buckets
+
+    def observe(self, value):
+        """
+
+        :param value: the latency to record, in seconds
+        """
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if value <= self.base:
+            index = 0
+        else:
+            index = min(int(math.log2(value / self.base)) + 1, self.n_buckets - 1)
+        self.buckets[index] += 1
+
+    def percentile(self, q):
+        """
+
+        :param q: percentile, 0-100
+        :return: upper edge of the bucket holding the q-th percentile, in seconds
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q / 100.0 * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.base * 2 ** index, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {"count": self.count,
+                "sum": self.total,
+                "min": self.min if self.count else 0.0,
+                "max": self.max,
+                "mean": self.total / self.count if self.count else 0.0,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "buckets": self.buckets}
+
+
+class MetricsRegistry:
+    """
+    Thread-safe registry of named counters, gauges and latency histograms.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        """
+
+        :return: a JSON-serialisable copy of every metric
+        """
+        with self._lock:
+            return {"counters": dict(self.counters),
+                    "gauges": dict(self.gauges),
+                    "histograms": {name: h.as_dict() for name, h in self.histograms.items()}}
+
+    def summary(self):
+        """
+
+        :return: a human readable table of the histograms and counters
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, h in sorted(snapshot["histograms"].items()):
+            lines.append("%-32s n=%-7d mean=%9.3f ms  p50=%9.3f ms  p99=%9.3f ms  max=%9.3f ms" %
+                         (name, h["count"], 1e3 * h["mean"], 1e3 * h["p50"], 1e3 * h["p99"], 1e3 * h["max"]))
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("%-32s %d" % (name, value))
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append("%-32s %s" % (name, value))
+        return "\n".join(lines)
+
+    def write(self, file_name):
+        """
+        Appends a snapshot of the registry to file_name as one JSON line.
+        """
+        record = self.snapshot()
+        record["pid"] = os.getpid()
+        record["time"] = time.time()
+        with open(file_name, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class _NullSpan:
+    """Shared stand-in returned by span() while tracing is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "cat", "args", "start")
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer._complete(self.name, self.cat, self.start, end, self.args)
+        return False
+
+    def set(self, **args):
+        """Attaches extra arguments to the span before it closes."""
+        self.args.update(args)
+
+
+class Tracer:
+    """
+    Collects spans and appends them to a Chrome trace file.
+
+    Timestamps are wall-clock microseconds so that events from separate
+    processes share one timeline; durations come from the monotonic clock.
+    """
+    flush_every = 256
+
+    def __init__(self, trace_file=None, metrics=None, process_name=None):
+        self.trace_file = trace_file
+        self.enabled = trace_file is not None
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.process_name = process_name
+        self._events = []
+        self._lock = threading.Lock()
+        self._epoch_ns = time.time_ns() - time.perf_counter_ns()
+        self._pid = os.getpid()
+        if self.enabled and process_name:
+            self._events.append({"name": "process_name", "ph": "M", "pid": self._pid,
+                                 "args": {"name": process_name}})
+
+    def span(self, name, cat="mlof", **args):
+        """
+
+        :param name: name of the span, e.g. "serial.gowave"
+        :param cat: category used to group spans in the viewer
+        :return: a context manager timing the enclosed block
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name, cat, args)
+
+    def instant(self, name, cat="mlof", **args):
+        """Records a zero-length marker, e.g. a state change."""
+        if not self.enabled:
+            return
+        self._append({"name": name, "cat": cat, "ph": "i", "s": "p",
+                      "ts": (time.time_ns()) / 1e3, "pid": self._pid,
+                      "tid": threading.get_ident(), "args": args})
+
+    def counter(self, name, value, cat="mlof"):
+        """Records a sampled value (queue depth, temperature...)."""
+        if not self.enabled:
+            return
+        self._append({"name": name, "cat": cat, "ph": "C",
+                      "ts": (time.time_ns()) / 1e3, "pid": self._pid,
+                      "args": {name: value}})
+
+    def _complete(self, name, cat, start, end, args):
+        self.metrics.observe(name, (end - start) / 1e9)
+        self._append({"name": name, "cat": cat, "ph": "X",
+                      "ts": (self._epoch_ns + start) / 1e3, "dur": (end - start) / 1e3,
+                      "pid": self._pid, "tid": threading.get_ident(), "args": args})
+
+    def _append(self, event):
+        with self._lock:
+            self._events.append(event)
+            if len(self._events) < self.flush_every:
+                return
+            events, self._events = self._events, []
+        self._write(events)
+
+    def flush(self):
+        """Writes any buffered events to the trace file."""
+        with self._lock:
+            events, self._events = self._events, []
+        if events:
+            self._write(events)
+
+    def _create(self):
+        """
+        Creates the trace file already holding the "[" that opens the JSON array.
+
+        The header is written to a temporary file that is then hard-linked into
+        place, so no other process can append to the trace before it is there.
+        If the link fails, the events are appended without it; load_trace adds it.
+        """
+        if os.path.exists(self.trace_file):
+            return
+        tmp_name = "%s.%d.%d.tmp" % (self.trace_file, os.getpid(), threading.get_ident())
+        fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.write(fd, b"[\n")
+            os.close(fd)
+            os.link(tmp_name, self.trace_file)
+        except OSError:
+            pass
+        finally:
+            os.remove(tmp_name)
+
+    def _write(self, events):
+        self._create()
+        payload = "".join(json.dumps(event, default=str) + ",\n" for event in events)
+        fd = os.open(self.trace_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+        try:
+            os.write(fd, payload.encode())
+        finally:
+            os.close(fd)
+
+
+tracer = Tracer()
+metrics = tracer.metrics
+_metrics_files = set()
+
+
+def configure(trace_file=None, process_name=None, metrics_file=None):
+    """
+    Switches tracing on (or off, with trace_file=None) for this process.
+
+    :param trace_file: Chrome trace file to append spans to
+    :param process_name: label shown for this process in the trace viewer
+    :param metrics_file: optional JSON-lines file to append a metrics snapshot to at exit
+    """
+    global tracer
+    if trace_file is not None and trace_file == tracer.trace_file:
+        if process_name and process_name != tracer.process_name:
+            tracer.process_name = process_name
+            tracer._append({"name": "process_name", "ph": "M", "pid": tracer._pid,
+                            "args": {"name": process_name}})
+    else:
+        tracer.flush()
+        tracer = Tracer(trace_file, metrics=metrics, process_name=process_name)
+    if metrics_file is not None and metrics_file not in _metrics_files:
+        _metrics_files.add(metrics_file)
+        atexit.register(metrics.write, metrics_file)
+    return tracer
+
+
+def configure_from_environment(process_name=None):
+    """Enables tracing if MLOF_TRACE (and optionally MLOF_METRICS) is set."""
+    trace_file = os.environ.get(TRACE_ENV)
+    if trace_file:
+        configure(trace_file, process_name=process_name,
+                  metrics_file=os.environ.get(METRICS_ENV))
+    return tracer
+
+
+def span(name, cat="mlof", **args):
+    return tracer.span(name, cat, **args)
+
+
+def instant(name, cat="mlof", **args):
+    tracer.instant(name, cat, **args)
+
+
+def counter(name, value, cat="mlof"):
+    tracer.counter(name, value, cat)
+
+
+def traced(name, cat="mlof"):
+    """
+    Decorator wrapping every call of the function in a span.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracedSerial:
+    """
+    Wraps a serial.Serial so that each command (a write and the read of its
+    reply) shows up as one "serial" span named after the command verb.
+    """
+    def __init__(self, port, label="serial"):
+        self._port = port
+        self._label = label
+        self._pending = None
+
+    def write(self, data):
+        if tracer.enabled:
+            command = data.decode(errors="replace").strip()
+            self._pending = (command, time.perf_counter_ns())
+        metrics.incr(self._label + ".commands")
+        return self._port.write(data)
+
+    def read(self, *args, **kwargs):
+        reply = self._port.read(*args, **kwargs)
+        if self._pending is not None:
+            command, start = self._pending
+            self._pending = None
+            verb = command.split(" ")[0].lower() if command else "?"
+            tracer._complete(self._label + "." + verb, "serial", start, time.perf_counter_ns(),
+                             {"command": command, "reply_bytes": len(reply)})
+        return reply
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+
+atexit.register(lambda: tracer.flush())
+configure_from_environment()
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] trace_file")
+
+    parser.add_option("--doSummary", action="store_true", default=False,
+                      help="print per-span latency statistics for a trace file")
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+def load_trace(trace_file):
+    """
+    Reads a trace file written by one or more Tracers.
+
+    :return: the list of trace events
+    """
+    with open(trace_file) as f:
+        text = f.read().strip()
+    if not text.startswith("["):
+        text = "[" + text
+    text = text.rstrip(",")
+    if not text.endswith("]"):
+        text = text + "]"
+    return json.loads(text)
+
+
+def summarize_trace(trace_file):
+    """
+    Rebuilds a metrics registry from the complete ("X") events of a trace.
+    """
+    registry = MetricsRegistry()
+    for event in load_trace(trace_file):
+        if event.get("ph") == "X":
+            registry.observe(event["name"], event["dur"] / 1e6)
+            registry.incr(event.get("cat", "mlof") + ".spans")
+    return registry
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+
+    if opts.doSummary:
+        for trace_file in args:
+            print(summarize_trace(trace_file).summary())
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+"""
+.. module:: live_view
+    :platform: unix
+    :synopsis: Local web page showing the latest frame of a run while it is acquired.
+
+A small HTTP server pushes a binned, zscaled PNG of the newest frame and its
+quick statistics to any number of browsers with server-sent events. Frames
+come either straight from a converter (LiveViewStage, --doLiveView in
+mlof_stream_convert.py) or from a directory the converters write into
+(--doServe). The page is at http://localhost:<port>/.
+
+Only the newest frame is ever kept. The converter hands it over and returns
+without waiting; one encoder thread turns whatever is newest into a preview;
+each client is sent the newest preview whenever it is ready for one. A slow
+or stalled browser therefore skips frames instead of holding up the
+acquisition, and a burst of frames costs one encode rather than one per frame.
+
+Typical usage:
+
+    python live_view.py --doServe -d /data/2023_05_01/ --port 8765
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import html
+import base64
+import optparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+from astropy.io import fits
+
+from instrumentation import configure_from_environment, span, metrics
+from quicklook import block_reduce, zscale_limits, stretch, encode_png, CAPTION_KEYS
+
+#ADU above which a pixel is counted as saturated in the quick statistics
+SATURATION_LEVEL = 65000
+KEEPALIVE_INTERVAL = 15.0
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%(title)s</title>
+<style>body{font-family:sans-serif;background:#222;color:#ddd}
+img{height:80vh;image-rendering:pixelated;background:#000}td{padding:0 8px}</style></head>
+<body><h3>%(title)s <span id="status">connecting</span></h3>
+<div style="display:flex;gap:16px"><img id="frame"><table id="stats"></table></div>
+<script>
+var source = new EventSource("events");
+source.addEventListener("frame", function (event) {
+    var frame = JSON.parse(event.data);
+    document.getElementById("frame").src = "data:image/png;base64," + frame.png;
+    delete frame.png;
+    var table = document.getElementById("stats");
+    table.replaceChildren();
+    for (var key in frame) {
+        addRow(table, key, frame[key]);
+    }
+    addRow(table, "latency", (Date.now() / 1000 - frame.received).toFixed(2) + " s");
+});
+// - header values are shown as text, never parsed as HTML
+function addRow(table, key, value) {
+    var row = table.insertRow();
+    row.insertCell().textContent = key;
+    row.insertCell().textContent = value;
+}
+source.onopen = function () { document.getElementById("status").textContent = "live"; };
+source.onerror = function () { document.getElementById("status").textContent = "reconnecting"; };
+</script></body></html>
+"""
+
+
+def frame_stats(img):
+    """
+
+    :return: dict of quick statistics of a frame; the median is of every 4th pixel along both axes
+    """
+    img = np.asarray(img)
+    return {'min': int(img.min()),
+            'max': int(img.max()),
+            'mean': round(float(img.mean()), 2),
+            'median': float(np.median(img[::4, ::4])),
+            'std': round(float(img.std()), 2),
+            'saturated': int(np.count_nonzero(img >= SATURATION_LEVEL))}
+
+
+class LatestFrame:
+    """
+    Holds the newest frame and the newest encoded preview, each replacing its predecessor.
+
+    publish() never blocks on the encoder or on clients. Clients wait for a
+    preview newer than the last one they were sent.
+    """
+    def __init__(self, factor=4):
+        self.factor = factor
+        self._condition = threading.Condition()
+        self._pending = None
+        self._preview = None
+        self.sequence = 0
+        self.n_published = 0
+        self.n_dropped = 0
+        self._closed = False
+        self._encoder = threading.Thread(target=self._encode_loop, name='live_view_encoder', daemon=True)
+        self._encoder.start()
+
+    def publish(self, img, header, file_name):
+        """
+        Hands a frame over for display. The frame is copied, so the caller may reuse it straight away.
+        """
+        frame = (np.array(img, copy=True), header, file_name, time.time())
+        with self._condition:
+            if self._pending is not None:
+                self.n_dropped += 1
+                metrics.incr("live_view.dropped")
+            self._pending = frame
+            self.n_published += 1
+            self._condition.notify_all()
+
+    def _encode_loop(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                frame, self._pending = self._pending, None
+            try:
+                preview = self._encode(*frame)
+            except Exception as error:
+                print('Live view could not show %s: %s' % (frame[2], error))
+                continue
+            with self._condition:
+                self.sequence += 1
+                preview['sequence'] = self.sequence
+                self._preview = json.dumps(preview)
+                self._condition.notify_all()
+
+    def _encode(self, img, header, file_name, received):
+        with span("live_view.encode", cat="preview", file=file_name):
+            start = time.perf_counter()
+            reduced = block_reduce(img, self.factor)
+            z1, z2 = zscale_limits(reduced)
+            preview = {'file': os.path.basename(file_name), 'received': received}
+            for key in CAPTION_KEYS:
+                if key in header:
+                    preview[key] = header[key]
+            preview.update(frame_stats(img))
+            preview['z1'], preview['z2'] = round(z1, 1), round(z2, 1)
+            preview['png'] = base64.b64encode(encode_png(stretch(reduced, z1, z2))).decode('ascii')
+            metrics.observe("live_view.encode", time.perf_counter() - start)
+        return preview
+
+    def wait_for(self, after, timeout):
+        """
+
+        :param after: sequence number of the last preview the client was sent
+        :return: (sequence number, JSON text) of the newest preview, or (after, None) on timeout or close
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.sequence > after or self._closed, timeout)
+            if self.sequence > after and not self._closed:
+                return self.sequence, self._preview
+            return after, None
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._encoder.join()
+
+
+class LiveViewHandler(BaseHTTPRequestHandler):
+    """
+    Serves the page at /, the event stream at /events and the newest preview as JSON at /latest.
+    """
+    def do_GET(self):
+        if self.path in ['/', '/index.html']:
+            self._send(200, 'text/html; charset=utf-8', (PAGE % {'title': html.escape(self.server.title)}).encode('utf-8'))
+        elif self.path == '/latest':
+            sequence, preview = self.server.latest.wait_for(0, 0)
+            if preview is None:
+                self._send(204, 'application/json', b'')
+            else:
+                self._send(200, 'application/json', preview.encode('utf-8'))
+        elif self.path == '/events':
+            self._stream()
+        else:
+            self._send(404, 'text/plain', b'not found\n')
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        # a client that stops reading is dropped rather than left holding a thread forever
+        self.connection.settimeout(self.server.client_timeout)
+        metrics.incr("live_view.clients")
+        sent = 0
+        try:
+            while not self.server.latest.closed:
+                sequence, preview = self.server.latest.wait_for(sent, KEEPALIVE_INTERVAL)
+                if preview is None:
+                    self.wfile.write(b': keepalive\n\n')
+                else:
+                    self.wfile.write(('event: frame\nid: %d\ndata: %s\n\n' % (sequence, preview)).encode('utf-8'))
+                    metrics.incr("live_view.sent")
+                    sent = sequence
+                self.wfile.flush()
+        except (OSError, ValueError):
+            # disconnected, timed out, or the server is shutting down
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LiveViewServer:
+    """
+    Live-view HTTP server running in a background thread.
+    """
+    def __init__(self, port=8765, host='localhost', factor=4, title='Live view', client_timeout=10.0):
+        """
+
+        :param host: interface to listen on; localhost keeps the page on this machine
+        :param factor: block-reduction factor of the previews
+        :param client_timeout: seconds a client may take to accept one event before it is dropped
+        """
+        self.latest = LatestFrame(factor=factor)
+        self._server = ThreadingHTTPServer((host, port), LiveViewHandler)
+        self._server.daemon_threads = True
+        self._server.latest = self.latest
+        self._server.title = title
+        self._server.client_timeout = client_timeout
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='live_view', daemon=True)
+        self._thread.start()
+        print('Live view at http://%s:%d/' % (host, self.port))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def publish(self, img, header, file_name):
+        self.latest.publish(img, header, file_name)
+
+    def close(self):
+        self.latest.close()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class LiveViewStage:
+    """
+    Conversion stage that shows every frame it is given on a live-view server.
+    """
+    def __init__(self, server):
+        self.server = server
+
+    def __call__(self, img, header, target_file):
+        self.server.publish(img, header, target_file)
+
+
+def newest_files(directory, pattern, seen):
+    """
+
+    :return: FITS files matching pattern in directory that are not in seen, oldest first.
+             Temporary files of the atomic writers and derived products are skipped.
+    """
+    new_files = []
+    for file_name in glob.glob(os.path.join(directory, pattern)):
+        base = os.path.basename(file_name)
+        if file_name in seen or base.startswith('.') or base.endswith(('_spec.fits', '_clean.fits')):
+            continue
+        try:
+            new_files.append((os.path.getmtime(file_name), file_name))
+        except OSError:
+            continue
+    return [file_name for mtime, file_name in sorted(new_files)]
+
+
+def watch_directory(server, directory, pattern='*.fits', poll_interval=0.2, idle_timeout=None):
+    """
+    Shows the newest FITS file written to directory until interrupted (or idle for idle_timeout seconds).
+    Files already there when watching starts are not shown.
+    """
+    seen = set(glob.glob(os.path.join(directory, pattern)))
+    last_new = time.time()
+    while idle_timeout is None or time.time() - last_new < idle_timeout:
+        new_files = newest_files(directory, pattern, seen)
+        seen.update(new_files)
+        if new_files:
+            last_new = time.time()
+            # only the newest is worth reading; the rest would be dropped anyway
+            try:
+                with fits.open(new_files[-1]) as hdul:
+                    server.publish(hdul[0].data, hdul[0].header, new_files[-1])
+            except (OSError, TypeError, ValueError) as error:
+                print('Could not read %s: %s' % (new_files[-1], error))
+        time.sleep(poll_interval)
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser()
+
+    parser.add_option("-d","--directory", default="./", help="directory the converters write FITS files into")
+    parser.add_option("--pattern", default="*.fits")
+    parser.add_option("--port", type=int, default=8765)
+    parser.add_option("--host", default="localhost", help="interface to listen on")
+    parser.add_option("-f","--factor", type=int, default=4, help="block-reduction factor of the previews")
+    parser.add_option("--poll_interval", type=float, default=0.2, help="seconds between checks for new files")
+    parser.add_option("--idle_timeout", type=float, default=None, help="stop after this many seconds without a new file")
+    parser.add_option("--doServe", action="store_true", default=False)
+
+    opts, args = parser.parse_args()
+
+    return opts
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    args = parse_commandline()
+    configure_from_environment(process_name="live_view")
+
+    if args.doServe:
+        if not os.path.isdir(args.directory):
+            print('%s is not a directory' % args.directory)
+            sys.exit(1)
+        with LiveViewServer(port=args.port, host=args.host, factor=args.factor,
+                            title=os.path.basename(os.path.abspath(args.directory))) as server:
+            try:
+                watch_directory(server, args.directory, args.pattern, args.poll_interval, args.idle_timeout)
+            except KeyboardInterrupt:
+                pass
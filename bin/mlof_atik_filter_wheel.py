@@ -13,6 +13,7 @@ import optparse
 import numpy as np
 import os
 from atik_filter_wheel import AtikFilterWheel as FilterWheel
+from instrumentation import configure_from_environment
 
 
 def parse_commandline():
@@ -49,6 +50,7 @@ if __name__ == "__main__":
 
     # Parse command line
     opts = parse_commandline()
+    configure_from_environment(process_name="mlof_atik_filter_wheel")
 
     if opts.doPosition:
         main(runtype="position", filter=opts.filter)
@@ -6,6 +6,20 @@
     :synopsis: module for communicating with the filter wheel instrument of cbp
 
 .. codeauthor:: Michael Coughlin, Eric Coughlin
+
+The CenterLine wheel holds a mask wheel and a filter wheel of 5 positions
+each, which the FLI driver addresses as one slot, 5 * mask + filter.
+visit() steps through a list of (mask, filter) targets: it skips targets the
+wheel is already at, can reorder the targets to go to the nearest one next,
+times every move and reads the slot back once to confirm it.
+stats() gives the move latencies.
+
+With TESTENVIRONMENT set, a simulated wheel (MockFilterWheel) stands in for
+the FLI one; a wheel can also be handed in, FilterWheel(device=MockFilterWheel()).
+
+Typical usage:
+
+    python mlof_fli_filter_wheel.py --doBatch --targets 0:0,0:1,1:0,1:1 --doReorder
 """
 
 import serial, sys, time, glob, struct
@@ -13,28 +27,122 @@ import optparse
 import numpy as np
 import os
 if 'TESTENVIRONMENT' in os.environ:
-    import mock
-    sys.modules['FLI'] = mock.Mock()
+    FLI = None
 else:
     import FLI
 import logging
 
+from instrumentation import configure_from_environment, span, metrics, Histogram
+
+N_POSITIONS = 5
+
+
+def slot_of(mask, filter):
+    return N_POSITIONS * mask + filter
+
+
+def rotation_steps(slot_from, slot_to):
+    """
+
+    :return: positions the mask and filter wheels turn through between two slots, whichever way is shorter
+    """
+    steps = 0
+    for wheel_from, wheel_to in zip(divmod(slot_from, N_POSITIONS), divmod(slot_to, N_POSITIONS)):
+        distance = abs(wheel_from - wheel_to)
+        steps += min(distance, N_POSITIONS - distance)
+    return steps
+
+
+def plan_moves(slots, start=None, reorder=False):
+    """
+    Orders slots for a batch of moves.
+
+    :param start: slot the wheel is at, if known
+    :param reorder: visit every slot once, always going to the nearest one left next;
+                    otherwise keep the order and only drop repeats in a row
+    :return: list of slots to visit
+    """
+    if not reorder:
+        plan = []
+        for slot in slots:
+            if not plan or plan[-1] != slot:
+                plan.append(slot)
+        return plan
+    left = list(dict.fromkeys(slots))
+    plan = []
+    current = start
+    while left:
+        if current is None:
+            current = left[0]
+        else:
+            current = min(left, key=lambda slot: rotation_steps(current, slot))
+        left.remove(current)
+        plan.append(current)
+    return plan
+
+
+class MockFilterWheel:
+    """
+    Simulated CenterLine wheel with the calls FilterWheel makes of an FLI USBFilterWheel.
+    """
+    model = b"CenterLine Filter Wheel"
+
+    def __init__(self, step_time=0.01, slot=0):
+        """
+
+        :param step_time: [s] taken per position either wheel turns through
+        """
+        self.step_time = step_time
+        self.slot = slot
+        self.n_set = 0
+        self.n_get = 0
+
+    def set_filter_pos(self, slot):
+        if not 0 <= slot < N_POSITIONS ** 2:
+            raise ValueError("Slot must be 0-%d" % (N_POSITIONS ** 2 - 1))
+        self.n_set += 1
+        time.sleep(self.step_time * rotation_steps(self.slot, slot))
+        self.slot = slot
+
+    def get_filter_pos(self):
+        self.n_get += 1
+        return self.slot
+
+    def get_filter_count(self):
+        return N_POSITIONS ** 2
+
 
 class FilterWheel:
     """
     This is the class for communicating with the Filter Wheel.
     """
-    def __init__(self):
+    def __init__(self, device=None):
+        """
+
+        :param device: wheel to use instead of finding the FLI one, e.g. a MockFilterWheel
+        """
         self.status = None
-        self.center_line_filter_wheel = self.initialize_connection()
+        self.center_line_filter_wheel = self.initialize_connection(device)
         self.mask = None
         self.filter = None
+        # slot the wheel was last confirmed at, so that moves to it can be skipped
+        self.slot = None
+        self.moves = []
+        self.n_skipped = 0
+        self.latency = Histogram()
 
-    def initialize_connection(self):
+    def initialize_connection(self, device=None):
         """
 
+        :param device: wheel to connect to, if not the FLI one
         :return: returns the connection to the Filter Wheel.
         """
+        if device is not None:
+            self.status = "Connected"
+            return device
+        if FLI is None:
+            self.status = "Connected"
+            return MockFilterWheel()
         print(FLI.filter_wheel.USBFilterWheel.find_devices())
         try:
             fws = FLI.filter_wheel.USBFilterWheel.find_devices()
@@ -47,14 +155,20 @@ class FilterWheel:
             logging.exception(e)
             self.status = "not connected"
 
-    def error_raised(self):
+    def error_raised(self, mask=None, filter=None):
         """
 
+        :param mask: mask position to check instead of self.mask
+        :param filter: filter position to check instead of self.filter
         :return: either raises an exception if parameters out of bounds or returns false to continue the program
         """
-        if self.mask > 4 or self.mask < 0:
+        if mask is None:
+            mask = self.mask
+        if filter is None:
+            filter = self.filter
+        if mask > 4 or mask < 0:
             raise Exception("Mask position must be integer 0-4")
-        elif self.filter > 4 or self.filter < 0:
+        elif filter > 4 or filter < 0:
             raise Exception("Filter position must be integer 0-4")
         return False
 
@@ -69,22 +183,96 @@ class FilterWheel:
             self.mask = mask
             self.filter = filter
             if not self.error_raised():
-                position = 5 * self.mask + self.filter
-                self.center_line_filter_wheel.set_filter_pos(position)
-                pos = self.center_line_filter_wheel.get_filter_pos()
+                self.move_to(slot_of(self.mask, self.filter))
         else:
             pass
 
+    def read_slot(self):
+        """
+
+        :return: the slot the wheel is at, read from the device and cached
+        """
+        with span("fli.get_filter_pos", cat="device"):
+            self.slot = self.center_line_filter_wheel.get_filter_pos()
+        return self.slot
+
+    def move_to(self, slot):
+        """
+        Moves to a slot unless the wheel is already there, and reads the slot back once to confirm the move.
+
+        set_filter_pos only returns once the wheel has stopped, so the one read back is enough.
+
+        :return: the record of the move, or None if it was skipped
+        """
+        if self.slot is None:
+            self.read_slot()
+        if slot == self.slot:
+            self.n_skipped += 1
+            metrics.incr("fli.skipped")
+            return None
+        slot_from = self.slot
+        start = time.perf_counter()
+        # forget the slot until the move is confirmed, in case it fails part way
+        self.slot = None
+        with span("fli.set_filter_pos", cat="device", position=slot):
+            self.center_line_filter_wheel.set_filter_pos(slot)
+        moved = time.perf_counter()
+        if self.read_slot() != slot:
+            raise Exception("Filter wheel is at slot %s after moving to slot %d" % (self.slot, slot))
+        end = time.perf_counter()
+        move = {'from': slot_from,
+                'to': slot,
+                'steps': rotation_steps(slot_from, slot),
+                'move_time': moved - start,
+                'confirm_time': end - moved,
+                'latency': end - start}
+        self.moves.append(move)
+        self.latency.observe(move['latency'])
+        metrics.observe("fli.move", move['latency'])
+        return move
+
+    def visit(self, targets, reorder=False):
+        """
+        Moves through a batch of (mask, filter) targets, yielding each once the wheel is there.
+
+        :param targets: list of (mask, filter)
+        :param reorder: visit each target once, always going to the nearest one left next
+        :return: generator of (mask, filter)
+        """
+        if self.status == "not connected":
+            return
+        for mask, filter in targets:
+            self.error_raised(mask, filter)
+        if self.slot is None:
+            self.read_slot()
+        for slot in plan_moves([slot_of(mask, filter) for mask, filter in targets], start=self.slot, reorder=reorder):
+            self.move_to(slot)
+            self.mask, self.filter = divmod(slot, N_POSITIONS)
+            yield self.mask, self.filter
+
+    def stats(self):
+        """
+
+        :return: number of moves made and skipped, the latency histogram of the moves,
+                 and their mean latency [s] by number of positions turned through
+        """
+        by_steps = {}
+        for move in self.moves:
+            by_steps.setdefault(move['steps'], []).append(move['latency'])
+        return {'moves': len(self.moves),
+                'skipped': self.n_skipped,
+                'latency': self.latency.as_dict(),
+                'latency_by_steps': dict((steps, float(np.mean(latencies))) for steps, latencies in sorted(by_steps.items()))}
+
     def get_position(self):
         """
 
         :return: returns the current mask and filter values of the Filter Wheel.
         """
         if self.status != "not connected":
-            pos = self.center_line_filter_wheel.get_filter_pos()
+            pos = self.read_slot()
 
-            self.mask = pos / 5
-            self.filter = np.mod(pos, 5)
+            self.mask, self.filter = divmod(pos, N_POSITIONS)
 
             print("Mask:{0} Filter:{1}".format(self.mask, self.filter))
             return self.mask, self.filter
@@ -96,6 +284,9 @@ class FilterWheel:
 
         :return: changes the status of the Filter Wheel depending on location of device in kernel.
         """
+        if FLI is None:
+            self.status = "Connected"
+            return
         try:
             fws = FLI.filter_wheel.USBFilterWheel.find_devices()
             for fw in fws:
@@ -114,15 +305,18 @@ def parse_commandline():
 
     parser.add_option("-m","--mask",default=0,type=int)
     parser.add_option("-f","--filter",default=0,type=int)
+    parser.add_option("-t","--targets",default="",help="comma separated mask:filter targets for --doBatch")
     parser.add_option("--doPosition", action="store_true",default=False)
     parser.add_option("--doGetPosition", action="store_true",default=False)
+    parser.add_option("--doBatch", action="store_true",default=False, help="move through --targets in turn and print the move latencies")
+    parser.add_option("--doReorder", action="store_true",default=False, help="with --doBatch, visit each target once, nearest first")
 
     opts, args = parser.parse_args()
 
     return opts
 
 
-def main(runtype = "position", mask = 0, filter = 0):
+def main(runtype = "position", mask = 0, filter = 0, targets = [], reorder = False):
 
     fws = FilterWheel()
 
@@ -132,12 +326,25 @@ def main(runtype = "position", mask = 0, filter = 0):
     elif runtype == "getposition":
         fws.get_position()
 
+    elif runtype == "batch":
+        for mask, filter in fws.visit(targets, reorder=reorder):
+            print("Mask:{0} Filter:{1}".format(mask, filter))
+        stats = fws.stats()
+        print("%d move(s), %d skipped; latency mean %.3f s, max %.3f s" %
+              (stats["moves"], stats["skipped"], stats["latency"]["mean"], stats["latency"]["max"]))
+        for steps, latency in stats["latency_by_steps"].items():
+            print("  %d position(s): %.3f s" % (steps, latency))
+
 if __name__ == "__main__":
 
     # Parse command line
     opts = parse_commandline()
+    configure_from_environment(process_name="mlof_fli_filter_wheel")
 
     if opts.doPosition:
         main(runtype="position", mask=opts.mask, filter=opts.filter)
     if opts.doGetPosition:
         main(runtype="getposition")
+    if opts.doBatch:
+        targets = [tuple(int(value) for value in target.split(":")) for target in opts.targets.split(",") if target]
+        main(runtype="batch", targets=targets, reorder=opts.doReorder)
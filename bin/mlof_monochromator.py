@@ -16,6 +16,8 @@ import string
 import numpy as np
 import optparse
 
+from instrumentation import TracedSerial, configure_from_environment, span
+
 
 class Monochromater:
     def __init__(self, port_name="/dev/ttyUSB0"):
@@ -29,8 +31,9 @@ class Monochromater:
         """
         try:
             global m
-            m = serial.Serial(port_name)
-            m.timeout = 2
+            port = serial.Serial(port_name)
+            port.timeout = 2
+            m = TracedSerial(port, label="mono")
             # m.rtscts = False
             # m.dsrdtr = False
             cmd = "wave?" + "\r\n"
@@ -180,12 +183,14 @@ class Monochromater:
     def scan(self, start, end, stepsize, sleeptime, filename='test.txt'):
         """Scans from start (nm) to end (nm) in steps of stepsize (nm). Sleeps for sleeptime seconds at each wavelength. Writes list of wavelengths to file filename"""
         if self.status != "not connected":
-            self.gowave(start)
+            with span("mono.gowave", cat="device", wave=start):
+                self.gowave(start)
             time.sleep(5)
             wave = start
             while wave <= end:
                 time.sleep(sleeptime)
-                self.gowave(wave + stepsize)
+                with span("mono.gowave", cat="device", wave=wave + stepsize):
+                    self.gowave(wave + stepsize)
                 wave = wave + stepsize
             result = "out.monochrom: Finished scanning from " + str(start) + " to " + str(end) + "nm."
             return result
@@ -261,9 +266,10 @@ class Monochromater:
 
     def get_mono(self):
         if self.status != "not connected":
-            wave = self.askwave()
-            grating = self.askgrat()
-            shutter = self.askshutter()
+            with span("mono.get_mono", cat="device"):
+                wave = self.askwave()
+                grating = self.askgrat()
+                shutter = self.askshutter()
             try:
                 wave = float(wave)
             except:
@@ -325,6 +331,7 @@ if __name__ == "__main__":
 
     # Parse command line
     opts = parse_commandline()
+    configure_from_environment(process_name="mlof_monochromator")
 
     if opts.doMonoFilter:
         main(runtype="monofilter", val=opts.filter, monochromator=opts.monochromator)
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+"""
+.. module:: mlof_stream_convert
+    :platform: unix
+    :synopsis: Converts a growing PIXIS raw file (or pipe) to FITS frame by frame.
+
+configure_sasha run with the 'stream' argument takes every readout of a
+kinetic series in one acquisition and appends each one to a single raw file.
+This script follows that file, like tail -f, and writes a FITS image as soon
+as each complete frame has landed. Only one frame buffer is ever held, so an
+hour-long series converts in constant memory.
+
+Typical usage, acquiring and converting 3600 one second frames:
+
+    python mlof_stream_convert.py --doAcquire -e 1000 -N 3600 -n sky \
+        -i /data/2023_05_01/sky.raw -o /data/2023_05_01/
+
+or following a file that something else is writing:
+
+    python mlof_stream_convert.py -i sky.raw -o /data/2023_05_01/ --idle_timeout 30
+"""
+
+import os
+import stat
+import sys
+import time
+import optparse
+import subprocess
+
+import numpy as np
+from astropy.time import Time
+
+from pixis_raw import FrameGeometry, BYTE_ORDERS, base_header, decode_readouts, choose_byte_order
+from instrumentation import configure_from_environment, span, metrics
+from fits_writer import FitsWriter, DURABILITY_POLICIES, write_fits_atomic
+from pixel_stats import PixelStatsAccumulator
+from spectral_extraction import ExtractionStage, EXTRACTION_METHODS
+from wavelength_calibration import calibration_header_elems
+from temperature_telemetry import TemperatureSeries, trace_header_elems, trace_hdu, series_file_name
+from quicklook import PreviewStage
+from live_view import LiveViewServer, LiveViewStage
+from exposure_timing import TimingSeries, timing_file_name, timing_header_elems, log_frame
+
+
+def follow_raw_frames(source_file, frame_bytes, poll_interval=0.05, idle_timeout=None, is_done=None):
+    """
+    Yields each complete frame of a raw file as it is written.
+
+    The same buffer is reused for every frame, so a yielded frame is only
+    valid until the next one is requested.
+
+    :param source_file: raw file or named pipe to read
+    :param frame_bytes: size of one frame, in bytes
+    :param poll_interval: seconds to sleep when no new data has arrived
+    :param idle_timeout: stop after this many seconds without new data (None waits forever)
+    :param is_done: optional callable; once it returns True the file is drained and iteration stops
+    :return: generator of memoryviews, each exactly one frame long
+    """
+    buffer = bytearray(frame_bytes)
+    view = memoryview(buffer)
+
+    last_data = time.monotonic()
+    while not os.path.exists(source_file):
+        if is_done is not None and is_done():
+            return
+        if idle_timeout is not None and time.monotonic() - last_data > idle_timeout:
+            return
+        time.sleep(poll_interval)
+
+    is_pipe = stat.S_ISFIFO(os.stat(source_file).st_mode)
+    with open(source_file, 'rb', buffering=0) as f:
+        filled = 0
+        last_data = time.monotonic()
+        while True:
+            # evaluated before reading, so that data written before the
+            # writer finished is still drained
+            finished = is_done is not None and is_done()
+            n_read = f.readinto(view[filled:])
+            if n_read:
+                filled += n_read
+                last_data = time.monotonic()
+                if filled == frame_bytes:
+                    yield view
+                    filled = 0
+                continue
+            if is_pipe or finished:
+                break
+            if idle_timeout is not None and time.monotonic() - last_data > idle_timeout:
+                break
+            time.sleep(poll_interval)
+
+    if filled:
+        print('Ignoring incomplete trailing frame of %d bytes in %s' % (filled, source_file))
+
+
+def BuildStreamHeader(args, geometry, temperature=None):
+    """
+
+    :param geometry: FrameGeometry of the readouts, which the wavelength solution is rescaled to
+    :param temperature: [C] sensor temperature at the start of the series, if known
+    :return: list of [key, value, comment] header elements shared by every frame of the series
+    """
+    exp_time = float(args.exposure_time)
+    if exp_time < 1:
+        obs_type = 'BIAS'
+    elif args.shutter == 1:
+        obs_type = 'DARK'
+    else:
+        obs_type = 'NORMAL'
+    gain_dict = {0:4, 1:2, 2:1}
+    readnoise_dict = {0:3.0, 1:9.0}
+    readout_speed_dict = {0:1.0, 1:0.2}
+    header_elems = [['TARGET', args.name, "target of exposure"],
+                    ['EXPTIME', exp_time / 1000.0, "[s] exposure time"],
+                    ['INSTRUME', 'MLOF', 'Instrument in use'],
+                    ['OBSTYPE', obs_type, "Type of exposure (BIAS, DARK, or NORMAL) "],
+                    ['GAIN', gain_dict[args.gain], '[e-/ADU] PIXIS detector gain'],
+                    ['RDSPEED', readout_speed_dict[args.readout_speed], "[MHz] PIXIS readout speed setting "],
+                    ['RDNOISE', readnoise_dict[args.readout_speed], '[e-] PIXIS typical rms readnoise'],
+                    ]
+    if args.grating is not None:
+        header_elems.append(['GRATING', args.grating, 'grating in use'])
+    if args.focus_pos is not None:
+        header_elems.append(['FOCUSPOS', args.focus_pos, 'Position of collimating lens (mm)'])
+    if args.wavelength is not None:
+        header_elems.append(['MONOWAVE', args.wavelength, '[nm] monochromator wavelength'])
+    if temperature is not None:
+        header_elems.append(['TEMP', temperature, '[C] temperature of PIXIS CCD at start of series'])
+    if args.doWavelengthCalibration:
+        # the solution is looked up once for the run; frames are not refitted
+        header_elems = header_elems + calibration_header_elems(header_elems, geometry)
+    return header_elems
+
+
+def stream_convert(source_file, output_dir, prefix, header_elems=[], n_frames=None,
+                   geometry=None, big_endian=None,
+                   poll_interval=0.05, idle_timeout=None, is_done=None, writer=None, stages=[],
+                   temperature_series=None, timing_series=None):
+    """
+    Converts every frame of a growing raw file to prefix_<i>.fits in output_dir.
+
+    :param n_frames: stop after this many frames (None converts until the source ends)
+    :param geometry: FrameGeometry of the readouts; defaults to the full unbinned sensor
+    :param big_endian: 0 or 1 to force the byte order; None picks it for every frame
+    :param writer: FitsWriter to hand frames to; by default each frame is written before the next is read.
+                   With a writer whose target_dirs are set, output_dir is ignored.
+    :param stages: callables run as stage(img, header, target_file) on every converted frame
+    :param temperature_series: TemperatureSeries that configure_sasha is appending to. When converting
+                               live, each frame gets the samples taken since the previous frame
+                               arrived, which is its exposure window to within the polling interval.
+    :param timing_series: TimingSeries that configure_sasha is appending to; each frame gets the
+                          timestamps of its readout and is logged in timing.jsonl once written
+    :return: the number of frames converted
+    """
+    if geometry is None:
+        geometry = FrameGeometry()
+    header = base_header(geometry.roi_shape(), geometry.n_unsigned_bytes)
+    for header_elem in geometry.header_elems() + header_elems:
+        header[header_elem[0]] = (header_elem[1], header_elem[2])
+
+    n_converted = 0
+    window_start = time.time()
+    for frame in follow_raw_frames(source_file, geometry.readout_stride, poll_interval=poll_interval,
+                                   idle_timeout=idle_timeout, is_done=is_done):
+        with span("stream.frame", cat="conversion", frame=n_converted):
+            img, byte_order_elem = choose_byte_order(decode_readouts(frame, geometry, n_readouts=1)[0], big_endian)
+            frame_header = header.copy()
+            frame_header[byte_order_elem[0]] = (byte_order_elem[1], byte_order_elem[2])
+            frame_header['FRAMENUM'] = (n_converted, 'index of frame within the readout series')
+            frame_header['CONVTIME'] = (Time.now().isot, 'time the frame was converted (UTC)')
+            extensions = []
+            if temperature_series is not None:
+                window_end = time.time()
+                temperature_series.update()
+                trace = temperature_series.window(window_start, window_end)
+                for header_elem in trace_header_elems(*trace):
+                    frame_header[header_elem[0]] = (header_elem[1], header_elem[2])
+                extensions = [trace_hdu(*trace)]
+                window_start = window_end
+            timing = None
+            if timing_series is not None:
+                timing_series.update()
+                timing = timing_series.frame(n_converted + 1)
+                for header_elem in timing_header_elems(timing):
+                    frame_header[header_elem[0]] = (header_elem[1], header_elem[2])
+            target_file = prefix + '_' + str(n_converted) + '.fits'
+            if writer is not None and writer.target_dirs:
+                target_file = writer.resolve(target_file)
+            else:
+                target_file = os.path.join(output_dir, target_file)
+            for stage in stages:
+                stage(img, frame_header, target_file)
+            if writer is not None:
+                future = writer.submit(img, frame_header, target_file, extensions)
+                if timing is not None:
+                    def log_written(future, timing=timing):
+                        if future.exception() is None:
+                            log_frame(future.result()[0], timing, time.time())
+                    future.add_done_callback(log_written)
+            else:
+                write_fits_atomic(img, frame_header, target_file, extensions=extensions)
+                log_frame(target_file, timing, time.time())
+        metrics.incr("stream.frames")
+        n_converted += 1
+        print('Converted frame %d to %s' % (n_converted, target_file))
+        if n_frames is not None and n_converted >= n_frames:
+            break
+    return n_converted
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser()
+
+    parser.add_option("-i","--input_file", help="raw file (or named pipe) being written by configure_sasha")
+    parser.add_option("-o","--output_dir", default="./")
+    parser.add_option("-p","--prefix", help="prefix of the FITS files; defaults to the raw file name")
+    parser.add_option("-N","--n_frames", type=int, help="number of frames in the series", default=None)
+    parser.add_option("-e","--exposure_time", type=int, help="exposure time, in ms", default=0)
+    parser.add_option("-n","--name", type=str, help="name of target, as it will appear in Fits header", default="UnknownTarget")
+    parser.add_option("-s","--shutter", type=int, help="should shutter act normally, opening during exposure (0), or stay closed at all times (1)", default=0)
+    parser.add_option("-g","--gain", type=int, help="gain key 0, 1 or 2 (4, 2 or 1 e-/ADU)", default=0)
+    parser.add_option("-r","--readout_speed", type=int, help="the readout speed.  Can be faster and noiser (1) or slower and less noisy (0).", default=0)
+    parser.add_option("--byte_order", default="auto", help="%s; auto picks it for every frame" % ", ".join(BYTE_ORDERS))
+    parser.add_option("--big_endian", action="store_true", default=False, help="same as --byte_order big")
+    parser.add_option("--geometry_file", help="readout geometry written by configure_sasha; defaults to <input>_geometry.txt")
+    parser.add_option("--roi", type=str, default=None, help="with --doAcquire, read out x,width,x_binning,y,height,y_binning only")
+    parser.add_option("--n_writers", type=int, default=0, help="write FITS files from this many background writers (0 writes inline)")
+    parser.add_option("--durability", default="batch", help="fsync policy of the background writers: %s" % ", ".join(DURABILITY_POLICIES))
+    parser.add_option("--fsync_every", type=int, default=16, help="files per fsync with --durability batch")
+    parser.add_option("--target_dirs", default=None, help="comma separated directories to spread frames over (overrides -o)")
+    parser.add_option("--grating", type=int, default=None, help="grating in use, recorded as GRATING")
+    parser.add_option("--focus_pos", type=float, default=None, help="collimator focus position in mm, recorded as FOCUSPOS")
+    parser.add_option("--wavelength", type=float, default=None, help="monochromator wavelength in nm, recorded as MONOWAVE")
+    parser.add_option("--doExtract", action="store_true", default=False, help="write the 1-D spectrum of every frame next to it")
+    parser.add_option("--doWavelengthCalibration", action="store_true", default=False,
+                      help="add the cached wavelength solution for this grating and focus position as WCS keywords")
+    parser.add_option("--extraction_method", default="optimal", help="%s" % ", ".join(EXTRACTION_METHODS))
+    parser.add_option("--doPreview", action="store_true", default=False,
+                      help="write a zscaled PNG thumbnail of every frame and an index.html contact sheet")
+    parser.add_option("--preview_dir", default=None, help="where --doPreview writes; defaults to <output_dir>/previews")
+    parser.add_option("--preview_factor", type=int, default=4, help="block-reduction factor of the thumbnails")
+    parser.add_option("--doLiveView", action="store_true", default=False,
+                      help="show every frame, as it is converted, on a local web page")
+    parser.add_option("--live_view_port", type=int, default=8765)
+    parser.add_option("--stats_file", default=None, help="accumulate per-pixel statistics and write them, with a bad-pixel mask, to this FITS file")
+    parser.add_option("--poll_interval", type=float, default=0.05, help="seconds between checks for new data")
+    parser.add_option("--idle_timeout", type=float, default=None, help="stop after this many seconds without new data")
+
+    parser.add_option("--doAcquire", action="store_true", default=False,
+                      help="run configure_sasha in stream mode and convert while it acquires")
+    parser.add_option("--doTemperatureLock", action="store_true", default=False)
+    parser.add_option("--telemetry_period", type=int, default=None,
+                      help="with --doAcquire, ms between detector temperature samples (0 turns them off)")
+
+    opts, args = parser.parse_args()
+
+    return opts
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    args = parse_commandline()
+    configure_from_environment(process_name="mlof_stream_convert")
+
+    if args.input_file is None:
+        print('An input raw file (-i) is required')
+        sys.exit(1)
+
+    prefix = args.prefix
+    if prefix is None:
+        prefix = os.path.splitext(os.path.basename(args.input_file))[0]
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    # the geometry is written when the camera parameters are committed, before any readout
+    geometry_file = args.geometry_file
+    if geometry_file is None:
+        geometry_file = args.input_file.replace(".raw", "") + "_geometry.txt"
+
+    is_done = None
+    process = None
+    if args.doAcquire:
+        if args.n_frames is None:
+            print('--doAcquire needs the number of frames (-N)')
+            sys.exit(1)
+        configure_sasha = subprocess.check_output(["which", "configure_sasha"]).decode().replace("\n","")
+        filename = args.input_file.replace(".raw", "")
+        for stale_file in [args.input_file, geometry_file, series_file_name(filename), timing_file_name(filename)]:
+            if os.path.exists(stale_file):
+                os.remove(stale_file)
+        command = [configure_sasha, str(args.exposure_time), str(args.n_frames), str(args.shutter),
+                   str(args.gain), str(args.readout_speed), filename, filename, "stream"]
+        if args.doTemperatureLock:
+            command.append("lock")
+        if args.roi is not None:
+            command.append("roi=" + args.roi)
+        if args.telemetry_period is not None:
+            command.append("telemetry=%d" % args.telemetry_period)
+        process = subprocess.Popen(command)
+        is_done = lambda: process.poll() is not None
+
+    if process is not None:
+        while not os.path.exists(geometry_file) and not is_done():
+            time.sleep(args.poll_interval)
+    geometry = FrameGeometry.from_file_or_default(geometry_file)
+
+    # only a live acquisition tells which temperature samples belong to which frame
+    temperature_series = None
+    if process is not None and args.telemetry_period != 0:
+        temperature_series = TemperatureSeries(series_file_name(args.input_file.replace(".raw", "")))
+    # the wavelength solution is looked up at the first temperature sample, which configure_sasha
+    # takes as soon as its telemetry starts
+    start_temperature = None
+    if temperature_series is not None and args.doWavelengthCalibration:
+        deadline = time.monotonic() + 5.0
+        while not temperature_series.update() and not len(temperature_series) and not is_done() and time.monotonic() < deadline:
+            time.sleep(args.poll_interval)
+        if len(temperature_series):
+            start_temperature = float(temperature_series.window(-np.inf, np.inf)[1][0])
+
+    timing_series = None
+    if process is not None:
+        timing_series = TimingSeries(timing_file_name(args.input_file.replace(".raw", "")))
+
+    writer = None
+    if args.n_writers > 0:
+        target_dirs = args.target_dirs.split(",") if args.target_dirs else None
+        writer = FitsWriter(n_workers=args.n_writers, durability=args.durability,
+                            fsync_every=args.fsync_every, target_dirs=target_dirs)
+
+    stages = []
+    stats = None
+    if args.stats_file is not None:
+        stats = PixelStatsAccumulator(geometry.roi_shape())
+        stages.append(lambda img, header, target_file: stats.add(img))
+    if args.doExtract:
+        stages.append(ExtractionStage(method=args.extraction_method))
+    live_view = None
+    if args.doLiveView:
+        live_view = LiveViewServer(port=args.live_view_port, title=prefix)
+        stages.append(LiveViewStage(live_view))
+    preview = None
+    if args.doPreview:
+        preview_dir = args.preview_dir
+        if preview_dir is None:
+            preview_dir = os.path.join(args.output_dir, "previews")
+        preview = PreviewStage(preview_dir=preview_dir, factor=args.preview_factor, title=prefix)
+        stages.append(preview)
+
+    with span("stream.convert", cat="conversion", file=args.input_file):
+        n_converted = stream_convert(args.input_file, args.output_dir, prefix,
+                                     header_elems=BuildStreamHeader(args, geometry, start_temperature), n_frames=args.n_frames, geometry=geometry,
+                                     big_endian=1 if args.big_endian else BYTE_ORDERS[args.byte_order], poll_interval=args.poll_interval,
+                                     idle_timeout=args.idle_timeout, is_done=is_done, writer=writer, stages=stages,
+                                     temperature_series=temperature_series, timing_series=timing_series)
+
+    if writer is not None:
+        writer.close()
+        writer_stats = writer.stats()
+        print('Wrote %d frame(s), %d failed; maximum queue depth %d' %
+              (writer_stats["written"], writer_stats["failed"], writer_stats["max_queue_depth"]))
+        if writer_stats["latency"] is not None:
+            print('Write latency: mean %.1f ms, p99 %.1f ms' %
+                  (1e3 * writer_stats["latency"]["mean"], 1e3 * writer_stats["latency"]["p99"]))
+
+    if preview is not None:
+        index_file = preview.close()
+        if index_file is not None:
+            print('Wrote %d preview(s) and %s' % (len(preview.entries), index_file))
+
+    if stats is not None:
+        stats.write(args.stats_file)
+        print('Wrote per-pixel statistics of %d frame(s) to %s' % (stats.n_frames, args.stats_file))
+
+    if process is not None:
+        process.wait()
+    if live_view is not None:
+        live_view.close()
+    print('Done converting %d frame(s) from %s' % (n_converted, args.input_file))
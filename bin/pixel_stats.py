@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""
+.. module:: pixel_stats
+    :platform: unix
+    :synopsis: Streaming per-pixel statistics and bad-pixel maps over bias/dark/flat runs.
+
+PixelStatsAccumulator is fed one frame at a time (by mlof_stream_convert.py
+while it converts, or from existing FITS files with this script) and keeps,
+per pixel, only:
+
+    shifted sum      int32    sum of (frame - first frame)
+    shifted sum sq   float32  sum of (frame - first frame)**2
+    min, max         uint16
+    n_high, n_low    uint32   frames above / below the thresholds
+
+Shifting by the first frame keeps the float32 sum of squares well
+conditioned, so the variance stays accurate over 10^4 frames. The state is
+about 22 MB for the PIXIS 1024 however long the run.
+
+Bad-pixel mask bits:
+
+    1   HOT        mean above the frame median by more than nsigma robust sigmas
+    2   DEAD       mean below dead_fraction of the median (flats) or nsigma low
+    4   NOISY      variance above noisy_factor times the median variance
+    8   SATURATED  above high_threshold in more than saturated_fraction of frames
+    16  STUCK      never changed value over the run
+
+Typical usage:
+
+    python pixel_stats.py --doAccumulate -o dark_run_stats.fits /data/2023_05_01/dark_*.fits
+"""
+
+import glob
+import optparse
+
+import numpy as np
+from astropy.io import fits
+
+from pixis_raw import PIXIS_DIMEN
+from instrumentation import configure_from_environment, span
+
+HOT = 1
+DEAD = 2
+NOISY = 4
+SATURATED = 8
+STUCK = 16
+
+
+class PixelStatsAccumulator:
+    """
+    Constant-memory, vectorized per-pixel statistics over a run of frames.
+    """
+    def __init__(self, shape=PIXIS_DIMEN, high_threshold=60000, low_threshold=None):
+        """
+
+        :param shape: [rows, columns] of the frames
+        :param high_threshold: ADU above which a pixel counts towards n_high
+        :param low_threshold: ADU below which a pixel counts towards n_low (None disables)
+        """
+        self.shape = tuple(shape)
+        self.high_threshold = high_threshold
+        self.low_threshold = low_threshold
+        self.n_frames = 0
+        self.reference = None
+        self.shifted_sum = np.zeros(self.shape, dtype=np.int32)
+        self.shifted_sumsq = np.zeros(self.shape, dtype=np.float32)
+        self.min = np.full(self.shape, np.iinfo(np.uint16).max, dtype=np.uint16)
+        self.max = np.zeros(self.shape, dtype=np.uint16)
+        self.n_high = np.zeros(self.shape, dtype=np.uint32)
+        self.n_low = np.zeros(self.shape, dtype=np.uint32)
+        # scratch space reused for every frame
+        self._diff = np.empty(self.shape, dtype=np.int32)
+        self._diffsq = np.empty(self.shape, dtype=np.float32)
+        self._above = np.empty(self.shape, dtype=bool)
+
+    def add(self, frame):
+        """
+        Folds one frame into the statistics.
+
+        :param frame: a (rows, columns) unsigned 16-bit image
+        """
+        if frame.shape != self.shape:
+            raise ValueError('Frame shape %s does not match accumulator shape %s' % (frame.shape, self.shape))
+        if self.reference is None:
+            self.reference = np.array(frame, dtype=np.uint16)
+        np.subtract(frame, self.reference, out=self._diff, dtype=np.int32)
+        self.shifted_sum += self._diff
+        np.multiply(self._diff, self._diff, out=self._diffsq, dtype=np.float32)
+        self.shifted_sumsq += self._diffsq
+        np.minimum(self.min, frame, out=self.min, casting='unsafe')
+        np.maximum(self.max, frame, out=self.max, casting='unsafe')
+        np.greater(frame, self.high_threshold, out=self._above)
+        self.n_high += self._above
+        if self.low_threshold is not None:
+            np.less(frame, self.low_threshold, out=self._above)
+            self.n_low += self._above
+        self.n_frames += 1
+
+    @property
+    def mean(self):
+        """Per-pixel mean, float32."""
+        if self.n_frames == 0:
+            return np.zeros(self.shape, dtype=np.float32)
+        return self.reference + self.shifted_sum.astype(np.float32) / self.n_frames
+
+    @property
+    def variance(self):
+        """Per-pixel sample variance (ddof=1), float32."""
+        if self.n_frames < 2:
+            return np.zeros(self.shape, dtype=np.float32)
+        mean_shift = self.shifted_sum.astype(np.float32) / self.n_frames
+        variance = (self.shifted_sumsq - self.n_frames * mean_shift ** 2) / (self.n_frames - 1)
+        return np.maximum(variance, 0, out=variance)
+
+    def bad_pixel_mask(self, nsigma=5.0, dead_fraction=None, noisy_factor=5.0, saturated_fraction=0.5):
+        """
+
+        :param nsigma: robust sigmas from the median mean for HOT (and DEAD, if dead_fraction is None)
+        :param dead_fraction: flag DEAD below this fraction of the median mean (use for flats)
+        :param noisy_factor: flag NOISY above this multiple of the median variance
+        :param saturated_fraction: flag SATURATED above high_threshold in more than this fraction of frames
+        :return: uint8 mask of the bits above
+        """
+        mean = self.mean
+        variance = self.variance
+        mask = np.zeros(self.shape, dtype=np.uint8)
+
+        median = np.median(mean)
+        robust_sigma = 1.4826 * np.median(np.abs(mean - median))
+        if robust_sigma == 0:
+            robust_sigma = np.sqrt(max(np.median(variance), 1.0))
+        mask[mean > median + nsigma * robust_sigma] |= HOT
+        if dead_fraction is not None:
+            mask[mean < dead_fraction * median] |= DEAD
+        else:
+            mask[mean < median - nsigma * robust_sigma] |= DEAD
+
+        if self.n_frames > 1:
+            mask[variance > noisy_factor * np.median(variance)] |= NOISY
+            mask[self.min == self.max] |= STUCK
+        if self.n_frames > 0:
+            mask[self.n_high > saturated_fraction * self.n_frames] |= SATURATED
+        return mask
+
+    def write(self, file_name, overwrite=True, **mask_kwargs):
+        """
+        Writes the bad-pixel mask (primary HDU) and MEAN, VARIANCE, MIN, MAX,
+        NHIGH and NLOW extensions to one FITS file.
+        """
+        header = fits.Header()
+        header['NFRAMES'] = (self.n_frames, 'number of frames accumulated')
+        header['HITHRESH'] = (self.high_threshold, '[ADU] threshold counted in NHIGH')
+        if self.low_threshold is not None:
+            header['LOTHRESH'] = (self.low_threshold, '[ADU] threshold counted in NLOW')
+        header['BPM_HOT'] = (HOT, 'mask bit: mean far above median')
+        header['BPM_DEAD'] = (DEAD, 'mask bit: mean far below median')
+        header['BPM_NOIS'] = (NOISY, 'mask bit: variance far above median')
+        header['BPM_SAT'] = (SATURATED, 'mask bit: usually above HITHRESH')
+        header['BPM_STCK'] = (STUCK, 'mask bit: value never changed')
+        hdul = fits.HDUList([fits.PrimaryHDU(self.bad_pixel_mask(**mask_kwargs), header=header),
+                             fits.ImageHDU(self.mean, name='MEAN'),
+                             fits.ImageHDU(self.variance, name='VARIANCE'),
+                             fits.ImageHDU(self.min, name='MIN'),
+                             fits.ImageHDU(self.max, name='MAX'),
+                             fits.ImageHDU(self.n_high, name='NHIGH'),
+                             fits.ImageHDU(self.n_low, name='NLOW')])
+        hdul.writeto(file_name, overwrite=overwrite)
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] fits_files")
+
+    parser.add_option("-o","--output_file", default="pixel_stats.fits")
+    parser.add_option("--high_threshold", type=int, default=60000)
+    parser.add_option("--low_threshold", type=int, default=None)
+    parser.add_option("--nsigma", type=float, default=5.0)
+    parser.add_option("--dead_fraction", type=float, default=None, help="flag pixels below this fraction of the median as dead (flats)")
+    parser.add_option("--noisy_factor", type=float, default=5.0)
+    parser.add_option("--doAccumulate", action="store_true", default=False)
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+    configure_from_environment(process_name="pixel_stats")
+
+    if opts.doAccumulate:
+        fits_files = sorted(f for pattern in args for f in glob.glob(pattern))
+        accumulator = None
+        for fits_file in fits_files:
+            with span("pixel_stats.add", cat="analysis", file=fits_file):
+                with fits.open(fits_file) as hdul:
+                    frame = hdul[0].data
+                    if accumulator is None:
+                        accumulator = PixelStatsAccumulator(frame.shape, high_threshold=opts.high_threshold,
+                                                            low_threshold=opts.low_threshold)
+                    accumulator.add(frame)
+        if accumulator is None:
+            print('No FITS files given')
+        else:
+            accumulator.write(opts.output_file, nsigma=opts.nsigma, dead_fraction=opts.dead_fraction,
+                              noisy_factor=opts.noisy_factor)
+            print('Accumulated %d frames into %s' % (accumulator.n_frames, opts.output_file))
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+"""
+.. module:: pixis_raw
+    :platform: unix
+    :synopsis: Decoding of the raw PIXIS readouts written by configure_sasha.
+
+The raw files are the camera readouts exactly as picam hands them over:
+readouts of unsigned pixels, one after the other, each readout_stride bytes
+apart. A readout holds one block per region of interest (the full sensor
+unless an ROI was requested), each block (height / y_binning) rows of
+(width / x_binning) pixels. configure_sasha records that layout in a
+<parameter file>_geometry.txt file next to the exposure parameters.
+
+The decoders here return NumPy views onto the buffer they are given, so no
+pixel is copied until the frame is written out.
+
+The byte order of the readouts has flipped at least once. Real frames are
+smooth from one pixel to the next, while the wrong byte order moves the noise
+into the high byte, so choose_byte_order picks, per frame, whichever order
+gives the smaller mean adjacent-pixel difference on a subsample of rows, and
+the choice is recorded as BYTEORDR. Frames already converted with the wrong
+order can be fixed in place:
+
+    python pixis_raw.py --doRedecode /data/2023_05_01/*.fits
+"""
+
+import os
+import sys
+import glob
+import optparse
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+
+from fits_writer import write_fits_atomic
+
+PIXIS_DIMEN = [1024, 1024]
+#big_endian values of choose_byte_order; None detects the order frame by frame
+BYTE_ORDERS = {'auto': None, 'little': 0, 'big': 1}
+
+
+class FrameGeometry:
+    """
+    Layout of a PIXIS readout: regions of interest, binning, stride and bit depth.
+    """
+    def __init__(self, rois=None, readout_stride=None, pixel_bit_depth=16):
+        """
+
+        :param rois: list of (x, width, x_binning, y, height, y_binning) tuples; defaults to the full sensor
+        :param readout_stride: bytes between the start of consecutive readouts; defaults to the packed size
+        :param pixel_bit_depth: bits per pixel reported by the camera
+        """
+        if rois is None:
+            rois = [(0, PIXIS_DIMEN[1], 1, 0, PIXIS_DIMEN[0], 1)]
+        self.rois = [tuple(int(v) for v in roi) for roi in rois]
+        self.pixel_bit_depth = int(pixel_bit_depth)
+        self.n_unsigned_bytes = 2 if self.pixel_bit_depth <= 16 else 4
+        if readout_stride is None:
+            readout_stride = self.frame_size
+        self.readout_stride = int(readout_stride)
+
+    @classmethod
+    def from_dimen(cls, img_dimen=PIXIS_DIMEN, n_unsigned_bytes=2):
+        """
+
+        :return: the geometry of an unbinned img_dimen[0] x img_dimen[1] frame
+        """
+        return cls(rois=[(0, img_dimen[1], 1, 0, img_dimen[0], 1)],
+                   pixel_bit_depth=8 * n_unsigned_bytes)
+
+    @classmethod
+    def from_file(cls, file_name):
+        """
+        Reads a geometry file written by configure_sasha.
+        """
+        rois = []
+        values = {}
+        with open(file_name) as f:
+            for line in f:
+                fields = line.split()
+                if not fields:
+                    continue
+                if fields[0] == 'roi':
+                    rois.append(tuple(int(v) for v in fields[1:7]))
+                else:
+                    values[fields[0]] = int(fields[1])
+        return cls(rois=rois or None, readout_stride=values.get('readout_stride'),
+                   pixel_bit_depth=values.get('pixel_bit_depth', 16))
+
+    @classmethod
+    def from_file_or_default(cls, file_name, img_dimen=PIXIS_DIMEN, n_unsigned_bytes=2):
+        """
+
+        :return: the geometry in file_name if it exists, else an unbinned img_dimen frame
+        """
+        if file_name is not None and os.path.isfile(file_name):
+            return cls.from_file(file_name)
+        return cls.from_dimen(img_dimen, n_unsigned_bytes)
+
+    def write(self, file_name):
+        with open(file_name, 'w') as f:
+            f.write('readout_stride %d\n' % self.readout_stride)
+            f.write('frame_size %d\n' % self.frame_size)
+            f.write('pixel_bit_depth %d\n' % self.pixel_bit_depth)
+            for roi in self.rois:
+                f.write('roi %d %d %d %d %d %d\n' % roi)
+
+    def roi_shape(self, index=0):
+        """
+
+        :return: [rows, columns] of region index after binning
+        """
+        x, width, x_binning, y, height, y_binning = self.rois[index]
+        return [height // y_binning, width // x_binning]
+
+    @property
+    def shapes(self):
+        return [self.roi_shape(i) for i in range(len(self.rois))]
+
+    @property
+    def frame_size(self):
+        """Bytes of pixel data in one readout (all regions)."""
+        return sum(rows * cols for rows, cols in self.shapes) * self.n_unsigned_bytes
+
+    def dtype(self, big_endian=0):
+        return np.dtype(('>u%d' if big_endian else '<u%d') % self.n_unsigned_bytes)
+
+    def n_readouts(self, n_bytes):
+        """
+
+        :return: how many complete readouts n_bytes of raw data hold
+        """
+        if n_bytes < self.frame_size:
+            return 0
+        return (n_bytes - self.frame_size) // self.readout_stride + 1
+
+    def header_elems(self, index=0):
+        """
+
+        :return: [key, value, comment] elements describing region index
+        """
+        x, width, x_binning, y, height, y_binning = self.rois[index]
+        return [['XBINNING', x_binning, 'binning factor along axis 1'],
+                ['YBINNING', y_binning, 'binning factor along axis 2'],
+                ['DETSEC', '[%d:%d,%d:%d]' % (x + 1, x + width, y + 1, y + height),
+                 'unbinned sensor region read out'],
+                ['RDSTRIDE', self.readout_stride, '[bytes] PIXIS readout stride'],
+                ['BITDEPTH', self.pixel_bit_depth, 'PIXIS pixel bit depth']]
+
+
+def decode_readouts(data, geometry, big_endian=0, roi_index=0, n_readouts=None):
+    """
+    Interprets raw bytes holding one or more readouts as a stack of images, without copying.
+
+    :param data: bytes, bytearray, memoryview, mmap or np.memmap of the raw data
+    :param geometry: FrameGeometry describing the readouts
+    :param big_endian: set if the readout is big endian (see convertRawToFits)
+    :param roi_index: which region of interest to return
+    :param n_readouts: number of readouts to decode; defaults to all complete ones in data
+    :return: a (n_readouts, rows, columns) view, each frame flipped to match convertRawToFits
+    """
+    n_bytes = memoryview(data).nbytes
+    if n_readouts is None:
+        n_readouts = geometry.n_readouts(n_bytes)
+    offset = sum(rows * cols for rows, cols in geometry.shapes[:roi_index]) * geometry.n_unsigned_bytes
+    rows, cols = geometry.roi_shape(roi_index)
+    n_bytes_per_pixel = geometry.n_unsigned_bytes
+    stack = np.ndarray(shape=(n_readouts, rows, cols), dtype=geometry.dtype(big_endian),
+                       buffer=data, offset=offset,
+                       strides=(geometry.readout_stride, cols * n_bytes_per_pixel, n_bytes_per_pixel))
+    return np.flip(stack, 1)
+
+
+def roughness(frame, step=8):
+    """
+
+    :return: mean absolute difference between adjacent pixels along every step-th row
+    """
+    sample = np.asarray(frame[::step], dtype=np.float32)
+    return float(np.mean(np.abs(np.diff(sample, axis=1)))) if sample.shape[1] > 1 else 0.0
+
+
+def needs_byteswap(frame, step=8, min_ratio=2.0):
+    """
+    Decides whether a frame reads better with its bytes swapped.
+
+    :param min_ratio: how much smoother the swapped frame must be; below it (e.g. flat or saturated frames) nothing is swapped
+    :return: (swap, ratio of the as-is to the swapped roughness)
+    """
+    as_is = roughness(frame, step)
+    swapped = roughness(frame[::step].byteswap(), 1)
+    ratio = as_is / swapped if swapped > 0 else (np.inf if as_is > 0 else 1.0)
+    return ratio >= min_ratio, ratio
+
+
+def is_big_endian(dtype):
+    return dtype.byteorder == '>' or (dtype.byteorder == '=' and sys.byteorder == 'big')
+
+
+def choose_byte_order(img, big_endian=None, default=0):
+    """
+    Reinterprets a decoded frame in the byte order that fits it, without copying.
+
+    :param img: a frame from decode_readouts
+    :param big_endian: 0 or 1 to force the byte order, None to detect it
+    :param default: byte order kept when detection is inconclusive
+    :return: (frame view, [key, value, comment] BYTEORDR header element)
+    """
+    if big_endian is None:
+        big_endian, how = default, 'default'
+        as_default = img if is_big_endian(img.dtype) == bool(default) else img.view(img.dtype.newbyteorder())
+        swap, ratio = needs_byteswap(as_default)
+        if swap:
+            big_endian = 1 - int(default)
+        # a ratio well below 1 is just as conclusive, in favour of the default
+        if swap or ratio <= 0.5:
+            how = 'detected, ratio %.3g' % ratio
+    else:
+        how = 'forced'
+    if is_big_endian(img.dtype) != bool(big_endian):
+        img = img.view(img.dtype.newbyteorder())
+    order = 'BIG' if is_big_endian(img.dtype) else 'LITTLE'
+    return img, ['BYTEORDR', order, 'raw byte order (%s)' % how]
+
+
+def base_header(img_dimen=PIXIS_DIMEN, n_unsigned_bytes=2):
+    """
+
+    :return: the structural keywords convertRawToFits starts every header with
+    """
+    new_header = fits.Header()
+    new_header['SIMPLE'] = ('T', 'Created by convertRawToFits.py')
+    new_header['BITPIX'] = (n_unsigned_bytes * 8, 'number of bits per data pixel')
+    new_header['NAXIS'] = (2, 'number of data axes')
+    new_header['NAXIS1'] = (img_dimen[1], 'length of data axis 1')
+    new_header['NAXIS2'] = (img_dimen[0], 'length of data axis 2')
+    new_header['BZERO'] = (2 ** (n_unsigned_bytes * 8 - 1), 'data range offset')
+    new_header['BSCALE'] = (1, 'default scaling factor')
+    return new_header
+
+
+def redecode_file(file_name, dry_run=False, min_ratio=2.0):
+    """
+    Swaps the bytes of a FITS frame converted with the wrong byte order, in place.
+
+    :return: True if the file needed (and, unless dry_run, got) swapping
+    """
+    with fits.open(file_name) as hdul:
+        if hdul[0].data is None or hdul[0].data.dtype.itemsize != 2 or 'CRMETH' in hdul[0].header:
+            print('Skipping %s: not a converted 16-bit frame' % file_name)
+            return False
+        data = np.array(hdul[0].data, dtype=np.uint16)
+        header = hdul[0].header.copy()
+        extensions = [hdu.copy() for hdu in hdul[1:]]
+    swap, ratio = needs_byteswap(data, min_ratio=min_ratio)
+    if not swap:
+        return False
+    print('%s: byte order wrong (roughness ratio %.3g)%s' % (file_name, ratio, '' if dry_run else ', swapping'))
+    if dry_run:
+        return True
+    # frames converted before BYTEORDR existed were decoded little endian
+    order = 'LITTLE' if header.get('BYTEORDR', 'LITTLE') == 'BIG' else 'BIG'
+    header['BYTEORDR'] = (order, 'raw byte order (redecoded, ratio %.3g)' % ratio)
+    header['HISTORY'] = 'Bytes swapped by pixis_raw.py --doRedecode'
+    write_fits_atomic(data.byteswap(), header, file_name, extensions=extensions)
+    return True
+
+
+def _redecode_files(args):
+    file_names, dry_run, min_ratio = args
+    return sum(redecode_file(file_name, dry_run=dry_run, min_ratio=min_ratio) for file_name in file_names)
+
+
+def redecode_files(file_names, n_processes=1, dry_run=False, min_ratio=2.0):
+    """
+    Checks, and fixes, the byte order of many converted frames in parallel.
+
+    :return: the number of frames found with the wrong byte order
+    """
+    if n_processes <= 1:
+        return _redecode_files((file_names, dry_run, min_ratio))
+    chunks = [(file_names[i::n_processes], dry_run, min_ratio) for i in range(n_processes)]
+    with Pool(n_processes) as pool:
+        return sum(pool.map(_redecode_files, chunks))
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] fits_files")
+
+    parser.add_option("-n","--n_processes", type=int, default=1)
+    parser.add_option("--min_ratio", type=float, default=2.0, help="how much smoother the swapped frame must be to swap it")
+    parser.add_option("--dry_run", action="store_true", default=False, help="only report the frames that would be swapped")
+    parser.add_option("--doRedecode", action="store_true", default=False)
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+
+    if opts.doRedecode:
+        fits_files = sorted(f for pattern in args for f in glob.glob(pattern))
+        n_swapped = redecode_files(fits_files, n_processes=opts.n_processes, dry_run=opts.dry_run,
+                                   min_ratio=opts.min_ratio)
+        print('%d of %d frame(s) had the wrong byte order' % (n_swapped, len(fits_files)))
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+"""
+.. module:: quicklook
+    :platform: unix
+    :synopsis: Quick-look thumbnails of PIXIS frames and an HTML contact sheet per run.
+
+A preview is made straight from the uint16 frame: block-reduced by an integer
+factor, stretched between the IRAF zscale limits and written as an 8-bit
+greyscale PNG with zlib, so matplotlib is not needed and a 1024x1024 frame
+takes a few milliseconds. JPEG previews are written with Pillow when it is
+installed.
+
+PreviewStage plugs into the converters (mlof_stream_convert.py and
+mlof_take_image, --doPreview) and does the stretching and encoding in a
+worker process. Once a run is converted, index.html in the preview directory
+shows every frame as a thumbnail linked to its FITS file, captioned with its
+target, exposure time, wavelength and pixel range.
+
+Typical usage:
+
+    python quicklook.py --doPreview -o /data/2023_05_01/previews /data/2023_05_01/*.fits
+"""
+
+import os
+import glob
+import html
+import struct
+import zlib
+import optparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from instrumentation import configure_from_environment, span, metrics
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PREVIEW_FORMATS = ['png', 'jpeg']
+#Header keywords shown under each thumbnail of the contact sheet
+CAPTION_KEYS = ['TARGET', 'OBSTYPE', 'EXPTIME', 'FRAMENUM', 'MONOWAVE', 'FOCUSPOS', 'TEMP']
+
+
+def block_reduce(img, factor):
+    """
+    Averages factor x factor blocks, dropping any rows and columns that do not fill a block.
+
+    :return: float32 image
+    """
+    if factor <= 1:
+        return np.asarray(img, dtype=np.float32)
+    rows, cols = img.shape[0] // factor, img.shape[1] // factor
+    img = np.asarray(img)[:rows * factor, :cols * factor]
+    # strided slice sums run several times faster than summing a 4-D reshape
+    columns = img[:, 0::factor].astype(np.uint32)
+    for i in range(1, factor):
+        columns += img[:, i::factor]
+    blocks = columns[0::factor].copy()
+    for i in range(1, factor):
+        blocks += columns[i::factor]
+    return blocks.astype(np.float32) / (factor * factor)
+
+
+def zscale_limits(img, n_samples=1000, contrast=0.25, n_iterations=3, rejection=2.5):
+    """
+    Display limits after the IRAF zscale algorithm: a line fitted to the
+    sorted values of a sample of pixels, its slope divided by contrast.
+
+    :return: (z1, z2)
+    """
+    values = np.asarray(img, dtype=np.float32).ravel()
+    step = max(1, values.size // n_samples)
+    samples = np.sort(values[::step])
+    n = samples.size
+    if n < 2:
+        return float(samples.min()), float(samples.max())
+    indices = np.arange(n, dtype=np.float32)
+    keep = np.ones(n, dtype=bool)
+    slope, intercept = 0.0, float(np.median(samples))
+    for i in range(n_iterations):
+        if keep.sum() < max(5, n // 2):
+            break
+        slope, intercept = np.polyfit(indices[keep], samples[keep], 1)
+        residuals = samples - (slope * indices + intercept)
+        sigma = np.std(residuals[keep])
+        keep = np.abs(residuals) < rejection * max(sigma, 1e-6)
+    median = float(np.median(samples))
+    center = (n - 1) / 2.0
+    z1 = max(float(samples[0]), median - center * slope / contrast)
+    z2 = min(float(samples[-1]), median + center * slope / contrast)
+    if z2 <= z1:
+        z1, z2 = float(samples[0]), float(samples[-1])
+    return z1, z2
+
+
+def stretch(img, z1, z2):
+    """
+
+    :return: uint8 image, linear between z1 and z2
+    """
+    scale = 255.0 / (z2 - z1) if z2 > z1 else 0.0
+    scaled = (np.asarray(img, dtype=np.float32) - z1) * scale
+    return np.clip(scaled, 0, 255, out=scaled).astype(np.uint8)
+
+
+def _png_chunk(chunk_type, data):
+    return (struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def encode_png(pixels, level=1):
+    """
+
+    :param pixels: 2-D uint8 greyscale image
+    :return: the PNG file contents
+    """
+    rows, cols = pixels.shape
+    # every scanline starts with filter type 0 (none)
+    scanlines = np.zeros((rows, cols + 1), dtype=np.uint8)
+    scanlines[:, 1:] = pixels
+    return (b'\x89PNG\r\n\x1a\n' +
+            _png_chunk(b'IHDR', struct.pack('>IIBBBBB', cols, rows, 8, 0, 0, 0, 0)) +
+            _png_chunk(b'IDAT', zlib.compress(scanlines.tobytes(), level)) +
+            _png_chunk(b'IEND', b''))
+
+
+def write_preview(pixels, file_name, fmt='png'):
+    """
+    Writes a uint8 image as PNG or JPEG, renaming it into place once complete.
+    """
+    tmp_name = os.path.join(os.path.dirname(os.path.abspath(file_name)),
+                            '.%s.%d.tmp' % (os.path.basename(file_name), os.getpid()))
+    if fmt == 'jpeg':
+        if Image is None:
+            raise ImportError('JPEG previews need Pillow; use png')
+        Image.fromarray(pixels, mode='L').save(tmp_name, format='JPEG', quality=85)
+    else:
+        with open(tmp_name, 'wb') as f:
+            f.write(encode_png(pixels))
+    os.replace(tmp_name, file_name)
+
+
+def preview_file_name(file_name, preview_dir=None, fmt='png'):
+    """
+
+    :return: name of the preview of a FITS file: <file>_preview.png, in preview_dir if given
+    """
+    preview_name = file_name.replace('.fits', '') + '_preview.' + ('jpg' if fmt == 'jpeg' else 'png')
+    if preview_dir is not None:
+        preview_name = os.path.join(preview_dir, os.path.basename(preview_name))
+    return preview_name
+
+
+def make_preview(reduced, preview_name, fmt='png'):
+    """
+    Stretches and writes an already block-reduced frame.
+
+    :return: (z1, z2) display limits used
+    """
+    z1, z2 = zscale_limits(reduced)
+    write_preview(stretch(reduced, z1, z2), preview_name, fmt)
+    return z1, z2
+
+
+def caption(header, file_name):
+    """
+
+    :return: a dict of what the contact sheet shows for one frame
+    """
+    entry = {'file': file_name}
+    for key in CAPTION_KEYS:
+        if key in header:
+            entry[key] = header[key]
+    return entry
+
+
+def write_contact_sheet(index_file, entries, title='Quick look'):
+    """
+    Writes an HTML page of thumbnails, each linked to its FITS file.
+
+    :param entries: dicts with 'file', 'preview', optional 'z1'/'z2' and CAPTION_KEYS values
+    """
+    index_dir = os.path.dirname(os.path.abspath(index_file))
+    figures = []
+    for entry in entries:
+        preview = os.path.relpath(os.path.abspath(entry['preview']), index_dir)
+        target = os.path.relpath(os.path.abspath(entry['file']), index_dir)
+        details = ['%s=%s' % (key, entry[key]) for key in CAPTION_KEYS if key in entry]
+        if 'z1' in entry:
+            details.append('z=%.0f..%.0f' % (entry['z1'], entry['z2']))
+        figures.append('<figure><a href="%s"><img src="%s" loading="lazy"></a>'
+                       '<figcaption><b>%s</b><br>%s</figcaption></figure>' %
+                       (html.escape(target), html.escape(preview), html.escape(os.path.basename(entry['file'])),
+                        html.escape(' '.join(details))))
+    page = ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>%s</title>\n'
+            '<style>body{font-family:sans-serif;background:#222;color:#ddd}'
+            'figure{display:inline-block;margin:4px;width:264px;vertical-align:top;font-size:11px}'
+            'img{width:256px;image-rendering:pixelated}</style></head>\n'
+            '<body><h3>%s (%d frames)</h3>\n%s\n</body></html>\n' %
+            (html.escape(title), html.escape(title), len(entries), '\n'.join(figures)))
+    tmp_name = index_file + '.tmp%d' % os.getpid()
+    with open(tmp_name, 'w') as f:
+        f.write(page)
+    os.replace(tmp_name, index_file)
+
+
+class PreviewStage:
+    """
+    Conversion stage that writes a thumbnail of every frame and, on close, the contact sheet.
+
+    Called as stage(img, header, target_file). The frame is block-reduced in
+    the caller, which also copies it out of any reused buffer; the stretching
+    and encoding happen in n_workers worker processes (inline with 0).
+    """
+    def __init__(self, preview_dir=None, factor=4, fmt='png', n_workers=1, index_file=None, title='Quick look'):
+        """
+
+        :param preview_dir: where previews go; defaults to next to each FITS file
+        :param factor: block-reduction factor
+        :param index_file: contact sheet written by close(); defaults to index.html in preview_dir (None: no sheet)
+        """
+        if fmt not in PREVIEW_FORMATS:
+            raise ValueError('fmt must be one of %s' % str(PREVIEW_FORMATS))
+        if fmt == 'jpeg' and Image is None:
+            print('Pillow is not installed; writing PNG previews instead')
+            fmt = 'png'
+        self.preview_dir = preview_dir
+        if preview_dir is not None and not os.path.isdir(preview_dir):
+            os.makedirs(preview_dir)
+        self.factor = factor
+        self.fmt = fmt
+        self.index_file = index_file
+        if index_file is None and preview_dir is not None:
+            self.index_file = os.path.join(preview_dir, 'index.html')
+        self.title = title
+        self.entries = []
+        self._futures = []
+        self._pool = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 0 else None
+
+    def __call__(self, img, header, target_file):
+        with span("preview.reduce", cat="preview", file=target_file):
+            reduced = block_reduce(img, self.factor)
+        entry = caption(header, target_file)
+        entry['preview'] = preview_file_name(target_file, self.preview_dir, self.fmt)
+        self.entries.append(entry)
+        if self._pool is None:
+            with span("preview.write", cat="preview", file=target_file):
+                entry['z1'], entry['z2'] = make_preview(reduced, entry['preview'], self.fmt)
+        else:
+            self._futures.append((entry, self._pool.submit(make_preview, reduced, entry['preview'], self.fmt)))
+        metrics.incr("preview.frames")
+
+    def close(self):
+        """
+        Waits for the outstanding previews and writes the contact sheet.
+
+        :return: the contact sheet file name, or None
+        """
+        if self._pool is not None:
+            for entry, future in self._futures:
+                try:
+                    entry['z1'], entry['z2'] = future.result()
+                except Exception as error:
+                    print('Preview of %s failed: %s' % (entry['file'], error))
+            self._futures = []
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        if self.index_file is None or not self.entries:
+            return None
+        write_contact_sheet(self.index_file, self.entries, self.title)
+        return self.index_file
+
+
+def _preview_files(args):
+    file_names, preview_dir, factor, fmt = args
+    entries = []
+    for file_name in file_names:
+        with fits.open(file_name) as hdul:
+            header = hdul[0].header
+            entry = caption(header, file_name)
+            reduced = block_reduce(hdul[0].data, factor)
+        entry['preview'] = preview_file_name(file_name, preview_dir, fmt)
+        entry['z1'], entry['z2'] = make_preview(reduced, entry['preview'], fmt)
+        entries.append(entry)
+    return entries
+
+
+def preview_files(file_names, preview_dir=None, factor=4, fmt='png', n_processes=1):
+    """
+    Makes previews of existing FITS files, in parallel.
+
+    :return: contact sheet entries, in the order of file_names
+    """
+    if n_processes <= 1:
+        return _preview_files((file_names, preview_dir, factor, fmt))
+    chunks = [(file_names[i::n_processes], preview_dir, factor, fmt) for i in range(n_processes)]
+    with ProcessPoolExecutor(max_workers=n_processes) as pool:
+        results = list(pool.map(_preview_files, chunks))
+    entries = [None] * len(file_names)
+    for i, chunk_entries in enumerate(results):
+        entries[i::n_processes] = chunk_entries
+    return entries
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] fits_files")
+
+    parser.add_option("-o","--preview_dir", default=None, help="where previews and index.html go; defaults to next to the FITS files")
+    parser.add_option("-i","--index_file", default=None, help="contact sheet file; defaults to index.html in the preview directory")
+    parser.add_option("-f","--factor", type=int, default=4, help="block-reduction factor")
+    parser.add_option("--format", default="png", help="%s" % ", ".join(PREVIEW_FORMATS))
+    parser.add_option("-n","--n_processes", type=int, default=4)
+    parser.add_option("-t","--title", default="Quick look")
+    parser.add_option("--doPreview", action="store_true", default=False)
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+    configure_from_environment(process_name="quicklook")
+
+    if opts.doPreview:
+        fits_files = sorted(f for pattern in args for f in glob.glob(pattern))
+        fmt = opts.format
+        if fmt == 'jpeg' and Image is None:
+            print('Pillow is not installed; writing PNG previews instead')
+            fmt = 'png'
+        if opts.preview_dir is not None and not os.path.isdir(opts.preview_dir):
+            os.makedirs(opts.preview_dir)
+        with span("preview.files", cat="preview", n_files=len(fits_files)):
+            entries = preview_files(fits_files, opts.preview_dir, opts.factor, fmt, opts.n_processes)
+        index_file = opts.index_file
+        if index_file is None:
+            index_dir = opts.preview_dir
+            if index_dir is None:
+                index_dir = os.path.dirname(fits_files[0]) if fits_files else '.'
+            index_file = os.path.join(index_dir, 'index.html')
+        if entries:
+            write_contact_sheet(index_file, entries, opts.title)
+        print('Wrote %d preview(s) and %s' % (len(entries), index_file))
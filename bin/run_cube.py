@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+"""
+.. module:: run_cube
+    :platform: unix
+    :synopsis: A run's FITS frames packed into one chunked, compressed HDF5 cube.
+
+Opening and parsing thousands of frames dominates analysis of a night. The
+frames of a run are packed into one HDF5 file holding
+
+    /frames          (frame, row, column) cube, one frame per chunk along the
+                     first axis and chunk_shape (default 256 x 64) within it,
+                     byte-shuffled and deflated
+    /header/<KEY>    one dataset per header keyword, a row per frame: numbers
+                     as float64 (NaN when missing), booleans as int8 (-1 when
+                     missing), anything else as text ('' when missing);
+                     /header/FILE names the FITS file each frame came from
+
+so that, for example, column 512 of every frame reads 1/16 of the cube and
+no whole frame. Worker processes read the FITS files and shuffle and deflate
+each chunk; the packing process only writes the compressed chunks into place.
+Packing again appends the frames that are not yet in the cube, and --follow
+keeps doing so while a run is still being converted.
+
+This needs h5py, which the rest of the pipeline does not.
+
+Typical usage:
+
+    python run_cube.py --doPack -o /data/2023_05_01.h5 -n 8 /data/2023_05_01/
+    python run_cube.py --doColumn 512 /data/2023_05_01.h5
+"""
+
+import os
+import sys
+import glob
+import time
+import zlib
+import optparse
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+
+from instrumentation import configure_from_environment, span, metrics
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+FRAMES = 'frames'
+HEADER = 'header'
+#Header keywords that describe the FITS layout rather than the frame
+STRUCTURAL_KEYS = ['SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'EXTEND', 'BZERO', 'BSCALE',
+                   'COMMENT', 'HISTORY', 'CHECKSUM', 'DATASUM', '']
+DEFAULT_CHUNK_SHAPE = (256, 64)
+MISSING = {'f': np.nan, 'b': -1, 's': ''}
+
+
+def require_h5py():
+    if h5py is None:
+        raise ImportError('packing runs needs h5py (pip install h5py)')
+
+
+def value_kind(value):
+    """
+
+    :return: 'b' for booleans, 'f' for other numbers, 's' for anything else
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return 'b'
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return 'f'
+    return 's'
+
+
+def header_columns(header, file_name):
+    """
+
+    :return: dict of keyword to (value, comment) for every non-structural keyword, plus FILE
+    """
+    columns = {'FILE': (os.path.basename(file_name), 'FITS file the frame came from')}
+    for card in header.cards:
+        if card.keyword in STRUCTURAL_KEYS:
+            continue
+        columns[card.keyword] = (card.value, card.comment)
+    return columns
+
+
+def shuffle_deflate(chunk, level):
+    """
+
+    :return: a chunk as HDF5 stores it through its shuffle and deflate filters
+    """
+    chunk = np.ascontiguousarray(chunk)
+    shuffled = chunk.view(np.uint8).reshape(-1, chunk.dtype.itemsize).T.tobytes()
+    return zlib.compress(shuffled, level)
+
+
+def compress_frame(args):
+    """
+    Reads one FITS frame and compresses it chunk by chunk, in a worker process.
+
+    :param args: (file name, (rows, columns), dtype string, chunk_shape, compression level)
+    :return: (file name, header columns, [(row, column, compressed chunk)]), or (file name, None, reason)
+    """
+    file_name, shape, dtype, chunk_shape, level = args
+    try:
+        with fits.open(file_name) as hdul:
+            data = hdul[0].data
+            if data is None or data.shape != tuple(shape):
+                return file_name, None, 'its data is %s, not a %dx%d frame' % (
+                    'missing' if data is None else 'x'.join(map(str, data.shape)), shape[0], shape[1])
+            data = np.asarray(data).astype(dtype, copy=False)
+            columns = header_columns(hdul[0].header, file_name)
+    except (OSError, ValueError, TypeError) as error:
+        return file_name, None, str(error)
+    chunk_rows, chunk_cols = chunk_shape
+    chunks = []
+    for row in range(0, shape[0], chunk_rows):
+        for col in range(0, shape[1], chunk_cols):
+            block = data[row:row + chunk_rows, col:col + chunk_cols]
+            if block.shape != (chunk_rows, chunk_cols):
+                # edge chunks are stored full size
+                padded = np.zeros((chunk_rows, chunk_cols), dtype=dtype)
+                padded[:block.shape[0], :block.shape[1]] = block
+                block = padded
+            chunks.append((row, col, shuffle_deflate(block, level)))
+    return file_name, columns, chunks
+
+
+class RunCube:
+    """
+    HDF5 cube of a run's frames, appended to as frames arrive.
+    """
+    def __init__(self, file_name, mode='a'):
+        """
+
+        :param mode: 'r' to read, 'a' to read and append
+        """
+        require_h5py()
+        self.file_name = file_name
+        self.h5 = h5py.File(file_name, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        self.h5.close()
+
+    @property
+    def frames(self):
+        """The (frame, row, column) dataset, or None before the first frame."""
+        return self.h5.get(FRAMES)
+
+    def __len__(self):
+        return 0 if self.frames is None else self.frames.shape[0]
+
+    def create(self, shape, dtype, chunk_shape=DEFAULT_CHUNK_SHAPE, level=1):
+        """
+        Creates the empty cube for frames of shape (rows, columns). Chunks are cut down to frames smaller than them.
+        """
+        chunk_shape = tuple(min(c, s) for c, s in zip(chunk_shape, shape))
+        self.h5.create_dataset(FRAMES, shape=(0,) + tuple(shape), maxshape=(None,) + tuple(shape), dtype=dtype,
+                               chunks=(1,) + tuple(chunk_shape), shuffle=True, compression='gzip',
+                               compression_opts=level)
+        self.h5.create_group(HEADER)
+        self.h5.attrs['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    def files(self):
+        """
+
+        :return: base names of the FITS files already in the cube, in frame order
+        """
+        if HEADER not in self.h5 or 'FILE' not in self.h5[HEADER]:
+            return []
+        return [name.decode() if isinstance(name, bytes) else name for name in self.h5[HEADER]['FILE'][:]]
+
+    def header(self, key):
+        """
+
+        :return: a header keyword of every frame, as an array
+        """
+        values = self.h5[HEADER][key][:]
+        if values.dtype.kind == 'O':
+            values = np.array([v.decode() if isinstance(v, bytes) else v for v in values], dtype=object)
+        return values
+
+    def column(self, col, frames=slice(None)):
+        """
+
+        :return: (frame, row) array of one detector column, read without reading whole frames
+        """
+        return self.frames[frames, :, col]
+
+    def _header_dataset(self, key, kind, comment):
+        group = self.h5[HEADER]
+        if key not in group:
+            n = len(self)
+            if kind == 's':
+                dataset = group.create_dataset(key, shape=(n,), maxshape=(None,), dtype=h5py.string_dtype(),
+                                               chunks=(1024,))
+                dataset[:] = ''
+            else:
+                dataset = group.create_dataset(key, shape=(n,), maxshape=(None,),
+                                               dtype=np.float64 if kind == 'f' else np.int8, chunks=(1024,),
+                                               fillvalue=MISSING[kind])
+            dataset.attrs['comment'] = comment
+        return group[key]
+
+    def append(self, columns, chunks):
+        """
+        Appends one frame from compress_frame: its compressed chunks go straight into place.
+        """
+        frames = self.frames
+        index = frames.shape[0]
+        frames.resize(index + 1, axis=0)
+        for row, col, compressed in chunks:
+            frames.id.write_direct_chunk((index, row, col), compressed)
+        for key, (value, comment) in columns.items():
+            dataset = self._header_dataset(key, value_kind(value), comment)
+            kind = 's' if dataset.dtype.kind == 'O' else ('f' if dataset.dtype.kind == 'f' else 'b')
+            if kind == 'b':
+                value = int(bool(value)) if value_kind(value) == 'b' else MISSING['b']
+            elif kind == 'f':
+                value = float(value) if value_kind(value) == 'f' else MISSING['f']
+            else:
+                value = str(value)
+            dataset.resize(index + 1, axis=0)
+            dataset[index] = value
+        # keywords this frame does not have
+        for key, dataset in self.h5[HEADER].items():
+            if dataset.shape[0] < index + 1:
+                dataset.resize(index + 1, axis=0)
+                if dataset.dtype.kind == 'O':
+                    dataset[index] = ''
+
+
+def candidate_files(paths):
+    """
+
+    :return: FITS frames named by files, glob patterns or directories, sorted by name;
+             temporary files and derived spectra and cleaned frames are left out
+    """
+    file_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            file_names.extend(glob.glob(os.path.join(path, '*.fits')))
+        else:
+            file_names.extend(glob.glob(path))
+    return sorted(f for f in set(file_names)
+                  if not os.path.basename(f).startswith('.') and not f.endswith(('_spec.fits', '_clean.fits')))
+
+
+def pack_files(cube_file, file_names, n_processes=4, chunk_shape=DEFAULT_CHUNK_SHAPE, level=1):
+    """
+    Appends the frames not yet in a cube, creating it from the first frame if needed.
+
+    :return: number of frames appended
+    """
+    require_h5py()
+    with RunCube(cube_file, 'a') as cube:
+        packed = set(cube.files())
+        file_names = [f for f in file_names if os.path.basename(f) not in packed]
+        if not file_names:
+            return 0
+        if cube.frames is None:
+            with fits.open(file_names[0]) as hdul:
+                data = hdul[0].data
+                shape, dtype = data.shape, data.dtype.newbyteorder('<').str
+            # binned or ROI frames may be smaller than a chunk
+            chunk_shape = tuple(min(c, s) for c, s in zip(chunk_shape, shape))
+            cube.create(shape, dtype, chunk_shape, level)
+        else:
+            shape, dtype = cube.frames.shape[1:], cube.frames.dtype.str
+            chunk_shape = cube.frames.chunks[1:]
+        tasks = [(f, shape, dtype, chunk_shape, level) for f in file_names]
+        n_appended = 0
+        with span("cube.pack", cat="io", n_files=len(tasks)):
+            if n_processes > 1:
+                pool = Pool(processes=n_processes)
+                results = pool.imap(compress_frame, tasks, chunksize=4)
+            else:
+                pool = None
+                results = map(compress_frame, tasks)
+            try:
+                for file_name, columns, chunks in results:
+                    if columns is None:
+                        print('Skipping %s: %s' % (file_name, chunks))
+                        continue
+                    cube.append(columns, chunks)
+                    n_appended += 1
+                    metrics.incr("cube.frames")
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+        cube.h5.flush()
+    return n_appended
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] fits_files_or_directories | cube_file")
+
+    parser.add_option("-o","--cube_file", default=None, help="HDF5 file to pack into")
+    parser.add_option("-n","--n_processes", type=int, default=4)
+    parser.add_option("--chunk_shape", default="%d,%d" % DEFAULT_CHUNK_SHAPE, help="rows,columns of a chunk")
+    parser.add_option("--level", type=int, default=1, help="deflate level")
+    parser.add_option("--follow", type=float, default=None,
+                      help="keep appending new frames every this many seconds until interrupted")
+    parser.add_option("--doPack", action="store_true", default=False)
+    parser.add_option("--doInfo", action="store_true", default=False)
+    parser.add_option("--doColumn", type=int, default=None, help="print statistics of one column across all frames")
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+    configure_from_environment(process_name="run_cube")
+
+    if h5py is None:
+        print('run_cube.py needs h5py (pip install h5py)')
+        sys.exit(1)
+
+    if opts.doPack:
+        if opts.cube_file is None:
+            print('A cube file (-o) is required')
+            sys.exit(1)
+        chunk_shape = tuple(int(n) for n in opts.chunk_shape.split(','))
+        while True:
+            start = time.perf_counter()
+            n_appended = pack_files(opts.cube_file, candidate_files(args), n_processes=opts.n_processes,
+                                    chunk_shape=chunk_shape, level=opts.level)
+            if n_appended or opts.follow is None:
+                print('Appended %d frame(s) to %s in %.1f s' % (n_appended, opts.cube_file, time.perf_counter() - start))
+            if opts.follow is None:
+                break
+            try:
+                time.sleep(opts.follow)
+            except KeyboardInterrupt:
+                break
+
+    if opts.doInfo:
+        for cube_file in args:
+            with RunCube(cube_file, 'r') as cube:
+                frames = cube.frames
+                print('%s: %d frame(s) of %s %s, chunks %s, %.1f MB on disk; header columns %s' %
+                      (cube_file, len(cube), 'x'.join(map(str, frames.shape[1:])), frames.dtype,
+                       'x'.join(map(str, frames.chunks)), os.path.getsize(cube_file) / 1e6,
+                       ', '.join(sorted(cube.h5[HEADER]))))
+
+    if opts.doColumn is not None:
+        for cube_file in args:
+            with RunCube(cube_file, 'r') as cube:
+                start = time.perf_counter()
+                column = cube.column(opts.doColumn)
+                elapsed = time.perf_counter() - start
+                means = column.mean(axis=1)
+                print('%s: column %d of %d frame(s) read in %.3f s; per-frame mean %.2f to %.2f' %
+                      (cube_file, opts.doColumn, column.shape[0], elapsed, means.min(), means.max()))
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+
+"""
+.. module:: spectral_extraction
+    :platform: unix
+    :synopsis: Vectorized 1-D spectral extraction with a per-configuration trace cache.
+
+The spectral trace (the row position of the spectrum as a function of
+column, plus its width) only changes when the grating or the collimator
+focus position (FOCUSPOS) changes. It is fitted once per configuration,
+cached on disk, and every later frame is reduced with whole-array NumPy
+operations: a boxcar sum or a Horne optimal extraction over a fixed window
+of rows, with the sky taken from bands either side of the aperture.
+
+Only NORMAL frames with GRATING and FOCUSPOS in their header are
+extracted, and a fit whose spectrum does not stand clearly above the
+background is never cached; other frames are skipped.
+
+Dispersion runs along the columns (FITS axis 1). Spectra are written next
+to the frame as <frame>_spec.fits, a table of PIXEL, FLUX and VARIANCE.
+
+Typical usage:
+
+    python spectral_extraction.py --doExtract --method optimal /data/2023_05_01/*.fits
+"""
+
+import os
+import glob
+import json
+import optparse
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+
+from instrumentation import configure_from_environment, span, metrics
+from wavelength_calibration import wavelengths_from_header
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('MLOF_CACHE', os.path.expanduser('~/.mlof/cache')), 'traces')
+EXTRACTION_METHODS = ['boxcar', 'optimal']
+
+
+class Trace:
+    """
+    Position and width of the spectrum on the detector for one instrument configuration.
+    """
+    def __init__(self, coeffs, sigma, shape, half_width=None, sky_gap=3, sky_width=10, key=None):
+        """
+
+        :param coeffs: polynomial coefficients (np.polyval order) of the trace row versus column
+        :param sigma: gaussian width of the spatial profile, in rows
+        :param shape: [rows, columns] of the frames the trace was fitted on
+        :param half_width: half width of the extraction aperture, in rows; defaults to 3 sigma
+        :param sky_gap: rows left between the aperture and the sky bands
+        :param sky_width: rows in each sky band
+        """
+        self.coeffs = [float(c) for c in coeffs]
+        self.sigma = float(sigma)
+        self.shape = [int(n) for n in shape]
+        self.half_width = float(half_width) if half_width is not None else 3.0 * self.sigma
+        self.sky_gap = float(sky_gap)
+        self.sky_width = float(sky_width)
+        self.key = key
+
+    def centers(self):
+        """
+
+        :return: trace row for every column
+        """
+        return np.polyval(self.coeffs, np.arange(self.shape[1]))
+
+    def to_dict(self):
+        return {'coeffs': self.coeffs, 'sigma': self.sigma, 'shape': self.shape,
+                'half_width': self.half_width, 'sky_gap': self.sky_gap,
+                'sky_width': self.sky_width, 'key': self.key}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values['coeffs'], values['sigma'], values['shape'], values['half_width'],
+                   values['sky_gap'], values['sky_width'], values.get('key'))
+
+
+def fit_trace(image, order=3, search_half_width=25, min_flux_fraction=0.05, min_snr=5.0, **trace_kwargs):
+    """
+    Fits the spectral trace of a frame, all columns at once.
+
+    :param image: (rows, columns) frame with the spectrum dispersed along the columns
+    :param order: order of the polynomial fitted to the column centroids
+    :param search_half_width: rows either side of the brightest row used for the centroids
+    :param min_flux_fraction: ignore columns with less than this fraction of the peak column flux
+    :param min_snr: the spectrum must peak this many times the background noise above it, in the median column
+    :return: a Trace; raises ValueError if the frame shows no spectrum
+    """
+    img = np.asarray(image, dtype=np.float32)
+    n_rows, n_cols = img.shape
+    sub = img - np.median(img, axis=0)
+
+    peak_row = int(np.argmax(sub.sum(axis=1)))
+    lo = max(peak_row - search_half_width, 0)
+    hi = min(peak_row + search_half_width + 1, n_rows)
+    window = np.clip(sub[lo:hi], 0, None)
+    rows = np.arange(lo, hi, dtype=np.float32)[:, None]
+
+    flux = window.sum(axis=0)
+    good = flux > min_flux_fraction * flux.max()
+    if good.sum() <= order:
+        raise ValueError('Too few illuminated columns (%d) to fit a trace' % good.sum())
+    # a bias or dark frame still has a brightest row; its peak is only noise
+    noise = 1.4826 * float(np.median(np.abs(sub - np.median(sub))))
+    peak = float(np.median(window.max(axis=0)[good]))
+    if peak <= min_snr * max(noise, 1e-6):
+        raise ValueError('No spectrum above the background (peak %.1f ADU, noise %.1f ADU)' % (peak, noise))
+    flux_safe = np.where(flux > 0, flux, 1)
+    centroid = (window * rows).sum(axis=0) / flux_safe
+    second_moment = (window * (rows - centroid) ** 2).sum(axis=0) / flux_safe
+
+    # noise in the wings inflates the moment; re-measure within 3 sigma of the centroid
+    sigma = float(np.median(np.sqrt(second_moment[good])))
+    core = np.where(np.abs(rows - centroid) <= max(3 * sigma, 2.0), window, 0)
+    core_flux = np.where(core.sum(axis=0) > 0, core.sum(axis=0), 1)
+    second_moment = (core * (rows - centroid) ** 2).sum(axis=0) / core_flux
+
+    columns = np.arange(n_cols)
+    coeffs = np.polyfit(columns[good], centroid[good], order, w=np.sqrt(flux[good]))
+    sigma = float(np.median(np.sqrt(second_moment[good])))
+    return Trace(coeffs, max(sigma, 0.5), [n_rows, n_cols], **trace_kwargs)
+
+
+class TraceCache:
+    """
+    On-disk cache of fitted traces, one JSON file per (grating, focus position, frame shape).
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._traces = {}
+
+    @staticmethod
+    def key(grating, focus_pos, shape):
+        return 'g%s_f%.2f_%dx%d' % (grating, float(focus_pos), shape[0], shape[1])
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, 'trace_%s.json' % key)
+
+    def get(self, grating, focus_pos, shape):
+        """
+
+        :return: the cached Trace for this configuration, or None
+        """
+        key = self.key(grating, focus_pos, shape)
+        if key not in self._traces and os.path.isfile(self.path(key)):
+            with open(self.path(key)) as f:
+                self._traces[key] = Trace.from_dict(json.load(f))
+        return self._traces.get(key)
+
+    def put(self, trace, grating, focus_pos):
+        key = self.key(grating, focus_pos, trace.shape)
+        trace.key = key
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_name = self.path(key) + '.tmp%d' % os.getpid()
+        with open(tmp_name, 'w') as f:
+            json.dump(trace.to_dict(), f, indent=2)
+        os.replace(tmp_name, self.path(key))
+        self._traces[key] = trace
+        return trace
+
+    def get_or_fit(self, image, grating, focus_pos, refit=False, **fit_kwargs):
+        """
+
+        :return: the cached Trace for this configuration, fitting (and caching) it from image if needed
+        """
+        trace = None if refit else self.get(grating, focus_pos, image.shape)
+        if trace is None:
+            with span("extraction.fit_trace", cat="analysis"):
+                trace = self.put(fit_trace(image, **fit_kwargs), grating, focus_pos)
+            metrics.incr("extraction.trace_fits")
+        return trace
+
+
+class SpectralExtractor:
+    """
+    Precomputed aperture, sky and profile weights for one Trace.
+    """
+    def __init__(self, trace, method='optimal', gain=1.0, readnoise=3.0):
+        """
+
+        :param method: 'boxcar' or 'optimal'
+        :param gain: detector gain, e-/ADU
+        :param readnoise: read noise, e-
+        """
+        if method not in EXTRACTION_METHODS:
+            raise ValueError('method must be one of %s' % str(EXTRACTION_METHODS))
+        self.trace = trace
+        self.method = method
+        self.gain = float(gain)
+        self.readnoise_adu = float(readnoise) / self.gain
+
+        centers = trace.centers()
+        reach = trace.half_width + trace.sky_gap + trace.sky_width
+        self.lo = int(max(np.floor(centers.min() - reach), 0))
+        self.hi = int(min(np.ceil(centers.max() + reach) + 1, trace.shape[0]))
+        offsets = np.arange(self.lo, self.hi, dtype=np.float32)[:, None] - centers[None, :].astype(np.float32)
+        distance = np.abs(offsets)
+
+        # fractional boxcar weights, so the aperture edge moves smoothly with the trace
+        self.aperture = np.clip(trace.half_width + 0.5 - distance, 0, 1).astype(np.float32)
+        sky = (distance > trace.half_width + trace.sky_gap) & (distance <= reach)
+        self.sky_mask = sky
+        profile = np.exp(-0.5 * (offsets / trace.sigma) ** 2) * (self.aperture > 0)
+        self.profile = (profile / profile.sum(axis=0)).astype(np.float32)
+
+    def extract(self, frames):
+        """
+        Extracts one spectrum per frame.
+
+        :param frames: a (rows, columns) frame or a (n, rows, columns) stack
+        :return: (flux, variance), each (columns,) or (n, columns), in ADU
+        """
+        data = np.asarray(frames)[..., self.lo:self.hi, :].astype(np.float32)
+        sky = np.nanmedian(np.where(self.sky_mask, data, np.nan), axis=-2)
+        sky = np.nan_to_num(sky)[..., None, :]
+        data -= sky
+        variance = (np.clip(data, 0, None) + np.clip(sky, 0, None)) / self.gain + self.readnoise_adu ** 2
+
+        if self.method == 'boxcar':
+            flux = (self.aperture * data).sum(axis=-2)
+            flux_variance = (self.aperture ** 2 * variance).sum(axis=-2)
+        else:
+            weights = self.profile / variance
+            norm = (weights * self.profile).sum(axis=-2)
+            flux = (weights * data).sum(axis=-2) / norm
+            flux_variance = self.profile.sum(axis=-2) / norm
+        return flux, flux_variance
+
+
+def spectrum_file_name(file_name):
+    return file_name.replace('.fits', '') + '_spec.fits'
+
+
+def write_spectrum(file_name, flux, variance, header=None, trace=None, method=None):
+    """
+    Writes a spectrum as a table of PIXEL, FLUX and VARIANCE, plus WAVE when
+    the frame header carries a wavelength solution.
+    """
+    columns = [fits.Column(name='PIXEL', format='J', array=np.arange(len(flux), dtype=np.int32)),
+               fits.Column(name='FLUX', format='E', unit='adu', array=flux),
+               fits.Column(name='VARIANCE', format='E', unit='adu2', array=variance)]
+    wavelengths = wavelengths_from_header(header, len(flux)) if header is not None else None
+    if wavelengths is not None:
+        columns.append(fits.Column(name='WAVE', format='D', unit='nm', array=wavelengths))
+    primary_header = fits.Header()
+    if header is not None:
+        for key in ['TARGET', 'EXPTIME', 'OBSTYPE', 'GAIN', 'GRATING', 'FOCUSPOS', 'MONOWAVE',
+                    'STARTEXP', 'ENDEXP', 'TIME', 'WAVCALK', 'WAVCALV', 'WAVRMS']:
+            if key in header:
+                primary_header[key] = (header[key], header.comments[key])
+    if method is not None:
+        primary_header['EXTMETH'] = (method, 'spectral extraction method')
+    if trace is not None:
+        primary_header['TRACEKEY'] = (trace.key, 'trace cache entry used')
+        primary_header['TRACESIG'] = (trace.sigma, '[pix] spatial profile sigma')
+        primary_header['APHALFW'] = (trace.half_width, '[pix] aperture half width')
+    hdul = fits.HDUList([fits.PrimaryHDU(header=primary_header),
+                         fits.BinTableHDU.from_columns(columns, name='SPECTRUM')])
+    hdul.writeto(file_name, overwrite=True)
+
+
+def skip_reason(header):
+    """
+
+    :return: why a frame cannot be extracted, or None if it can
+    """
+    if header.get('OBSTYPE') in ['BIAS', 'DARK']:
+        return '%s frame' % header['OBSTYPE']
+    missing = [key for key in ['GRATING', 'FOCUSPOS'] if key not in header]
+    if missing:
+        return 'no %s in header' % ' or '.join(missing)
+    return None
+
+
+class ExtractionStage:
+    """
+    Conversion stage that writes the spectrum of every frame next to it.
+
+    Called as stage(img, header, target_file) by mlof_stream_convert.py
+    and mlof_take_image.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, method='optimal', refit=False):
+        self.cache = TraceCache(cache_dir)
+        self.method = method
+        self.refit = refit
+        self._extractors = {}
+
+    def extractor(self, img, header):
+        """
+
+        :return: the SpectralExtractor of the frame's configuration; raises ValueError if its trace cannot be fitted
+        """
+        grating = header['GRATING']
+        focus_pos = header['FOCUSPOS']
+        key = TraceCache.key(grating, focus_pos, img.shape)
+        if key not in self._extractors:
+            trace = self.cache.get_or_fit(img, grating, focus_pos, refit=self.refit)
+            self._extractors[key] = SpectralExtractor(trace, method=self.method,
+                                                      gain=header.get('GAIN', 1.0),
+                                                      readnoise=header.get('RDNOISE', 3.0))
+        return self._extractors[key]
+
+    def __call__(self, img, header, target_file):
+        """
+
+        :return: True if a spectrum was written, False if the frame was skipped
+        """
+        reason = skip_reason(header)
+        if reason is None:
+            try:
+                extractor = self.extractor(img, header)
+            except ValueError as error:
+                reason = str(error)
+        if reason is not None:
+            print('Not extracting %s: %s' % (target_file, reason))
+            metrics.incr("extraction.skipped")
+            return False
+        with span("extraction.extract", cat="analysis"):
+            flux, variance = extractor.extract(img)
+            write_spectrum(spectrum_file_name(target_file), flux, variance, header=header,
+                           trace=extractor.trace, method=self.method)
+        metrics.incr("extraction.spectra")
+        return True
+
+
+def _extract_files(args):
+    file_names, cache_dir, method = args
+    stage = ExtractionStage(cache_dir=cache_dir, method=method)
+    n_spectra = 0
+    for file_name in file_names:
+        with fits.open(file_name) as hdul:
+            if stage(hdul[0].data, hdul[0].header, file_name):
+                n_spectra += 1
+    return n_spectra
+
+
+def extract_files(file_names, cache_dir=DEFAULT_CACHE_DIR, method='optimal', n_processes=1, refit=False):
+    """
+    Extracts the spectra of many frames, in parallel.
+
+    Traces missing from the cache are fitted first, from the first frame of
+    each configuration, so the workers only ever read the cache.
+
+    :return: the number of spectra written
+    """
+    stage = ExtractionStage(cache_dir=cache_dir, method=method, refit=refit)
+    seen = set()
+    for file_name in file_names:
+        header = fits.getheader(file_name)
+        if skip_reason(header) is not None:
+            continue
+        key = (header['GRATING'], header['FOCUSPOS'], header['NAXIS2'], header['NAXIS1'])
+        if key not in seen:
+            try:
+                stage.extractor(fits.getdata(file_name), header)
+                seen.add(key)
+            except ValueError:
+                # tried again on the next frame of this configuration
+                pass
+
+    if n_processes <= 1:
+        return _extract_files((file_names, cache_dir, method))
+    chunks = [(file_names[i::n_processes], cache_dir, method) for i in range(n_processes)]
+    with Pool(n_processes) as pool:
+        return sum(pool.map(_extract_files, chunks))
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] fits_files")
+
+    parser.add_option("-m","--method", default="optimal", help="extraction method: %s" % ", ".join(EXTRACTION_METHODS))
+    parser.add_option("-c","--cache_dir", default=DEFAULT_CACHE_DIR)
+    parser.add_option("-j","--n_processes", type=int, default=1)
+    parser.add_option("--refit", action="store_true", default=False, help="refit traces even if they are cached")
+    parser.add_option("--doExtract", action="store_true", default=False)
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+    configure_from_environment(process_name="spectral_extraction")
+
+    if opts.doExtract:
+        file_names = sorted(f for pattern in args for f in glob.glob(pattern) if not f.endswith('_spec.fits'))
+        n_spectra = extract_files(file_names, cache_dir=opts.cache_dir, method=opts.method,
+                                  n_processes=opts.n_processes, refit=opts.refit)
+        print('Extracted %d spectra' % n_spectra)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+.. module:: temperature_telemetry
+    :platform: unix
+    :synopsis: Detector temperature series recorded by configure_sasha, cut to exposure windows.
+
+While it runs, configure_sasha samples the sensor temperature and lock status
+in a background thread (every 500 ms by default, see its telemetry=period_ms
+argument) and appends each sample to <parameter prefix>_temperature.txt as
+
+    unix_time  degrees_C  status
+
+where status is the picam PicamSensorTemperatureStatus (1 unlocked, 2
+locked, 3 faulted). The converters cut the series to each exposure's window
+and attach it to the FITS file: summary keywords in the primary header and
+the samples themselves in a TEMPTRACE table extension.
+
+Typical usage:
+
+    python temperature_telemetry.py --doSummary exposure_params12_temperature.txt
+"""
+
+import os
+import optparse
+
+import numpy as np
+from astropy.io import fits
+
+UNLOCKED = 1
+LOCKED = 2
+FAULTED = 3
+
+
+def series_file_name(parameter_file_prefix):
+    return parameter_file_prefix + '_temperature.txt'
+
+
+class TemperatureSeries:
+    """
+    Samples of a temperature series file, re-read incrementally while configure_sasha appends to it.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._offset = 0
+        self._partial = ''
+        self._times = []
+        self._temperatures = []
+        self._statuses = []
+
+    def update(self):
+        """
+        Reads any samples appended since the last call.
+
+        :return: the number of new samples
+        """
+        if not os.path.isfile(self.file_name):
+            return 0
+        with open(self.file_name) as f:
+            f.seek(self._offset)
+            text = f.read()
+            self._offset = f.tell()
+        lines = (self._partial + text).split('\n')
+        # the last line may still be being written
+        self._partial = lines.pop()
+        n_new = 0
+        for line in lines:
+            fields = line.split()
+            if len(fields) == 3:
+                self._times.append(float(fields[0]))
+                self._temperatures.append(float(fields[1]))
+                self._statuses.append(int(fields[2]))
+                n_new += 1
+        return n_new
+
+    def __len__(self):
+        return len(self._times)
+
+    def window(self, start, end):
+        """
+
+        :param start: unix time of the start of the window
+        :param end: unix time of the end of the window
+        :return: (times, temperatures, statuses) arrays of the samples in [start, end]
+        """
+        times = np.array(self._times)
+        first = np.searchsorted(times, start, side='left')
+        last = np.searchsorted(times, end, side='right')
+        return (times[first:last], np.array(self._temperatures[first:last]),
+                np.array(self._statuses[first:last], dtype=np.int16))
+
+
+def trace_header_elems(times, temperatures, statuses):
+    """
+
+    :return: [key, value, comment] elements summarising a temperature trace
+    """
+    if len(times) == 0:
+        return [['TEMPNSMP', 0, 'temperature samples during exposure']]
+    return [['TEMPMEAN', round(float(np.mean(temperatures)), 3), '[C] mean CCD temperature during exposure'],
+            ['TEMPMIN', float(np.min(temperatures)), '[C] minimum CCD temperature during exposure'],
+            ['TEMPMAX', float(np.max(temperatures)), '[C] maximum CCD temperature during exposure'],
+            ['TEMPNSMP', len(times), 'temperature samples during exposure'],
+            ['TEMPLOCK', bool(np.all(statuses == LOCKED)), 'temperature locked throughout exposure']]
+
+
+def trace_hdu(times, temperatures, statuses):
+    """
+
+    :return: a TEMPTRACE table of TIME, TEMP and STATUS
+    """
+    columns = [fits.Column(name='TIME', format='D', unit='s', array=times),
+               fits.Column(name='TEMP', format='E', unit='deg C', array=temperatures),
+               fits.Column(name='STATUS', format='I', array=statuses)]
+    hdu = fits.BinTableHDU.from_columns(columns, name='TEMPTRACE')
+    hdu.header['STATLOCK'] = (LOCKED, 'STATUS value of a locked temperature')
+    return hdu
+
+
+def exposure_trace(series_file, start, end):
+    """
+    Cuts a series file to one exposure.
+
+    :param start: unix time the exposure started
+    :param end: unix time the exposure ended
+    :return: (header elements, list of extension HDUs); both empty if there is no series
+    """
+    if series_file is None or not os.path.isfile(series_file):
+        return [], []
+    series = TemperatureSeries(series_file)
+    series.update()
+    times, temperatures, statuses = series.window(start, end)
+    return trace_header_elems(times, temperatures, statuses), [trace_hdu(times, temperatures, statuses)]
+
+
+def exposure_window(exposure_parameter_file):
+    """
+
+    :return: (start, end) unix times of the shutter from the parameter file configure_sasha writes.
+             Older versions recorded whole seconds, in which case the end is extended to the end of its second.
+    """
+    with open(exposure_parameter_file) as f:
+        lines = [line.strip() for line in f.readlines()]
+    if '.' not in lines[2]:
+        return float(lines[1]), float(lines[2]) + 1.0
+    return float(lines[1]), float(lines[2])
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] temperature_series_file")
+
+    parser.add_option("--doSummary", action="store_true", default=False)
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+
+    if opts.doSummary:
+        for file_name in args:
+            series = TemperatureSeries(file_name)
+            series.update()
+            times, temperatures, statuses = series.window(-np.inf, np.inf)
+            if len(times) == 0:
+                print('%s: no samples' % file_name)
+                continue
+            print('%s: %d samples over %.1f s, %.2f to %.2f C (mean %.3f), locked %.0f%% of the time' %
+                  (file_name, len(times), times[-1] - times[0], temperatures.min(), temperatures.max(),
+                   temperatures.mean(), 100.0 * np.mean(statuses == LOCKED)))
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+"""
+.. module:: wavelength_calibration
+    :platform: unix
+    :synopsis: Pixel to wavelength solutions fitted from monochromator sweeps, cached per configuration.
+
+A monochromator sweep (Monochromater.scan, or one mlof_take_image per
+gowave) gives frames of a single line at a known wavelength, recorded in the
+MONOWAVE header keyword. The line is centroided in every frame at once, on a
+(frames, columns) stack of collapsed profiles, and a polynomial
+wavelength(column) is fitted with one round of sigma clipping.
+
+Solutions are stored in a versioned local cache, one JSON file per fit:
+
+    ~/.mlof/cache/wavecal/wavecal_g<grating>_f<focus>_t<temperature>_v<version>.json
+
+Later frames taken with the same grating and focus position, at a sensor
+temperature within the tolerance, get the newest matching solution applied
+as WCS keywords when they are converted; nothing is refitted. A solution
+records which sensor columns its sweep read out (DETSEC and XBINNING), so
+it is rescaled to the columns of binned or ROI frames, and not applied to
+frames reaching beyond the columns the sweep covered.
+
+Typical usage:
+
+    python wavelength_calibration.py --doFit /data/2023_05_01/sweep_*.fits
+    python wavelength_calibration.py --doList
+"""
+
+import os
+import re
+import glob
+import json
+import optparse
+
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+
+from instrumentation import configure_from_environment, span
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('MLOF_CACHE', os.path.expanduser('~/.mlof/cache')), 'wavecal')
+FILE_PATTERN = re.compile(r'wavecal_g(?P<grating>[^_]+)_f(?P<focus>[-0-9.]+)_t(?P<temperature>[-0-9.]+)_v(?P<version>\d+)\.json$')
+
+
+def collapse_frames(frames):
+    """
+
+    :param frames: (n, rows, columns) stack of sweep frames
+    :return: (n, columns) background-subtracted profiles, summed over the rows
+    """
+    profiles = np.asarray(frames, dtype=np.float32).sum(axis=-2)
+    return profiles - np.median(profiles, axis=-1, keepdims=True)
+
+
+def centroid_lines(profiles, half_width=5):
+    """
+    Centroids the brightest line of every profile at once.
+
+    :param profiles: (n, columns) background-subtracted profiles
+    :param half_width: columns either side of the peak used for the centroid
+    :return: (centroids, peak fluxes), each (n,)
+    """
+    profiles = np.asarray(profiles, dtype=np.float32)
+    n, n_cols = profiles.shape
+    peaks = np.argmax(profiles, axis=1)
+    offsets = np.arange(-half_width, half_width + 1)
+    columns = np.clip(peaks[:, None] + offsets[None, :], 0, n_cols - 1)
+    window = np.clip(np.take_along_axis(profiles, columns, axis=1), 0, None)
+    flux = window.sum(axis=1)
+    centroids = (window * columns).sum(axis=1) / np.where(flux > 0, flux, 1)
+    return centroids, profiles[np.arange(n), peaks]
+
+
+class WavelengthSolution:
+    """
+    Polynomial wavelength (nm) as a function of column, for one instrument configuration.
+    """
+    def __init__(self, coeffs, grating, focus_pos, temperature, n_columns, rms=0.0,
+                 n_lines=0, version=None, created=None, x_offset=0, x_binning=1):
+        """
+
+        :param n_columns: columns of the frames the solution applies to
+        :param x_offset: first unbinned sensor column of those frames
+        :param x_binning: sensor columns binned into each of their columns
+        """
+        self.coeffs = [float(c) for c in coeffs]
+        self.grating = grating
+        self.focus_pos = float(focus_pos)
+        self.temperature = float(temperature)
+        self.n_columns = int(n_columns)
+        self.rms = float(rms)
+        self.n_lines = int(n_lines)
+        self.version = version
+        self.created = created
+        self.x_offset = int(x_offset)
+        self.x_binning = int(x_binning)
+
+    def __call__(self, columns):
+        return np.polyval(self.coeffs, columns)
+
+    @property
+    def key(self):
+        return 'g%s_f%.2f_t%.1f' % (self.grating, self.focus_pos, self.temperature)
+
+    def to_dict(self):
+        return {'coeffs': self.coeffs, 'grating': self.grating, 'focus_pos': self.focus_pos,
+                'temperature': self.temperature, 'n_columns': self.n_columns, 'rms': self.rms,
+                'n_lines': self.n_lines, 'version': self.version, 'created': self.created,
+                'x_offset': self.x_offset, 'x_binning': self.x_binning}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    def sensor_columns(self, columns, x_offset=None, x_binning=None):
+        """
+
+        :return: unbinned sensor column at the centre of each column of a frame read out
+                 from x_offset with x_binning (by default, the frames of this solution)
+        """
+        if x_offset is None:
+            x_offset = self.x_offset
+        if x_binning is None:
+            x_binning = self.x_binning
+        return x_offset + x_binning * np.asarray(columns, dtype=float) + (x_binning - 1) / 2.0
+
+    def for_frame(self, n_columns, x_offset=0, x_binning=1):
+        """
+        The solution in the columns of a frame with another readout geometry.
+
+        :return: a WavelengthSolution for the frame
+        :raises ValueError: if the frame reaches beyond the sensor columns the sweep covered
+        """
+        if (n_columns, x_offset, x_binning) == (self.n_columns, self.x_offset, self.x_binning):
+            return self
+        first, last = self.sensor_columns([0, self.n_columns - 1])
+        frame_first, frame_last = self.sensor_columns([0, n_columns - 1], x_offset, x_binning)
+        if frame_first < first - 0.5 or frame_last > last + 0.5:
+            raise ValueError('Frame covers sensor columns %.1f-%.1f, the solution only %.1f-%.1f' %
+                             (frame_first, frame_last, first, last))
+        # column of this solution = scale * column of the frame + shift
+        scale = float(x_binning) / self.x_binning
+        shift = (self.sensor_columns(0, x_offset, x_binning) - self.sensor_columns(0)) / self.x_binning
+        coeffs = (np.poly1d(self.coeffs)(np.poly1d([scale, shift]))).coeffs
+        # keep the order, even where the composition leaves leading zeros out
+        coeffs = np.concatenate([np.zeros(len(self.coeffs) - len(coeffs)), coeffs])
+        values = self.to_dict()
+        values.update(coeffs=coeffs, n_columns=n_columns, x_offset=x_offset, x_binning=x_binning)
+        return WavelengthSolution.from_dict(values)
+
+    def header_elems(self):
+        """
+
+        :return: [key, value, comment] WCS elements: a linear approximation plus the exact polynomial
+        """
+        center = (self.n_columns - 1) / 2.0
+        dispersion = float(np.polyval(np.polyder(self.coeffs), center))
+        header_elems = [['CTYPE1', 'WAVE', 'wavelength along axis 1'],
+                        ['CUNIT1', 'nm', 'wavelength unit'],
+                        ['CRPIX1', center + 1, 'reference pixel (FITS, 1-based)'],
+                        ['CRVAL1', float(self(center)), '[nm] wavelength at reference pixel'],
+                        ['CDELT1', dispersion, '[nm/pix] dispersion at reference pixel'],
+                        ['WAVORDER', len(self.coeffs) - 1, 'order of the wavelength polynomial'],
+                        ['WAVCALK', self.key, 'wavelength calibration cache key'],
+                        ['WAVCALV', self.version, 'wavelength calibration version'],
+                        ['WAVRMS', self.rms, '[nm] rms of the wavelength fit']]
+        # highest power first, as np.polyval of the 0-based column
+        for i, coeff in enumerate(self.coeffs):
+            header_elems.append(['WAVCOEF%d' % i, coeff, 'wavelength polynomial coefficient'])
+        return header_elems
+
+
+def fit_solution(centroids, wavelengths, order=2, clip_sigma=3.0):
+    """
+    Fits wavelength versus column with one round of sigma clipping.
+
+    :return: (coeffs, rms, number of lines kept)
+    """
+    centroids = np.asarray(centroids, dtype=float)
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    if len(centroids) <= order:
+        raise ValueError('Need more than %d lines for an order %d fit, got %d' % (order, order, len(centroids)))
+    coeffs = np.polyfit(centroids, wavelengths, order)
+    residuals = wavelengths - np.polyval(coeffs, centroids)
+    keep = np.abs(residuals) <= clip_sigma * max(np.std(residuals), 1e-6)
+    if keep.sum() > order and not keep.all():
+        coeffs = np.polyfit(centroids[keep], wavelengths[keep], order)
+        residuals = wavelengths[keep] - np.polyval(coeffs, centroids[keep])
+    return coeffs, float(np.sqrt(np.mean(residuals ** 2))), int(keep.sum())
+
+
+class CalibrationCache:
+    """
+    Versioned on-disk store of WavelengthSolutions.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, temperature_tolerance=2.0):
+        """
+
+        :param temperature_tolerance: largest sensor temperature difference (C) a solution is reused over
+        """
+        self.cache_dir = cache_dir
+        self.temperature_tolerance = temperature_tolerance
+
+    def entries(self):
+        """
+
+        :return: list of (grating, focus_pos, temperature, version, path) in the cache
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            match = FILE_PATTERN.match(file_name)
+            if match:
+                entries.append((match.group('grating'), float(match.group('focus')),
+                                float(match.group('temperature')), int(match.group('version')),
+                                os.path.join(self.cache_dir, file_name)))
+        return entries
+
+    def put(self, solution):
+        """
+        Stores a solution as the next version for its configuration.
+        """
+        versions = [version for grating, focus, temperature, version, path in self.entries()
+                    if grating == str(solution.grating) and abs(focus - solution.focus_pos) < 0.005
+                    and abs(temperature - solution.temperature) < 0.05]
+        solution.version = max(versions) + 1 if versions else 1
+        solution.created = Time.now().isot
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = os.path.join(self.cache_dir, 'wavecal_%s_v%d.json' % (solution.key, solution.version))
+        tmp_name = path + '.tmp%d' % os.getpid()
+        with open(tmp_name, 'w') as f:
+            json.dump(solution.to_dict(), f, indent=2)
+        os.replace(tmp_name, path)
+        return path
+
+    def lookup(self, grating, focus_pos, temperature=None):
+        """
+
+        :return: the newest solution for this grating and focus position at the closest
+                 temperature within tolerance, or None
+        """
+        candidates = []
+        for entry_grating, focus, entry_temperature, version, path in self.entries():
+            if entry_grating != str(grating) or abs(focus - float(focus_pos)) >= 0.005:
+                continue
+            distance = 0.0 if temperature is None else abs(entry_temperature - float(temperature))
+            if distance <= self.temperature_tolerance:
+                candidates.append((distance, -version, path))
+        if not candidates:
+            return None
+        with open(min(candidates)[2]) as f:
+            return WavelengthSolution.from_dict(json.load(f))
+
+
+def header_value(header_elems, key, default=None):
+    """
+
+    :return: the value of key in a list of [key, value, comment] header elements
+    """
+    for header_elem in header_elems:
+        if header_elem[0] == key:
+            return header_elem[1]
+    return default
+
+
+def wavelengths_from_header(header, n_columns):
+    """
+
+    :param header: FITS header carrying the WAVCOEF keywords written by WavelengthSolution.header_elems
+    :return: wavelength (nm) of each column, or None if the header has no solution
+    """
+    if 'WAVORDER' not in header:
+        return None
+    coeffs = [header['WAVCOEF%d' % i] for i in range(header['WAVORDER'] + 1)]
+    return np.polyval(coeffs, np.arange(n_columns))
+
+
+def calibration_header_elems(header_elems, geometry, cache_dir=DEFAULT_CACHE_DIR, temperature_tolerance=2.0):
+    """
+    Looks up the solution for the configuration described by header_elems
+    (GRATING, FOCUSPOS, TEMP) and returns its WCS header elements, in the
+    columns of frames read out with geometry.
+
+    :param geometry: FrameGeometry of the frames the solution is written into
+    :return: list of [key, value, comment], empty if no solution applies
+    """
+    grating = header_value(header_elems, 'GRATING')
+    focus_pos = header_value(header_elems, 'FOCUSPOS')
+    if grating is None or focus_pos is None:
+        return []
+    temperature = header_value(header_elems, 'TEMP')
+    if temperature is None:
+        # solutions are only valid near the temperature they were fitted at
+        print('No sensor temperature known; not applying a wavelength solution')
+        return []
+    cache = CalibrationCache(cache_dir, temperature_tolerance=temperature_tolerance)
+    solution = cache.lookup(grating, focus_pos, temperature)
+    if solution is None:
+        print('No wavelength solution cached for grating %s, focus position %s' % (grating, focus_pos))
+        return []
+    x_offset, width, x_binning = geometry.rois[0][:3]
+    try:
+        solution = solution.for_frame(width // x_binning, x_offset=x_offset, x_binning=x_binning)
+    except ValueError as e:
+        print('Not applying the wavelength solution: %s' % e)
+        return []
+    return solution.header_elems()
+
+
+def detector_columns(header):
+    """
+
+    :return: (first unbinned sensor column, x binning) of a converted frame, from DETSEC and XBINNING
+    """
+    x_offset = 0
+    if 'DETSEC' in header:
+        x_offset = int(header['DETSEC'].strip('[]').split(',')[0].split(':')[0]) - 1
+    return x_offset, int(header.get('XBINNING', 1))
+
+
+def fit_sweep(file_names, order=2, half_width=5, min_peak=None, grating=None, focus_pos=None, temperature=None):
+    """
+    Fits a solution from sweep frames carrying MONOWAVE (and GRATING, FOCUSPOS, TEMP) keywords.
+
+    Frames are read one at a time into a (frames, columns) profile stack, so
+    the sweep never has to fit in memory as images.
+
+    :param min_peak: ignore frames whose line peak is below this (defaults to half the median peak)
+    :return: a WavelengthSolution
+    :raises ValueError: if the grating, focus position or temperature is neither given nor recorded
+    """
+    profiles = []
+    wavelengths = []
+    temperatures = []
+    header = None
+    columns = None
+    for file_name in file_names:
+        with fits.open(file_name) as hdul:
+            header = hdul[0].header
+            if 'MONOWAVE' not in header:
+                print('Skipping %s: no MONOWAVE keyword' % file_name)
+                continue
+            profiles.append(collapse_frames(hdul[0].data[None])[0])
+            wavelengths.append(float(header['MONOWAVE']))
+            if 'TEMP' in header:
+                temperatures.append(float(header['TEMP']))
+            if grating is None:
+                grating = header.get('GRATING')
+            if focus_pos is None:
+                focus_pos = header.get('FOCUSPOS')
+            if columns is None:
+                columns = detector_columns(header)
+            elif detector_columns(header) != columns:
+                raise ValueError('%s was read out from other sensor columns than the frames before it' % file_name)
+    if not profiles:
+        raise ValueError('No sweep frames with MONOWAVE found')
+    # a solution filed under a made-up configuration would never be looked up
+    if grating is None:
+        raise ValueError('No GRATING recorded in the sweep frames; give it with -g')
+    if focus_pos is None:
+        raise ValueError('No FOCUSPOS recorded in the sweep frames; give it with -f')
+    if temperature is None and not temperatures:
+        raise ValueError('No TEMP recorded in the sweep frames; give it with -t')
+
+    profiles = np.array(profiles)
+    centroids, peaks = centroid_lines(profiles, half_width=half_width)
+    if min_peak is None:
+        min_peak = 0.5 * np.median(peaks)
+    lit = peaks >= min_peak
+    coeffs, rms, n_lines = fit_solution(centroids[lit], np.array(wavelengths)[lit], order=order)
+    if temperature is None:
+        temperature = np.median(temperatures)
+    return WavelengthSolution(coeffs, grating, focus_pos, round(float(temperature), 1), profiles.shape[1],
+                              rms=rms, n_lines=n_lines, x_offset=columns[0], x_binning=columns[1])
+
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] sweep_fits_files")
+
+    parser.add_option("-c","--cache_dir", default=DEFAULT_CACHE_DIR)
+    parser.add_option("--order", type=int, default=2)
+    parser.add_option("--half_width", type=int, default=5, help="columns either side of the line peak used for the centroid")
+    parser.add_option("-g","--grating", default=None, help="override the GRATING keyword")
+    parser.add_option("-f","--focus_pos", type=float, default=None, help="override the FOCUSPOS keyword")
+    parser.add_option("-t","--temperature", type=float, default=None, help="override the median TEMP of the sweep")
+    parser.add_option("--doFit", action="store_true", default=False)
+    parser.add_option("--doList", action="store_true", default=False)
+
+    opts, args = parser.parse_args()
+
+    return opts, args
+
+
+if __name__ == "__main__":
+
+    # Parse command line
+    opts, args = parse_commandline()
+    configure_from_environment(process_name="wavelength_calibration")
+
+    cache = CalibrationCache(opts.cache_dir)
+    if opts.doFit:
+        file_names = sorted(f for pattern in args for f in glob.glob(pattern))
+        with span("wavecal.fit", cat="analysis", n_frames=len(file_names)):
+            solution = fit_sweep(file_names, order=opts.order, half_width=opts.half_width,
+                                 grating=opts.grating, focus_pos=opts.focus_pos, temperature=opts.temperature)
+        path = cache.put(solution)
+        print('Fitted %d lines, rms %.4f nm; saved version %d to %s' % (solution.n_lines, solution.rms, solution.version, path))
+    if opts.doList:
+        for grating, focus, temperature, version, path in sorted(cache.entries()):
+            print('grating %s  focus %.2f mm  temperature %.1f C  version %d  %s' % (grating, focus, temperature, version, path))
@@ -17,9 +17,134 @@
 #include "stdio.h"
 #include "picam.h"
 #include <time.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <pthread.h>
+#include <errno.h>
+#include <sys/time.h>
 
 using namespace std;
 
+// - span tracing, enabled by pointing MLOF_TRACE at a Chrome trace file
+//   (the same file the python tools append to, see bin/instrumentation.py)
+const char* trace_file = getenv( "MLOF_TRACE" );
+
+double WallClockMicroseconds()
+{
+    struct timespec ts;
+    clock_gettime( CLOCK_REALTIME, &ts );
+    return ts.tv_sec * 1e6 + ts.tv_nsec / 1e3;
+}
+
+double MonotonicMicroseconds()
+{
+    struct timespec ts;
+    clock_gettime( CLOCK_MONOTONIC, &ts );
+    return ts.tv_sec * 1e6 + ts.tv_nsec / 1e3;
+}
+
+// - creates the trace file already holding the "[" that opens the JSON array;
+//   the header goes to a temporary file that is hard-linked into place, so no
+//   other process can append before it (as Tracer._create in bin/instrumentation.py)
+void CreateTraceFile()
+{
+    if( access( trace_file, F_OK ) == 0 )
+        return;
+    ostringstream tmp_name;
+    tmp_name << trace_file << "." << getpid() << "." << pthread_self() << ".tmp";
+    int fd = open( tmp_name.str().c_str(), O_WRONLY | O_CREAT | O_TRUNC, 0666 );
+    if( fd < 0 )
+        return;
+    bool written = write( fd, "[\n", 2 ) == 2;
+    close( fd );
+    if( written && link( tmp_name.str().c_str(), trace_file ) < 0 ) {}
+    unlink( tmp_name.str().c_str() );
+}
+
+void WriteTraceEvent( const string& event )
+{
+    CreateTraceFile();
+    int fd = open( trace_file, O_WRONLY | O_CREAT | O_APPEND, 0666 );
+    if( fd < 0 )
+        return;
+    if( write( fd, event.c_str(), event.size() ) < 0 ) {}
+    close( fd );
+}
+
+// - times the enclosing scope and writes a complete ("X") event on exit
+struct TraceSpan
+{
+    const char* name;
+    const char* cat;
+    double wall_start;
+    double mono_start;
+
+    TraceSpan( const char* span_name, const char* span_cat = "picam" )
+        : name( span_name ), cat( span_cat ), wall_start( 0 ), mono_start( 0 )
+    {
+        if( !trace_file )
+            return;
+        wall_start = WallClockMicroseconds();
+        mono_start = MonotonicMicroseconds();
+    }
+
+    ~TraceSpan()
+    {
+        if( !trace_file )
+            return;
+        std::ostringstream ss;
+        ss << fixed << setprecision( 3 )
+           << "{\"name\": \"" << name << "\", \"cat\": \"" << cat
+           << "\", \"ph\": \"X\", \"ts\": " << wall_start
+           << ", \"dur\": " << MonotonicMicroseconds() - mono_start
+           << ", \"pid\": " << getpid() << ", \"tid\": 0},\n";
+        WriteTraceEvent( ss.str() );
+    }
+};
+
+// - writes a complete ("X") event for a span timed elsewhere, e.g. an
+//   exposure placed from when its readout arrived
+void TraceComplete( const char* name, const char* cat, double wall_start, double dur, long readout )
+{
+    if( !trace_file )
+        return;
+    std::ostringstream ss;
+    ss << fixed << setprecision( 3 )
+       << "{\"name\": \"" << name << "\", \"cat\": \"" << cat
+       << "\", \"ph\": \"X\", \"ts\": " << wall_start
+       << ", \"dur\": " << dur
+       << ", \"pid\": " << getpid() << ", \"tid\": 0, \"args\": {\"readout\": " << readout << "}},\n";
+    WriteTraceEvent( ss.str() );
+}
+
+// - per-readout timestamps, written to <parameter prefix>_timing.txt as
+//     readout  event  monotonic_seconds  unix_seconds
+//   (see bin/exposure_timing.py); each line is flushed as it is written so
+//   that a converter following the acquisition can read it straight away
+struct TimingLog
+{
+    FILE* file;
+
+    TimingLog( const string& file_name )
+    {
+        file = fopen( file_name.c_str(), "w" );
+    }
+
+    ~TimingLog()
+    {
+        if( file )
+            fclose( file );
+    }
+
+    void Mark( long readout, const char* event, double mono_us, double wall_us )
+    {
+        if( !file )
+            return;
+        fprintf( file, "%ld %s %.6f %.6f\n", readout, event, mono_us / 1e6, wall_us / 1e6 );
+        fflush( file );
+    }
+};
+
 string ConvertFloatToString(double value_as_float, int target_precision) 
 {
     std::ostringstream ss;
@@ -124,8 +249,62 @@ void CalculateMean( PicamHandle camera, const PicamAvailableData& available )
     }
 }
 
+// - restricts the readout to a single region of interest, binned on chip
+void ConfigureRoi( PicamHandle camera, const PicamRoi& requested )
+{
+    PicamError error;
+    const PicamRois* rois;
+    error = Picam_GetParameterRoisValue( camera, PicamParameter_Rois, &rois );
+    if( error != PicamError_None )
+    {
+        std::cout << "Could not read the current ROI ... ";
+        PrintError( error );
+        return;
+    }
+    std::cout << "Set ROI x=" << requested.x << " width=" << requested.width
+              << " x_binning=" << requested.x_binning << " y=" << requested.y
+              << " height=" << requested.height << " y_binning=" << requested.y_binning << " ... ";
+    rois->roi_array[0] = requested;
+    PicamRois single_roi = *rois;
+    single_roi.roi_count = 1;
+    error = Picam_SetParameterRoisValue( camera, PicamParameter_Rois, &single_roi );
+    PrintError( error );
+    Picam_DestroyRois( rois );
+}
+
+// - writes the layout of a readout (what the converters need to decode it)
+//   as "key value" lines: readout_stride, frame_size, pixel_bit_depth and
+//   one "roi x width x_binning y height y_binning" line per region
+void WriteGeometry( PicamHandle camera, string file_name )
+{
+    piint readout_stride = 0;
+    Picam_GetParameterIntegerValue( camera, PicamParameter_ReadoutStride, &readout_stride );
+    piint frame_size = 0;
+    Picam_GetParameterIntegerValue( camera, PicamParameter_FrameSize, &frame_size );
+    piint bit_depth = 0;
+    Picam_GetParameterIntegerValue( camera, PicamParameter_PixelBitDepth, &bit_depth );
+
+    ofstream outputFile;
+    outputFile.open( file_name.c_str() );
+    outputFile << "readout_stride " << readout_stride << "\n";
+    outputFile << "frame_size " << frame_size << "\n";
+    outputFile << "pixel_bit_depth " << bit_depth << "\n";
+    const PicamRois* rois;
+    if( Picam_GetParameterRoisValue( camera, PicamParameter_Rois, &rois ) == PicamError_None )
+    {
+        for( piint i = 0; i < rois->roi_count; ++i )
+        {
+            const PicamRoi& roi = rois->roi_array[i];
+            outputFile << "roi " << roi.x << " " << roi.width << " " << roi.x_binning << " "
+                       << roi.y << " " << roi.height << " " << roi.y_binning << "\n";
+        }
+        Picam_DestroyRois( rois );
+    }
+    outputFile.close();
+}
+
 // - changes some common camera parameters and applies them to hardware
-void Configure( PicamHandle camera, float exp_time, int gain_setting, int fast, int shutter)
+void Configure( PicamHandle camera, float exp_time, int gain_setting, int fast, int shutter, const PicamRoi* roi = NULL )
 {
     PicamError error;
 
@@ -239,6 +418,10 @@ void Configure( PicamHandle camera, float exp_time, int gain_setting, int fast,
             exp_time );
     PrintError( error );
 
+    // - optionally read out only a binned region of interest
+    if( roi )
+        ConfigureRoi( camera, *roi );
+
     // - show that the modified parameters need to be applied to hardware
     pibln committed;
     Picam_AreParametersCommitted( camera, &committed );
@@ -251,11 +434,14 @@ void Configure( PicamHandle camera, float exp_time, int gain_setting, int fast,
     std::cout << "Commit to hardware: ";
     const PicamParameter* failed_parameters;
     piint failed_parameters_count;
-    error =
-        Picam_CommitParameters(
-            camera,
-            &failed_parameters,
-            &failed_parameters_count );
+    {
+        TraceSpan trace( "Picam_CommitParameters" );
+        error =
+            Picam_CommitParameters(
+                camera,
+                &failed_parameters,
+                &failed_parameters_count );
+    }
     PrintError( error );
 
     // - print any invalid parameters
@@ -319,6 +505,188 @@ void Acquire( PicamHandle camera )
     }
 }
 
+// - detector temperature telemetry
+//   a background thread reads the sensor temperature and lock status every
+//   period_ms into a ring buffer, and appends every sample to an on-disk
+//   series (<parameter prefix>_temperature.txt, one "unix_time degrees_C status"
+//   line per sample) that the converters cut to each exposure's window
+struct TemperatureSample
+{
+    double time;
+    piflt temperature;
+    piint status;
+};
+
+const int telemetry_capacity = 4096;
+
+struct TemperatureTelemetry
+{
+    PicamHandle camera;
+    int period_ms;
+    FILE* series_file;
+    TemperatureSample samples[telemetry_capacity];
+    long n_samples;
+    bool running;
+    pthread_t thread;
+    pthread_mutex_t mutex;
+    pthread_cond_t changed;
+
+    TemperatureTelemetry()
+        : camera( NULL ), period_ms( 500 ), series_file( NULL ), n_samples( 0 ), running( false )
+    {
+        pthread_mutex_init( &mutex, NULL );
+        pthread_cond_init( &changed, NULL );
+    }
+
+    // - takes one sample from hardware and publishes it
+    void Sample()
+    {
+        TemperatureSample sample;
+        sample.temperature = 0;
+        sample.status = 0;
+        PicamError error;
+        {
+            TraceSpan trace( "Picam_ReadSensorTemperature", "telemetry" );
+            error = Picam_ReadParameterFloatingPointValue(
+                camera, PicamParameter_SensorTemperatureReading, &sample.temperature );
+            if( error == PicamError_None )
+                error = Picam_ReadParameterIntegerValue(
+                    camera, PicamParameter_SensorTemperatureStatus, &sample.status );
+        }
+        sample.time = WallClockMicroseconds() / 1e6;
+        if( error != PicamError_None )
+            return;
+
+        pthread_mutex_lock( &mutex );
+        samples[n_samples % telemetry_capacity] = sample;
+        n_samples++;
+        pthread_cond_broadcast( &changed );
+        pthread_mutex_unlock( &mutex );
+
+        if( series_file )
+        {
+            fprintf( series_file, "%.6f %.3f %d\n", sample.time, sample.temperature, sample.status );
+            fflush( series_file );
+        }
+    }
+
+    static void* Run( void* self )
+    {
+        TemperatureTelemetry* telemetry = static_cast<TemperatureTelemetry*>( self );
+        pthread_mutex_lock( &telemetry->mutex );
+        while( telemetry->running )
+        {
+            pthread_mutex_unlock( &telemetry->mutex );
+            telemetry->Sample();
+            pthread_mutex_lock( &telemetry->mutex );
+
+            // - sleep for one period, or until Stop wakes us
+            struct timeval now;
+            gettimeofday( &now, NULL );
+            long nanoseconds = now.tv_usec * 1000L + ( telemetry->period_ms % 1000 ) * 1000000L;
+            struct timespec deadline;
+            deadline.tv_sec = now.tv_sec + telemetry->period_ms / 1000 + nanoseconds / 1000000000L;
+            deadline.tv_nsec = nanoseconds % 1000000000L;
+            while( telemetry->running &&
+                   pthread_cond_timedwait( &telemetry->changed, &telemetry->mutex, &deadline ) != ETIMEDOUT )
+                ;
+        }
+        pthread_mutex_unlock( &telemetry->mutex );
+        return NULL;
+    }
+
+    bool Start( PicamHandle telemetry_camera, string series_file_name, int telemetry_period_ms )
+    {
+        camera = telemetry_camera;
+        period_ms = telemetry_period_ms > 0 ? telemetry_period_ms : 500;
+        series_file = fopen( series_file_name.c_str(), "w" );
+        running = true;
+        if( pthread_create( &thread, NULL, Run, this ) != 0 )
+        {
+            running = false;
+            std::cout << "Could not start the temperature telemetry thread" << std::endl;
+            return false;
+        }
+        return true;
+    }
+
+    void Stop()
+    {
+        pthread_mutex_lock( &mutex );
+        bool was_running = running;
+        running = false;
+        pthread_cond_broadcast( &changed );
+        pthread_mutex_unlock( &mutex );
+        if( was_running )
+            pthread_join( thread, NULL );
+        if( series_file )
+        {
+            fclose( series_file );
+            series_file = NULL;
+        }
+    }
+
+    // - the most recent sample; false if there is none yet
+    bool Latest( TemperatureSample* sample )
+    {
+        pthread_mutex_lock( &mutex );
+        bool found = n_samples > 0;
+        if( found )
+            *sample = samples[( n_samples - 1 ) % telemetry_capacity];
+        pthread_mutex_unlock( &mutex );
+        return found;
+    }
+
+    // - mean temperature of the buffered samples taken between start and end
+    //   (unix seconds); returns the number of samples used
+    int WindowMean( double start, double end, double* mean )
+    {
+        pthread_mutex_lock( &mutex );
+        long first = n_samples > telemetry_capacity ? n_samples - telemetry_capacity : 0;
+        int n = 0;
+        double sum = 0;
+        for( long i = first; i < n_samples; i++ )
+        {
+            const TemperatureSample& sample = samples[i % telemetry_capacity];
+            if( sample.time >= start && sample.time <= end )
+            {
+                sum += sample.temperature;
+                n++;
+            }
+        }
+        pthread_mutex_unlock( &mutex );
+        if( n )
+            *mean = sum / n;
+        return n;
+    }
+
+    // - returns straight away if the last sample was locked, otherwise waits
+    //   for the sampler to see a lock (timeout_seconds < 0 waits indefinitely)
+    bool WaitForLock( double timeout_seconds )
+    {
+        double deadline = WallClockMicroseconds() / 1e6 + timeout_seconds;
+        pthread_mutex_lock( &mutex );
+        bool locked = false;
+        while( running )
+        {
+            locked = n_samples > 0 &&
+                samples[( n_samples - 1 ) % telemetry_capacity].status == PicamSensorTemperatureStatus_Locked;
+            if( locked || ( timeout_seconds >= 0 && WallClockMicroseconds() / 1e6 >= deadline ) )
+                break;
+            struct timeval now;
+            gettimeofday( &now, NULL );
+            struct timespec wake;
+            wake.tv_sec = now.tv_sec + 1;
+            wake.tv_nsec = now.tv_usec * 1000L;
+            pthread_cond_timedwait( &changed, &mutex, &wake );
+        }
+        pthread_mutex_unlock( &mutex );
+        return locked;
+    }
+};
+
+TemperatureTelemetry telemetry;
+
 // - reads the temperature and temperature status directly from hardware
 //   and waits for temperature to lock if requested
 void ReadTemperature( PicamHandle camera, pibool lock, piflt* temperature )
@@ -327,11 +695,14 @@ void ReadTemperature( PicamHandle camera, pibool lock, piflt* temperature )
 
     // - read temperature
     std::cout << "Read sensor temperature: ";
-    error =
-        Picam_ReadParameterFloatingPointValue(
-            camera,
-            PicamParameter_SensorTemperatureReading,
-            temperature );
+    {
+        TraceSpan trace( "Picam_ReadSensorTemperature" );
+        error =
+            Picam_ReadParameterFloatingPointValue(
+                camera,
+                PicamParameter_SensorTemperatureReading,
+                temperature );
+    }
     PrintError( error );
     if( error == PicamError_None )
     {
@@ -364,9 +735,11 @@ void ReadTemperature( PicamHandle camera, pibool lock, piflt* temperature )
 
 
     // - wait indefinitely for temperature to lock if requested
-    if( lock )
+    //   (with telemetry running, exposures are gated on its samples instead, see GateOnLock)
+    if( lock && !telemetry.running )
     {
         std::cout << "Waiting for temperature lock: ";
+        TraceSpan trace( "Picam_WaitForTemperatureLock" );
         error =
             Picam_WaitForStatusParameterValue(
                 camera,
@@ -377,10 +750,26 @@ void ReadTemperature( PicamHandle camera, pibool lock, piflt* temperature )
     }
 }
 
+// - holds an exposure until the telemetry has seen the temperature lock;
+//   costs nothing once it is locked, so it runs before every exposure
+void GateOnLock()
+{
+    TemperatureSample sample;
+    if( telemetry.Latest( &sample ) && sample.status == PicamSensorTemperatureStatus_Locked )
+        return;
+    std::cout << "Waiting for temperature lock..." << std::endl;
+    TraceSpan trace( "WaitForTemperatureLock", "telemetry" );
+    telemetry.WaitForLock( -1 );
+    if( telemetry.Latest( &sample ) )
+        std::cout << "    Locked at " << sample.temperature << " degrees C" << std::endl;
+}
+
 
 // - Saves a single frames worth of data to a raw filter 
-void SaveData( PicamHandle camera, const PicamAvailableData& available, string file_name)
+//   (or, with append, adds the readouts to the end of a growing raw file)
+void SaveData( PicamHandle camera, const PicamAvailableData& available, string file_name, bool append = false )
 {  
+    TraceSpan trace( "SaveData", "io" );
     FILE *pFile;  
     // std::cout << "We have defined SaveData" << std::endl; 
     piint bit_depth;
@@ -400,7 +789,7 @@ void SaveData( PicamHandle camera, const PicamAvailableData& available, string f
     // std::cout << "available.readout_count: " << available.readout_count << std::endl;
     // std::cout << "available.initial_readout:" << std::endl;
     // std::cout << available.initial_readout << std::endl;
-    pFile = fopen( file_name.c_str(), "wb" );
+    pFile = fopen( file_name.c_str(), append ? "ab" : "wb" );
     if( pFile )
     {
         if( !fwrite( available.initial_readout, 1, (available.readout_count * readoutstride), pFile ) ) 
@@ -411,14 +800,20 @@ void SaveData( PicamHandle camera, const PicamAvailableData& available, string f
         }
         
         //std::cout << "pFile seemingly defined." << std::endl; 
+        // - make the readout visible to a reader following the file
+        fflush( pFile );
         fclose( pFile );
     }
 
 }
 
 // - acquires data while changing exposure time
-void AcquireAndExposeAndSave( PicamHandle camera, int readout_count, string image_file_prefix, string parameter_file_prefix )
+//   with stream set, all readouts of the acquisition are appended to one raw
+//   file as they arrive, so that mlof_stream_convert.py can convert them while
+//   the camera keeps running
+void AcquireAndExposeAndSave( PicamHandle camera, int readout_count, string image_file_prefix, string parameter_file_prefix, bool stream = false )
 {
+    TraceSpan acquisition_trace( "AcquireAndExposeAndSave", "acquisition" );
     PicamError error;
 
     // - set to acquire 10 readouts
@@ -443,10 +838,39 @@ void AcquireAndExposeAndSave( PicamHandle camera, int readout_count, string imag
     Picam_DestroyParameters( failed_parameters );
     PrintError( error );
 
+    // - record the committed readout layout next to the exposure parameters
+    std::stringstream geometry_name_stream;
+    geometry_name_stream << parameter_file_prefix << "_geometry.txt";
+    WriteGeometry( camera, geometry_name_stream.str() );
+
+    // - the exposure and readout times place the shutter from when each readout arrives
+    piflt exposure_ms = 0;
+    piflt readout_ms = 0;
+    Picam_GetParameterFloatingPointValue( camera, PicamParameter_ExposureTime, &exposure_ms );
+    Picam_GetParameterFloatingPointValue( camera, PicamParameter_ReadoutTimeCalculation, &readout_ms );
+    std::stringstream timing_name_stream;
+    timing_name_stream << parameter_file_prefix << "_timing.txt";
+    TimingLog timing( timing_name_stream.str() );
+
+    if( stream )
+    {
+        // - start the growing raw file empty
+        std::stringstream stream_name_stream;
+        stream_name_stream << image_file_prefix << ".raw";
+        FILE* pFile = fopen( stream_name_stream.str().c_str(), "wb" );
+        if( pFile )
+            fclose( pFile );
+    }
+
     // - acquire asynchronously
     std::cout << "Acquire:" << std::endl;
     std::cout << "    Start: ";
-    error = Picam_StartAcquisition( camera );
+    double issue_mono = MonotonicMicroseconds();
+    timing.Mark( 0, "issue", issue_mono, WallClockMicroseconds() );
+    {
+        TraceSpan trace( "Picam_StartAcquisition" );
+        error = Picam_StartAcquisition( camera );
+    }
     PrintError( error );
 
     // - acquisition loop
@@ -456,19 +880,25 @@ void AcquireAndExposeAndSave( PicamHandle camera, int readout_count, string imag
     pibool running = true;
     pi64s readouts_acquired = 0;
     // pibool changed_exposure = true;
-    time_t start_time; 
-    time_t end_time; 
-    time(&start_time); 
+    // - no exposure opens before the command was issued or before the previous readout arrived
+    double earliest_open_mono = issue_mono;
+    double open_wall = 0;
+    double close_wall = 0;
     while( (error == PicamError_None || error == PicamError_TimeOutOccurred) &&
            running )
     {
         // - wait for data, completion or failure
-        error =
-            Picam_WaitForAcquisitionUpdate(
-                camera,
-                readout_time_out,
-                &available,
-                &status );
+        {
+            TraceSpan trace( "Picam_WaitForAcquisitionUpdate" );
+            error =
+                Picam_WaitForAcquisitionUpdate(
+                    camera,
+                    readout_time_out,
+                    &available,
+                    &status );
+        }
+        double arrival_mono = MonotonicMicroseconds();
+        double arrival_wall = WallClockMicroseconds();
 
         // - display each result
         if( error == PicamError_None &&
@@ -476,13 +906,43 @@ void AcquireAndExposeAndSave( PicamHandle camera, int readout_count, string imag
         {
             running = status.running != 0;
             readouts_acquired += available.readout_count;
-            time(&end_time); 
-            //cout << "start_time = " << start_time << " and end_time = " << end_time << std::endl; 
             if( available.readout_count ) 
-            { // - read temperature
+            { // - picam only says when each readout arrived: the shutter closed a
+              //   readout time before that, and opened an exposure time before it
+              //   closed.  Readouts that arrive together are a frame period apart.
+                double wall_offset = arrival_wall - arrival_mono;
+                double frame_period_us = 1e3 * ( exposure_ms + readout_ms );
+                for( pi64s k = 0; k < available.readout_count; k++ )
+                {
+                    long readout = (long)( readouts_acquired - available.readout_count + 1 + k );
+                    double readout_mono = arrival_mono - ( available.readout_count - 1 - k ) * frame_period_us;
+                    double close_mono = readout_mono - 1e3 * readout_ms;
+                    double open_mono = close_mono - 1e3 * exposure_ms;
+                    if( open_mono < earliest_open_mono )
+                        open_mono = earliest_open_mono;
+                    if( close_mono < open_mono )
+                        close_mono = open_mono;
+                    open_wall = open_mono + wall_offset;
+                    close_wall = close_mono + wall_offset;
+                    timing.Mark( readout, "open", open_mono, open_wall );
+                    timing.Mark( readout, "close", close_mono, close_wall );
+                    timing.Mark( readout, "readout", readout_mono, readout_mono + wall_offset );
+                    TraceComplete( "exposure", "acquisition", open_wall, close_wall - open_wall, readout );
+                    earliest_open_mono = readout_mono;
+                }
+
+                // - read temperature: the telemetry mean over the exposure if it has
+                //   samples in the window, otherwise straight from hardware
                 // std::cout << "Read sensor temperature: ";
                 piflt temperature;
-                error = Picam_ReadParameterFloatingPointValue(
+                double window_mean;
+                if( telemetry.WindowMean( open_wall / 1e6, close_wall / 1e6, &window_mean ) )
+                {
+                    temperature = window_mean;
+                    error = PicamError_None;
+                }
+                else
+                    error = Picam_ReadParameterFloatingPointValue(
                                                               camera,
                                                               PicamParameter_SensorTemperatureReading,
                                                               &temperature );
@@ -503,12 +963,17 @@ void AcquireAndExposeAndSave( PicamHandle camera, int readout_count, string imag
                 string new_image_name = image_name_stream.str(); 
                 string new_parameter_name = parameter_name_stream.str(); 
                 std::cout << "Saving readout to file: " << new_image_name << std::endl; 
-                SaveData( camera, available, new_image_name );
-                double start_float = start_time; 
-                double end_float = end_time; 
+                SaveData( camera, available, new_image_name, stream );
+                double saved_mono = MonotonicMicroseconds();
+                double saved_wall = WallClockMicroseconds();
+                for( pi64s k = 0; k < available.readout_count; k++ )
+                    timing.Mark( (long)( readouts_acquired - available.readout_count + 1 + k ), "saved", saved_mono, saved_wall );
+                // - the (last) exposure's shutter open and close, to the microsecond
+                double start_float = open_wall / 1e6; 
+                double end_float = close_wall / 1e6; 
                 double temperature_float = temperature; 
                 double array_to_print [] = {temperature_float, start_float, end_float};
-                int precision_of_params_to_print [] = {0, 0, 0}; 
+                int precision_of_params_to_print [] = {2, 6, 6}; 
                 PrintToFile(array_to_print, new_parameter_name, precision_of_params_to_print );    
             } 
         }
@@ -613,15 +1078,34 @@ int main( int argc, char* argv[] )
     std::cout << "Prefix for saved parameter values is " << parameter_file_prefix << std::endl; 
 
     // - allow the optional argument 'lock' to wait for temperature lock
+    // - and the optional argument 'stream' to take all readout_count readouts
+    //   as one acquisition, appended to a single growing raw file
+    // - and the optional argument 'roi=x,width,x_binning,y,height,y_binning'
+    //   to read out a binned region of interest instead of the full sensor
+    // - and the optional argument 'telemetry=period_ms' to set how often the
+    //   sensor temperature is sampled (default 500 ms, 0 turns telemetry off)
     pibool lock = false;
-    if( argc == 9 )
+    bool stream = false;
+    bool use_roi = false;
+    PicamRoi roi;
+    int telemetry_period_ms = 500;
+    for( int i = 8; i < argc; i++ )
     {
-        std::string arg( argv[8] );
+        std::string arg( argv[i] );
         if( arg == "lock" )
             lock = true;
+        else if( arg == "stream" )
+            stream = true;
+        else if( arg.compare( 0, 4, "roi=" ) == 0 &&
+                 sscanf( arg.c_str() + 4, "%d,%d,%d,%d,%d,%d",
+                         &roi.x, &roi.width, &roi.x_binning,
+                         &roi.y, &roi.height, &roi.y_binning ) == 6 )
+            use_roi = true;
+        else if( arg.compare( 0, 10, "telemetry=" ) == 0 )
+            telemetry_period_ms = atoi( arg.c_str() + 10 );
         else
         {
-            std::cout << "Invalid argument to lock temperature.";
+            std::cout << "Invalid optional argument " << arg << " (expected lock, stream, roi=x,width,x_binning,y,height,y_binning or telemetry=period_ms).";
             return -1;
         }
     }
@@ -647,10 +1131,17 @@ int main( int argc, char* argv[] )
 
     std::cout << "Configuration" << std::endl
               << "=============" << std::endl;
-    Configure( camera, exp_time, gain_setting, fast, shutter );
+    Configure( camera, exp_time, gain_setting, fast, shutter, use_roi ? &roi : NULL );
     //Acquire( camera );
     std::cout << std::endl;
 
+    if( telemetry_period_ms > 0 )
+    {
+        std::stringstream series_name_stream;
+        series_name_stream << parameter_file_prefix << "_temperature.txt";
+        telemetry.Start( camera, series_name_stream.str(), telemetry_period_ms );
+    }
+
     std::cout << "Temperature" << std::endl
               << "===========" << std::endl;
     //piflt* temperature_pointer;
@@ -672,6 +1163,16 @@ int main( int argc, char* argv[] )
     //int readout_count = 8; 
     std::cout << "Starting Series of Exposures" << std::endl
               << "===============" << std::endl;
+    if( stream )
+    {
+        // - one acquisition for the whole series; each readout lands in
+        //   image_file_prefix.raw as soon as picam hands it over
+        if( lock && telemetry.running )
+            GateOnLock();
+        AcquireAndExposeAndSave( camera, readout_count, image_file_prefix, parameter_file_prefix, true );
+        std::cout << std::endl;
+        readout_count = 0;
+    }
     for (int i=1; i<=readout_count; i++) {
         string new_image_file_prefix; 
         new_image_file_prefix.append(image_file_prefix); 
@@ -680,10 +1181,13 @@ int main( int argc, char* argv[] )
         new_parameter_file_prefix.append(parameter_file_prefix); 
         //new_parameter_file_prefix.append(ConvertFloatToString(static_cast< float > (i), 0));
 
+        if( lock && telemetry.running )
+            GateOnLock();
         AcquireAndExposeAndSave( camera, 1, new_image_file_prefix, new_parameter_file_prefix );
         std::cout << std::endl;
     } 
 
+    telemetry.Stop();
     Picam_CloseCamera( camera );
 
     Picam_UninitializeLibrary();